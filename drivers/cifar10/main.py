@@ -294,6 +294,10 @@ def main():
   test_loader  = torch.utils.data.DataLoader(test_set,
                                              batch_size=args.batch_size, 
                                              shuffle=False)
+  if force_lp:
+    # only rank 0 reads the images
+    train_loader = torchbraid.utils.LPDataLoader(train_loader,MPI.COMM_WORLD)
+    test_loader  = torchbraid.utils.LPDataLoader(test_loader,MPI.COMM_WORLD)
 
   if force_lp :
     root_print(rank,'Using ParallelNet: finefcf {}, use_downcycle {}'.format(args.lp_finefcf,args.lp_use_downcycle))
@@ -362,6 +362,8 @@ def main():
                       help='Layer parallel use user-defined mpi buffers (default: False)')
   parser.add_argument('--warm-up', action='store_true', default=False,
                       help='Warm up for GPU timings (default: False)')
+  parser.add_argument('--placement', action='store_true', default=False,
+                      help='Divide the cores of each node between its ranks, and report the placement (default: False)')
 
   comm = MPI.COMM_WORLD
   rank = comm.Get_rank()
@@ -369,7 +371,10 @@ def main():
   args = parser.parse_args()
 
   use_cuda = not args.no_cuda and torch.cuda.is_available()
-  device, host = torchbraid.utils.getDevice(comm=comm)
+  if args.placement:
+    device, host, _ = torchbraid.utils.place_rank(comm,use_gpu=use_cuda,report=True)
+  else:
+    device, host = torchbraid.utils.getDevice(comm=comm)
   if not use_cuda:
     device = torch.device("cuda" if use_cuda else "cpu")
   print(f'Run info rank: {rank}: Torch version: {torch.__version__} | Device: {device} | Host: {host}')
@@ -421,6 +426,10 @@ def main():
   test_set = torch.utils.data.Subset(dataset, range(train_size, train_size + test_size))
   train_loader = torch.utils.data.DataLoader(train_set, batch_size=args.batch_size, shuffle=False)
   test_loader = torch.utils.data.DataLoader(test_set, batch_size=args.batch_size, shuffle=False)
+  if force_lp:
+    # only rank 0 reads the images
+    train_loader = torchbraid.utils.LPDataLoader(train_loader, comm, device=device)
+    test_loader = torchbraid.utils.LPDataLoader(test_loader, comm, device=device)
 
   root_print(rank, '')
 
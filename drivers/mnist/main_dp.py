@@ -56,6 +56,7 @@ from torchvision import datasets, transforms
 
 import torchbraid
 import torchbraid.utils
+import torchbraid.utils.data_parallel
 
 
 # from sgd import SGD as SGD2
@@ -233,7 +234,7 @@ class ParallelNet(nn.Module):
     return x
 
 
-def train(args, model, train_loader, optimizer, epoch, compose, device, comm_dp, comm_lp):
+def train(args, model, train_loader, optimizer, epoch, compose, device, comm_dp, comm_lp, reducer):
   rank_lp = comm_lp.Get_rank()
   rank_dp = comm_dp.Get_rank()
   model.train()
@@ -246,9 +247,8 @@ def train(args, model, train_loader, optimizer, epoch, compose, device, comm_dp,
     output = model(data)
     loss = compose(criterion, output, target)
     loss.backward()
-    #get_grads(model=model, comm_dp=comm_dp, comm_lp=comm_lp)
-    dp_avg_grads(model=model, comm_dp=comm_dp, comm_lp=comm_lp)
-    #get_grads(model=model, comm_dp=comm_dp, comm_lp=comm_lp)
+    # the gradients are averaged during the backward pass, wait for the reductions
+    reducer.finish()
 
     stop_time = timer()
     optimizer.step()
@@ -383,15 +383,6 @@ def split_communicator(comm: MPI.Comm, splitting: int):
   return comm_dp, comm_lp
 
 
-def dp_avg_grads(model, comm_dp, comm_lp):
-  for param in model.parameters():
-    send_buf = param.grad.data
-    recv_buf = torch.zeros_like(send_buf)
-    comm_dp.Allreduce(send_buf, recv_buf, op=MPI.SUM)
-    param.grad.data = recv_buf / float(comm_dp.Get_size())
-
-
-
 def main():
   # Training settings
   parser = argparse.ArgumentParser(description='TORCHBRAID CIFAR10 Example')
@@ -582,6 +573,7 @@ def main():
     compose = lambda op, *p: op(*p)
 
   optimizer = optim.SGD(model.parameters(), lr=args.lr, momentum=0.9)
+  reducer = torchbraid.utils.data_parallel.GradientReducer(model, comm_dp, use_cuda=use_cuda)
   # optimizer = SGD2(model.parameters(), lr=args.lr, momentum=0.9)
 
   epoch_times = []
@@ -594,7 +586,7 @@ def main():
   if args.warm_up:
     warm_up_timer = timer()
     train(args=args, model=model, train_loader=train_loader, optimizer=optimizer, epoch=0,
-          compose=compose, device=device, comm_dp=comm_dp, comm_lp=comm_lp)
+          compose=compose, device=device, comm_dp=comm_dp, comm_lp=comm_lp, reducer=reducer)
     if force_lp:
       model.parallel_nn.timer_manager.resetTimers()
       model.parallel_nn.fwd_app.resetBraidTimer()
@@ -608,7 +600,7 @@ def main():
   for epoch in range(1, args.epochs + 1):
     start_time = timer()
     train(args=args, model=model, train_loader=train_loader, optimizer=optimizer, epoch=epoch,
-          compose=compose, device=device, comm_dp=comm_dp, comm_lp=comm_lp)
+          compose=compose, device=device, comm_dp=comm_dp, comm_lp=comm_lp, reducer=reducer)
     end_time = timer()
     epoch_times += [end_time - start_time]
 
@@ -143,6 +143,11 @@ class ImplicitGRUBlock(nn.Module):
 
     return (x_red_r,x_red_z,x_red_n)
 
+  def reduceXSequence(self, x):
+    # the linear layers act on the last dimension, so the whole sequence
+    # (batch x time x input) is reduced at once
+    return self.reduceX(x)
+
   def fastForward(self, level,tstart,tstop,x_red, h_prev):
     dt = tstop-tstart
 
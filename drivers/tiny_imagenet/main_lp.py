@@ -66,6 +66,7 @@ from torchvision import datasets, transforms
 from timeit import default_timer as timer
 
 from utils import parse_args, buildNet, ParallelNet, getComm, git_rev, getDevice
+from torchbraid.utils import LPDataLoader
 
 
 def root_print(rank, s):
@@ -211,42 +212,6 @@ def test(rank, args, model, test_loader, epoch, compose, device, prefix=''):
   return 100. * correct / len(test_loader.dataset)
 
 
-class FakeIter:
-  def __init__(self, cnt, elmt):
-    self.cnt = cnt
-    self.elmt = elmt
-
-  def __iter__(self):
-    return self
-
-  def __next__(self):
-    if self.cnt > 0:
-      self.cnt -= 1
-      return self.elmt
-    else:
-      raise StopIteration
-
-
-class FakeLoader:
-  def __init__(self, cnt, device):
-    self.cnt = cnt
-
-    elmt = torch.tensor((), device=device)
-    self.elmt = (elmt, elmt)
-
-    self.dataset = cnt * [None]
-
-  def __iter__(self):
-    return FakeIter(self.cnt, self.elmt)
-
-
-def parallel_loader(rank, loader, device):
-  if rank == 0:
-    return loader
-  batches = len(loader)
-  return FakeLoader(batches, device)
-
-
 def main():
   ##
   # Parse command line args (function defined above)
@@ -299,11 +264,12 @@ def main():
   train_loader = torch.utils.data.DataLoader(train_dataset,
                                              batch_size=args.batch_size, shuffle=True,
                                              pin_memory=True)
-  train_loader = parallel_loader(rank, train_loader, my_device)
+  # only rank 0 reads the images
+  train_loader = LPDataLoader(train_loader, comm, device=my_device)
   test_loader = torch.utils.data.DataLoader(test_dataset,
                                             batch_size=args.batch_size, shuffle=False,
                                             pin_memory=True)
-  test_loader = parallel_loader(rank, test_loader, my_device)
+  test_loader = LPDataLoader(test_loader, comm, device=my_device)
   if rank == 0:
     print("\nTraining setup:  Batch size:  " + str(args.batch_size) + "  Sample ratio:  " + str(
       args.samp_ratio) + "  Epochs:  " + str(args.epochs))
@@ -369,10 +335,7 @@ def main():
 
   if args.load_model:
     root_print(rank, f'Loading from \"{args.model_dir}\"')
-    model.loadParams(rank, args.model_dir)
-    optimizer.load_state_dict(torch.load(f'{args.model_dir}/optimizer.{rank}.mdl'))
-    if args.lr_scheduler:
-      scheduler.load_state_dict(torch.load(f'{args.model_dir}/scheduler.{rank}.mdl'))
+    model.loadCheckpoint(rank, args.model_dir, optimizer, scheduler)
 
   model = model.to(my_device)
 
@@ -405,6 +368,8 @@ def main():
 
   print(f'Run info rank: {rank}: Torch version: {torch.__version__} | Device: {my_device} | Host: {my_host}')
 
+  checkpoint = None
+
   epoch = 0
   start_time = timer()
   test_result = test(rank, args, model, test_loader, epoch, compose, my_device)
@@ -428,12 +393,13 @@ def main():
     # output the serial and parallel models
     if args.save_model:
       root_print(rank, f'Saving to \"{args.model_dir}\"')
-      torch.save(optimizer.state_dict(), f'{args.model_dir}/optimizer.{rank}.mdl')
-      if args.lr_scheduler:
-        torch.save(scheduler.state_dict(), f'{args.model_dir}/scheduler.{rank}.mdl')
-      model.saveParams(rank, args.model_dir)
+      # the parallel checkpoint is written in the background, while training continues
+      checkpoint = model.saveCheckpoint(rank, args.model_dir, optimizer, scheduler)
     # end args
 
+  if checkpoint is not None:
+    checkpoint.wait()
+
   if not args.use_serial:
     timer_str = model.parallel_nn.getTimersString()
     root_print(rank, timer_str)
@@ -207,6 +207,19 @@ class SerialNet(nn.Module):
   def loadParams(self,rank,model_dir):
     self.load_state_dict(torch.load(f'{model_dir}/serial_model.{rank}.mdl'))
 
+  def saveCheckpoint(self,rank,model_dir,optimizer,scheduler=None):
+    self.saveParams(rank,model_dir)
+    torch.save(optimizer.state_dict(),f'{model_dir}/optimizer.{rank}.mdl')
+    if scheduler is not None:
+      torch.save(scheduler.state_dict(),f'{model_dir}/scheduler.{rank}.mdl')
+    return None
+
+  def loadCheckpoint(self,rank,model_dir,optimizer,scheduler=None):
+    self.loadParams(rank,model_dir)
+    optimizer.load_state_dict(torch.load(f'{model_dir}/optimizer.{rank}.mdl'))
+    if scheduler is not None:
+      scheduler.load_state_dict(torch.load(f'{model_dir}/scheduler.{rank}.mdl'))
+
 
 class ParallelNet(nn.Module):
   ''' Full parallel ODE-net based on StepLayer,  will be parallelized in time ''' 
@@ -290,6 +303,20 @@ class ParallelNet(nn.Module):
   def loadParams(self,rank,model_dir):
     self.load_state_dict(torch.load(f'{model_dir}/parallel_model.{rank}.mdl'))
 
+  def saveCheckpoint(self,rank,model_dir,optimizer,scheduler=None):
+    # the layers are sharded by global layer index, so this can be loaded on a
+    # different number of processors. The close layer and scheduler come from rank 0.
+    extra = {'close_nn': self.close_nn.state_dict() if rank==0 else None,
+             'scheduler': scheduler.state_dict() if scheduler is not None else None}
+    return self.parallel_nn.saveCheckpoint(model_dir,optimizer,extra=extra)
+
+  def loadCheckpoint(self,rank,model_dir,optimizer,scheduler=None):
+    extra = self.parallel_nn.loadCheckpoint(model_dir,optimizer)
+    if rank==0:
+      self.close_nn.load_state_dict(extra['close_nn'])
+    if scheduler is not None:
+      scheduler.load_state_dict(extra['scheduler'])
+
 # end ParallelNet 
 ####################################################################################
 ####################################################################################
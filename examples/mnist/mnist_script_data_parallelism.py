@@ -210,12 +210,12 @@ def main():
   test_size = int(10000 * args.percent_data)
   train_set = torch.utils.data.Subset(dataset, range(train_size))
   test_set = torch.utils.data.Subset(dataset, range(train_size, train_size + test_size))
-  train_partition = torchbraid.utils.data_parallel.Partioner(data=train_set, procs=size_dp, seed=args.seed, batch_size=batch_size).get_partion(
-    rank=rank_dp)
-  test_partition = torchbraid.utils.data_parallel.Partioner(data=test_set, procs=size_dp, seed=args.seed, batch_size=batch_size).get_partion(
-    rank=rank_dp)
-  train_loader = torch.utils.data.DataLoader(train_partition, batch_size=batch_size, shuffle=False)
-  test_loader = torch.utils.data.DataLoader(test_partition, batch_size=batch_size, shuffle=False)
+  train_sampler = torchbraid.utils.data_parallel.PartitionSampler(train_set, procs=size_dp, rank=rank_dp, seed=args.seed,
+                                                                  batch_size=batch_size)
+  test_sampler = torchbraid.utils.data_parallel.PartitionSampler(test_set, procs=size_dp, rank=rank_dp, seed=args.seed,
+                                                                 batch_size=batch_size)
+  train_loader = torch.utils.data.DataLoader(train_set, batch_size=batch_size, sampler=train_sampler)
+  test_loader = torch.utils.data.DataLoader(test_set, batch_size=batch_size, sampler=test_sampler)
 
   # Diagnostic information
   root_print(rank, '-- procs_lp       = {}\n'
@@ -284,6 +284,7 @@ def main():
   validat_correct_counts = []
 
   for epoch in range(1, args.epochs + 1):
+    train_sampler.set_epoch(epoch)
     start_time = timer()
     [losses, train_times] = train(params=args, model=model, train_loader=train_loader, optimizer=optimizer,
                                   epoch=epoch, compose=model.compose, device=device, comm_dp=comm_dp, comm_lp=comm_lp)
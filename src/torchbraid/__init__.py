@@ -1,4 +1,5 @@
 from .layer_parallel import LayerParallel
+from .async_pipeline import AsyncPipelineTrainer
 from .utils import getDevice
 from .rnn_layer_parallel import RNN_Parallel, RNN_Serial
 from .test_fixtures import test_cbs
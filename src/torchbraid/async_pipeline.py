@@ -0,0 +1,343 @@
+#@HEADER
+# ************************************************************************
+#
+#                        Torchbraid v. 0.1
+#
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+#
+# Torchbraid is licensed under 3-clause BSD terms of use:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name National Technology & Engineering Solutions of Sandia,
+# LLC nor the names of the contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+#
+# ************************************************************************
+#@HEADER
+
+import torch
+from torch.func import functional_call
+
+from mpi4py import MPI
+
+import torchbraid.utils
+
+class AsyncPipelineTrainer:
+  """
+  Asynchronous (1F1B) training driver for a LayerParallel network.
+
+  Each processor owns the layers of its LayerParallel partition, rank 0 also
+  owns the open and close layers and the loss. Batches are streamed through
+  the processors, and a processor works on the forward of a new batch while
+  the backward of an older batch is still in flight elsewhere. So the
+  processors other than rank 0 are not idle while rank 0 evaluates the open
+  and close layers and the loss.
+
+  At most max_staleness+1 batches are in flight. Each processor takes an
+  optimizer step when its part of the backward for a batch is done, so a
+  forward may use weights that miss the updates of up to max_staleness
+  earlier batches. With max_staleness=0 this is synchronous training.
+  Weights are stashed per batch (a copy of the local parameters for each
+  batch in flight) so that the backward uses the same weights as the forward.
+
+  The propagation is exact, MGRIT is not used. For instance:
+
+    trainer = AsyncPipelineTrainer(parallel_nn,optimizer,criterion,
+                                   open_nn=open_nn,close_nn=close_nn,max_staleness=1)
+    for epoch in range(epochs):
+      losses = trainer.train(train_loader) # the batches are only used on rank 0
+    trainer.close()
+  """
+
+  fwd_tag      = 40 # state moving to the right
+  out_tag      = 41 # output of the last processor sent to rank 0
+  grad_out_tag = 42 # gradient of the output sent to the last processor
+  bwd_tag      = 43 # gradient moving to the left
+  stop_tag     = 44
+
+  def __init__(self,parallel_nn,optimizer,criterion=None,open_nn=None,close_nn=None,max_staleness=1):
+    """
+    parallel_nn: The LayerParallel module
+    optimizer: Optimizer for all the parameters on this processor (including the
+               open and close layers on rank 0)
+    criterion: Loss function called as criterion(output,target) on rank 0
+    open_nn: Layer applied to the input before parallel_nn on rank 0 (can be None)
+    close_nn: Layer applied to the output of parallel_nn on rank 0 (can be None)
+    max_staleness: Maximum number of optimizer steps a forward can lag behind
+    """
+    self.parallel_nn = parallel_nn
+    self.fwd_app = parallel_nn.fwd_app
+    self.optimizer = optimizer
+    self.criterion = criterion
+    self.open_nn = open_nn
+    self.close_nn = close_nn
+    self.max_staleness = max_staleness
+
+    assert max_staleness>=0
+    assert not self.fwd_app.splinet, 'Asynchronous training is not supported for a SpliNet'
+
+    # the messages are probed by tag, so they go through a communicator of their own
+    # that braid (or anything else sharing the module's communicator) can't post to
+    self.comm = parallel_nn.getMPIComm().Dup()
+    self.my_rank = self.comm.Get_rank()
+    self.num_ranks = self.comm.Get_size()
+
+    if self.my_rank==0:
+      assert criterion is not None
+
+    params = [p for m in self.stageModules() for p in m.parameters()]
+    self.device = params[0].device if len(params)>0 else torch.device('cpu')
+
+    self.stage_graphs = dict()
+    self.head_grads = dict()
+    self.targets = dict()
+    self.pending = []
+    self.losses = []
+
+  def close(self):
+    """
+    Free the communicator of the trainer, it can't train afterwards. This is
+    collective over the processors of the LayerParallel module.
+    """
+    if self.comm is not None:
+      self.comm.Free()
+      self.comm = None
+
+  def stageModules(self):
+    """
+    The modules evaluated (and stashed) on this processor before the output
+    leaves the processor.
+    """
+    modules = list(self.fwd_app.layer_models)
+    if self.open_nn is not None:
+      modules = [self.open_nn] + modules
+    return modules
+
+  def train(self,batches=None):
+    """
+    Train for one pass over batches, an iterable of (input,target) pairs. This
+    is only used on rank 0, and must be called on all processors.
+
+    Returns the list of losses on rank 0, and an empty list elsewhere.
+    """
+    self.parallel_nn.train()
+    self.losses = []
+
+    if self.my_rank==0:
+      self.trainRoot(batches)
+    else:
+      self.trainWorker()
+
+    MPI.Request.Waitall([r for p in self.pending for r in p[0]])
+    self.pending = []
+
+    return self.losses
+
+  def trainRoot(self,batches):
+    batches = iter(batches)
+    exhausted = False
+    in_flight = 0
+    k = 0
+    while True:
+      status = MPI.Status()
+      if in_flight>0 and self.comm.Iprobe(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG,status=status):
+        # prefer finishing the work in the pipeline
+        in_flight -= self.handleMessage(status)
+      elif not exhausted and in_flight<=self.max_staleness:
+        try:
+          x,target = next(batches)
+        except StopIteration:
+          exhausted = True
+          continue
+
+        self.device = x.device
+        self.targets[k] = target
+        y = self.forwardStage(k,x)
+        in_flight += 1
+
+        if self.num_ranks==1:
+          g = self.head(k,y)
+          self.backwardStage(k,g)
+          in_flight -= 1
+        else:
+          self.send(y,1,self.fwd_tag,k)
+        k += 1
+      elif in_flight>0:
+        self.comm.Probe(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG,status=status)
+        in_flight -= self.handleMessage(status)
+      else:
+        break
+    # end while
+
+    # everyone has finished their work
+    for dest in range(1,self.num_ranks):
+      self.comm.Send(torchbraid.utils.empty_shape_buffer(),dest=dest,tag=self.stop_tag)
+  # end trainRoot
+
+  def trainWorker(self):
+    while True:
+      status = MPI.Status()
+      self.comm.Probe(source=MPI.ANY_SOURCE,tag=MPI.ANY_TAG,status=status)
+      if status.Get_tag()==self.stop_tag:
+        self.comm.Recv(torchbraid.utils.empty_shape_buffer(),source=0,tag=self.stop_tag)
+        break
+      self.handleMessage(status)
+  # end trainWorker
+
+  def handleMessage(self,status):
+    """
+    Receive and process a message, returns 1 if a batch was completed
+    and 0 otherwise.
+    """
+    tag = status.Get_tag()
+    k,t = self.recv(status)
+
+    if tag==self.fwd_tag:
+      y = self.forwardStage(k,t)
+      if self.my_rank==self.num_ranks-1:
+        self.send(y,0,self.out_tag,k)
+      else:
+        self.send(y,self.my_rank+1,self.fwd_tag,k)
+    elif tag==self.out_tag:
+      g = self.head(k,t)
+      self.send(g,self.num_ranks-1,self.grad_out_tag,k)
+    elif tag==self.grad_out_tag or tag==self.bwd_tag:
+      g = self.backwardStage(k,t)
+      if self.my_rank>0:
+        self.send(g,self.my_rank-1,self.bwd_tag,k)
+      else:
+        return 1
+    else:
+      raise RuntimeError(f'AsyncPipelineTrainer: unexpected message tag {tag}')
+
+    return 0
+  # end handleMessage
+
+  def forwardStage(self,k,x):
+    """
+    Apply the local layers to x, using a stashed copy of the weights.
+    """
+    x = x.detach()
+    x.requires_grad = self.my_rank>0 and x.is_floating_point()
+
+    modules = self.stageModules()
+    stash = [{n: p.detach().clone().requires_grad_(p.requires_grad) for n,p in m.named_parameters()} for m in modules]
+
+    fwd_app = self.fwd_app
+    with torch.enable_grad():
+      y = x
+      if self.open_nn is not None:
+        y = functional_call(self.open_nn,stash[0],(y,))
+        layer_stash = stash[1:]
+      else:
+        layer_stash = stash
+
+      dtype = y.dtype
+      for i,(layer,weights) in enumerate(zip(fwd_app.layer_models,layer_stash)):
+        with fwd_app.autocast(0):
+          y = functional_call(layer,weights,(fwd_app.dt,y))
+        y = y.to(dtype)
+
+    self.stage_graphs[k] = (x,y,modules,stash)
+    return y
+  # end forwardStage
+
+  def backwardStage(self,k,g):
+    """
+    Back propagate the gradient g through the local layers, and take an
+    optimizer step. Returns the gradient with respect to the input of this
+    processor (None on rank 0).
+    """
+    x,y,modules,stash = self.stage_graphs.pop(k)
+
+    params  = [p for m in modules for p in m.parameters() if p.requires_grad]
+    stashed = [p for s in stash for p in s.values() if p.requires_grad]
+
+    wrt = stashed + ([x] if x.requires_grad else [])
+    grads = torch.autograd.grad(y,wrt,grad_outputs=g,allow_unused=True)
+
+    self.step(k,list(zip(params,grads[0:len(stashed)])))
+
+    if x.requires_grad:
+      return grads[-1]
+    return None
+  # end backwardStage
+
+  def head(self,k,y):
+    """
+    Evaluate the close layer and loss on rank 0, returns the gradient
+    with respect to y.
+    """
+    y = y.detach()
+    y.requires_grad = True
+
+    with torch.enable_grad():
+      output = self.close_nn(y) if self.close_nn is not None else y
+      loss = self.criterion(output,self.targets.pop(k))
+
+    params = []
+    if self.close_nn is not None:
+      params = [p for p in self.close_nn.parameters() if p.requires_grad]
+    grads = torch.autograd.grad(loss,[y]+params,allow_unused=True)
+
+    # the close layer is updated with the rest of the processors parameters
+    self.head_grads[k] = list(zip(params,grads[1:]))
+    self.losses += [loss.item()]
+
+    return grads[0]
+  # end head
+
+  def step(self,k,param_grads):
+    param_grads += self.head_grads.pop(k,[])
+    for p,g in param_grads:
+      if g is not None:
+        p.grad = g
+    self.optimizer.step()
+    self.optimizer.zero_grad()
+
+  def send(self,t,dest,tag,k):
+    """
+    Send a tensor without waiting, the batch index and shape are sent first.
+    """
+    t = t.detach().contiguous()
+    header = torchbraid.utils.encode_shapes([t.shape,torch.Size([k])],t.dtype)
+    if self.fwd_app.use_cuda:
+      torch.cuda.synchronize()
+
+    requests = [self.comm.Isend(header,dest=dest,tag=tag),
+                self.comm.Isend(t,dest=dest,tag=tag)]
+
+    # keep the buffers alive until the sends complete
+    self.pending += [(requests,header,t)]
+    self.pending = [p for p in self.pending if not MPI.Request.Testall(p[0])]
+
+  def recv(self,status):
+    """
+    Receive a tensor sent by send, returns the batch index and the tensor.
+    """
+    source = status.Get_source()
+    tag = status.Get_tag()
+
+    header = torchbraid.utils.empty_shape_buffer()
+    self.comm.Recv(header,source=source,tag=tag)
+    shapes,dtype = torchbraid.utils.decode_shapes(header)
+
+    t = torch.empty(shapes[0],dtype=dtype,device=self.device)
+    self.comm.Recv(t,source=source,tag=tag)
+
+    return shapes[1][0],t
+# end AsyncPipelineTrainer
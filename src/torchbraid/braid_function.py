@@ -32,6 +32,8 @@
 import torch.autograd
 import torch.nn.functional as F
 
+import torchbraid.utils
+
 class BraidFunction(torch.autograd.Function):
 
   @staticmethod
@@ -47,19 +49,21 @@ class BraidFunction(torch.autograd.Function):
 
   @staticmethod
   def forward(ctx, fwd_app, bwd_app, x, *params):
-    comm          = fwd_app.getMPIComm()
+    comm          = fwd_app.getCommBackend()
     my_rank       = fwd_app.getMPIComm().Get_rank()
     num_ranks     = fwd_app.getMPIComm().Get_size()
 
     fwd_app.setDevice(x.device)
     bwd_app.setDevice(x.device)
 
-    # copy the input to all processors (ensure consistency)
+    # copy the input shape to all processors (ensure consistency), the
+    # shapes of the states are cached by each processor
     if my_rank==0:
-      shape = fwd_app.buildShapes(x)
+      shape_buf = torchbraid.utils.encode_shapes(x.shape,x.dtype)
     else: 
-      shape = None
-    shape = comm.bcast(shape,root=0)
+      shape_buf = torchbraid.utils.empty_shape_buffer()
+    comm.bcast(torch.from_numpy(shape_buf),root=0)
+    shape = fwd_app.getCachedShapes(shape_buf,x.device)
 
     old_shape = fwd_app.getShape()
     adjusting = old_shape is not None and old_shape!=shape
@@ -86,35 +90,58 @@ class BraidFunction(torch.autograd.Function):
       fwd_app.setShape(shape)
       bwd_app.setShape(shape)
 
-    if my_rank!=num_ranks-1:
-      result = torch.zeros(shape[-1],device=x.device)
-      fwd_app.run(x)
-    else:
+    # the output gradient is None on processors that don't use the output
+    ctx.set_materialize_grads(False)
+
+    if not fwd_app.bcast_output:
+      # the output is only used on the last processor, everyone
+      # else gets a placeholder
+      if my_rank!=num_ranks-1:
+        fwd_app.run(x)
+        result = torch.zeros(1,device=x.device)
+        ctx.output_shape = (result.shape,result.dtype,result.device)
+        return result
+
       result = fwd_app.run(x)
+    else:
+      if my_rank!=num_ranks-1:
+        result = torch.zeros(shape[-1],device=x.device)
+        fwd_app.run(x)
+      else:
+        result = fwd_app.run(x)
 
-    # broadcast the output of the last layer
-    comm.Bcast(result, root=num_ranks - 1)
+      # broadcast the output of the last layer
+      comm.bcast(result, root=num_ranks - 1)
 
     if adjusting:
-      return result[0:temp_batch,:]
-    else:
-      return result
+      result = result[0:temp_batch,:]
+
+    ctx.output_shape = (result.shape,result.dtype,result.device)
+    return result
 
   @staticmethod
   def backward(ctx, grad_output):
-    comm          = ctx.bwd_app.getMPIComm()
+    comm          = ctx.bwd_app.getCommBackend()
     my_rank       = ctx.bwd_app.getMPIComm().Get_rank()
     num_ranks     = ctx.bwd_app.getMPIComm().Get_size()
 
-    # copy the input to the final processor (where time integration begins)
-    if num_ranks>1:
+    shape,dtype,device = ctx.output_shape
+
+    # copy the input to the final processor (where time integration begins),
+    # unless the output was only used there
+    if num_ranks>1 and ctx.fwd_app.bcast_output:
       if my_rank==0:
-        if ctx.fwd_app.use_cuda:
-          torch.cuda.synchronize()
-        comm.Isend(grad_output,dest=num_ranks-1)
+        if grad_output is None:
+          grad_output = torch.zeros(shape,dtype=dtype,device=device)
+        req = comm.isend(grad_output,dest=num_ranks-1)
+        req.wait()
       elif my_rank==num_ranks-1: 
-        req = comm.Irecv(grad_output,source=0)
-        req.Wait()
+        # receive into a new buffer, the incoming gradient may not be contiguous
+        grad_output = torch.empty(shape,dtype=dtype,device=device)
+        req = comm.irecv(grad_output,source=0)
+        req.wait()
+    elif my_rank==num_ranks-1 and grad_output is None:
+      grad_output = torch.zeros(shape,dtype=dtype,device=device)
 
     if my_rank==num_ranks-1:
       if ctx.adjusting:
@@ -129,8 +156,10 @@ class BraidFunction(torch.autograd.Function):
 
     grads = ctx.bwd_app.grads
 
-    # flatten the grads array
+    # flatten the grads array, and release the app's references so
+    # the gradient views can be used directly by autograd
     grads = [g for sublist in grads for g in sublist]
+    ctx.bwd_app.grads = None
 
     for grad_needed,param in zip(ctx.needs_input_grad[3:],grads):
       if grad_needed:
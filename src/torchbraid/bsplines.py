@@ -1,5 +1,7 @@
 #!/usr/bin/env python
 
+import numpy as np
+
 class BsplineBasis():
     def __init__(self, nsplines, degree, Tfinal):
         self.nsplines = nsplines
@@ -8,11 +10,49 @@ class BsplineBasis():
 
         self.nKnots = self.nsplines - self.degree + 1
         self.dknots = self.Tf/ (self.nKnots - 1)
+
+        # previously evaluated time points
+        self.eval_cache = dict()
     # end __init__
  
     # Evaluate the spline basis functions at time t:
     # This returns the values of d+1 spline basis functions, and the interval k such that t \in [tau_k, \tau_k+1] for spline knots \tau_i
+    # Results are memoized, a copy of the coefficient list is returned.
     def eval(self, time):
+        if time not in self.eval_cache:
+            self.eval_cache[time] = self.eval_uncached(time)
+
+        spline, k = self.eval_cache[time]
+        return list(spline), k
+    # end eval(time)
+
+    # Evaluate the spline basis functions at a whole array of times at once:
+    # This returns an array of shape (len(times), d+1) with the values of the d+1 non-zero spline
+    # basis functions at each time, and an integer array with the interval k for each time.
+    # The values match eval(time).
+    def eval_many(self, times):
+
+        times = np.asarray(times, dtype=np.float64).reshape(-1)
+
+        # Get interval index k s.t. t \in [t_k, t_k+1] (truncation, as in eval)
+        k = np.trunc(times / self.dknots).astype(np.int64)
+
+        spline = np.zeros((len(times), self.degree+1))
+        spline[:,0] = 1.0
+
+        # Recursive loop to update splines, vectorized over the times
+        deltaKnots = self.dknots
+        for i in range(1,self.degree+1):        # i = 1,2,...,degree
+            for r in range(i,0,-1):        # r = i, i-1, ..., 1
+                coeff1 = (times - (k-i+r)*deltaKnots)  / ( (k+r)*deltaKnots - (k-i+r)*deltaKnots )
+                coeff2 = ( (k+r+1)*deltaKnots - times) / ( (k+r+1)*deltaKnots - (k-i+r+1)*deltaKnots )
+                spline[:,r] = coeff1 * spline[:,r-1] + coeff2 * spline[:,r]
+            spline[:,0] = spline[:,0] * ((k+1)*deltaKnots - times) / ((k+1)*deltaKnots - (k-i+1)*deltaKnots)
+
+        return spline, k
+    # end eval_many(times)
+
+    def eval_uncached(self, time):
 
         # Get interval index k s.t. t \in [t_k, t_k+1]
         k = int(time / self.dknots)   # this will round down to next smaller integer
@@ -32,7 +72,7 @@ class BsplineBasis():
             spline[0] = spline[0] * ((k+1)*deltaKnots - time) / ((k+1)*deltaKnots - (k-i+1)*deltaKnots)
 
         return spline, k
-    # end eval(time)
+    # end eval_uncached(time)
 
 
 def spline_test(degree, nSplines, Tfinal, deltax):
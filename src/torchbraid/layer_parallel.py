@@ -30,6 +30,11 @@
 #@HEADER
 
 import inspect
+import json
+import os
+import re
+import threading
+import uuid
 
 import torch
 import torch.nn as nn
@@ -39,6 +44,7 @@ from mpi4py import MPI
 import copy
 
 from torchbraid.braid_function import BraidFunction
+from torchbraid.pipeline_function import PipelineFunction
 from torchbraid.utils import ContextTimerManager
 
 import torchbraid.odenet_apps as apps
@@ -65,6 +71,58 @@ class FixDTBlock(nn.Module):
     return self.layer(self.dt,x)
 # end FixDTBlock
 
+class CheckpointFuture:
+  """
+  Handle for a checkpoint being written in the background. wait() must be
+  called on all processors, it blocks until the files of all processors are
+  written and then publishes the checkpoint (the root writes the manifest).
+  """
+
+  def __init__(self,comm,write,publish,async_write=True):
+    self.comm = comm
+    self.publish = publish
+    self.error = None
+    self.published = None
+
+    def run():
+      try:
+        write()
+      except Exception as e:
+        self.error = e
+
+    if async_write:
+      self.thread = threading.Thread(target=run,daemon=False)
+      self.thread.start()
+    else:
+      self.thread = None
+      run()
+
+  def wait(self):
+    if self.published is None:
+      if self.thread is not None:
+        self.thread.join()
+
+      # only publish once all the shards are complete
+      published = self.comm.allreduce(self.error is None,op=MPI.LAND)
+      if published and self.comm.Get_rank()==0:
+        try:
+          self.publish()
+        except Exception as e:
+          self.error = e
+      if published:
+        published = self.comm.bcast(self.error is None,root=0)
+      self.published = published
+
+    if not self.published:
+      raise RuntimeError('writing the checkpoint failed') from self.error
+
+  def done(self):
+    """
+    Check if the files of this processor are written.
+    """
+    return self.thread is None or not self.thread.is_alive()
+# end CheckpointFuture
+
 class LayerParallel(LPModule):
 
   def __init__(self,comm,layer_blocks,global_steps,Tf,max_fwd_levels=1,max_bwd_levels=1,max_iters=10,spatial_ref_pair=None,user_mpi_buf=False, nsplines=0, splinedegree=1):
@@ -81,6 +139,9 @@ class LayerParallel(LPModule):
     blocks with global_steps greater than 1, the layer is treated as a NODE. Note that the time
     step used doesn't really care about this, and if you sum the global steps (say equal to N_total),
     then dt=Tf/N_total.
+
+    If user_mpi_buf is True the buffers of the braid messages are allocated as tensors, and a
+    received vector uses its buffer without a copy (this is always the case on the GPU).
     """
     super().__init__(comm)
 
@@ -89,20 +150,44 @@ class LayerParallel(LPModule):
     layer_blocks = self.makeList(layer_blocks)
 
     assert(len(global_steps)==len(layer_blocks)) # sanity check
-    layers = zip(global_steps,layer_blocks)
 
-    self.fwd_app = apps.ForwardODENetApp(comm,layers,Tf,max_fwd_levels,max_iters,self.timer_manager,
-                                         spatial_ref_pair=spatial_ref_pair,user_mpi_buf=user_mpi_buf,
-                                         nsplines=nsplines, splinedegree=splinedegree)
-    self.bwd_app = apps.BackwardODENetApp(self.fwd_app,self.timer_manager,max_levels=max_bwd_levels)
+    # kept so the apps can be rebuilt on another communicator (see repartition)
+    self.app_args = {'layers': list(zip(global_steps,layer_blocks)),
+                     'Tf': Tf,
+                     'max_fwd_levels': max_fwd_levels,
+                     'max_bwd_levels': max_bwd_levels,
+                     'max_iters': max_iters,
+                     'spatial_ref_pair': spatial_ref_pair,
+                     'user_mpi_buf': user_mpi_buf,
+                     'nsplines': nsplines,
+                     'splinedegree': splinedegree}
+
+    self.buildApps(comm)
+
+    self.inference_mode = 'auto'
+
+    self.execution_mode = 'mgrit'
+    self.num_microbatches = 1
+
+    self.checkpoint_future = None
+
+  # end __init__
+
+  def buildApps(self,comm):
+    """
+    Build the forward and backward apps, and the local layers, on comm.
+    """
+    args = self.app_args
+    self.fwd_app = apps.ForwardODENetApp(comm,args['layers'],args['Tf'],args['max_fwd_levels'],args['max_iters'],self.timer_manager,
+                                         spatial_ref_pair=args['spatial_ref_pair'],user_mpi_buf=args['user_mpi_buf'],
+                                         nsplines=args['nsplines'], splinedegree=args['splinedegree'])
+    self.bwd_app = apps.BackwardODENetApp(self.fwd_app,self.timer_manager,max_levels=args['max_bwd_levels'])
 
     self.layer_models = [l for l in self.fwd_app.layer_models]
     self.local_layers = nn.Sequential(*self.layer_models)
 
     self.dt = self.fwd_app.dt
 
-  # end __init__
-
   def makeList(self,data):
     """
     Conditionally convert a single element to a list, or return a list
@@ -119,39 +204,150 @@ class LayerParallel(LPModule):
       l.zero_grad()
     self.local_layers.zero_grad()
 
+  def getGradBuffer(self):
+    """
+    Get the flat buffer holding the gradients of the local layers computed
+    by the last backward solve, for instance to reduce them with a single
+    call. Returns None if the parameter gradients are not views into it.
+    """
+    return self.bwd_app.getGradBuffer()
+
+  def setGradientReducer(self, reducer):
+    """
+    Set the data parallel GradientReducer notified as the gradients of the
+    local layers become final in the backward solve (None to disable).
+    """
+    self.configureApps('bwd','__setattr__','grad_reducer',reducer)
+
   def setFwdStorage(self, storage):
-    self.fwd_app.setStorage(storage)
+    self.configureApps('fwd','setStorage',storage)
 
   def setBwdStorage(self, storage):
-    self.bwd_app.setStorage(storage)
+    self.configureApps('bwd','setStorage',storage)
 
   def setMinCoarse(self, mc):
-    self.fwd_app.setMinCoarse(mc)
-    self.bwd_app.setMinCoarse(mc)
+    self.configureApps('both','setMinCoarse',mc)
 
   def setFMG(self):
-    self.fwd_app.setFMG()
-    self.bwd_app.setFMG()
+    self.configureApps('both','setFMG')
 
   def setFwdFinalFCRelax(self):
-    self.fwd_app.finalRelax()
+    self.configureApps('fwd','finalRelax')
 
   def setBwdFinalFCRelax(self):
-    self.bwd_app.finalRelax()
+    self.configureApps('bwd','finalRelax')
 
   def setBwdRelaxOnlyCG(self, flag):
-    self.bwd_app.setRelaxOnlyCG(flag)
+    self.configureApps('bwd','setRelaxOnlyCG',flag)
 
   def setFwdRelaxOnlyCG(self, flag):
-    self.fwd_app.setRelaxOnlyCG(flag)
+    self.configureApps('fwd','setRelaxOnlyCG',flag)
 
   def setCRelaxWt(self, CWt):
-    self.bwd_app.setCRelaxWt(CWt)
+    self.configureApps('bwd','setCRelaxWt',CWt)
     #
     # Probably leave commented out for forward solve, more interested
     # in "mixing" adjoint data.
     #self.fwd_app.setCFactor(CWt)
 
+  def setCompile(self,enable=True,max_shapes=1,**compile_kwargs):
+    """
+    Compile the step (and through autograd its adjoint) with torch.compile.
+
+    Compiled steps are cached by (block type, shape, level, training). For
+    each block type, level and training flag at most max_shapes shapes are
+    compiled, steps with other shapes (a short final batch, for instance)
+    fall back to eager. Additional keyword arguments are passed
+    to torch.compile.
+    """
+    self.configureApps('fwd','setCompile',enable,max_shapes,**compile_kwargs)
+
+  def getCompileStats(self):
+    """
+    Get a dictionary of the compilation statistics on this processor: the
+    calls through a compiled step (hits), the calls that compiled a new step
+    (misses), the eager calls (fallbacks) and the compile failures.
+    """
+    return self.fwd_app.getCompileStats()
+
+  def setExecutionMode(self,mode,num_microbatches=1):
+    """
+    Set how the forward and backward propagation are computed. This can be
+    changed at any time (say per epoch) without rebuilding the model.
+
+      'mgrit'    - Forward and adjoint MGRIT solves (default)
+      'pipeline' - Exact propagation, the batch is split into num_microbatches
+                   micro-batches that are streamed through the processors
+    """
+    assert mode in ['mgrit','pipeline']
+    assert num_microbatches>0
+    if mode=='pipeline':
+      assert not self.fwd_app.splinet, 'Pipeline execution is not supported for a SpliNet'
+
+    self.execution_mode = mode
+    self.num_microbatches = num_microbatches
+
+  def getExecutionMode(self):
+    return self.execution_mode
+
+  def setCloseOnLastRank(self,enable=True):
+    """
+    Keep the output of the network on the last processor, instead of copying
+    it to all processors. The close layer and loss are then evaluated on the
+    last rank (use comp_op(rank=-1)), and the other processors get a one
+    element placeholder. This avoids communicating the final feature map
+    from the last processor, and its gradient back, each step. Use
+    copyScalarFromRank to share the value of the loss.
+    """
+    self.configureApps('fwd','__setattr__','bcast_output',not enable)
+
+  def setInferenceMode(self,mode):
+    """
+    Set how the network is evaluated for inference, that is in eval mode
+    with gradients disabled (e.g. under torch.no_grad or torch.inference_mode).
+
+      'auto'       - Use the sequential evaluation if its critical path is
+                     shorter than max_iters MGRIT iterations (default)
+      'sequential' - Exact rank-by-rank evaluation, layer weights are not
+                     communicated and the backward app is not touched
+      'mgrit'      - Use the forward MGRIT solve, as in training
+    """
+    assert mode in ['auto','sequential','mgrit']
+    self.inference_mode = mode
+
+  def useSequentialInference(self):
+    """
+    Determine if the sequential evaluation is used for inference.
+    """
+    if self.inference_mode=='mgrit' or self.fwd_app.splinet:
+      return False
+    if self.inference_mode=='sequential':
+      return True
+
+    seq_cost,mgrit_cost = self.fwd_app.getSequentialCost()
+    return seq_cost<=mgrit_cost
+
+  def sequentialForward(self,x):
+    """
+    Evaluate the network without MGRIT, the output is broadcast
+    from the last processor.
+    """
+    comm = self.getMPIComm()
+
+    with torch.inference_mode():
+      y = self.fwd_app.runSequential(x)
+
+    # the result is copied outside of inference mode so it can be used freely
+    if y is not None:
+      y = y.clone()
+
+    if not self.fwd_app.bcast_output:
+      return y if y is not None else torch.zeros(1,device=x.device)
+
+    # broadcast the output of the last layer
+    return PipelineFunction.bcastFromLast(comm,y,x.device,self.fwd_app.use_cuda)
+  # end sequentialForward
+
   def forward(self,x):
     # we are doing this to take adavtage of
     # pytorch's autograd which functions "naturally"
@@ -165,6 +361,13 @@ class LayerParallel(LPModule):
       self.fwd_app.evalNetwork()
       self.bwd_app.evalNetwork()
 
+      # inference skips the storage and weight communication of MGRIT when possible
+      if not torch.is_grad_enabled() and self.useSequentialInference():
+        return self.sequentialForward(x)
+
+    if self.execution_mode=='pipeline':
+      return PipelineFunction.apply(self.fwd_app,self.num_microbatches,x,*params)
+
     return BraidFunction.apply(self.fwd_app,self.bwd_app,x,*params) 
   # end forward
 
@@ -173,32 +376,513 @@ class LayerParallel(LPModule):
 
 
   # This method copies the layer parameters and can be used for verification
-  def buildSequentialOnRoot(self):
-    ode_layers    = [FixDTBlock(copy.deepcopy(l),self.dt) for l in self.layer_models]
-    remote_layers = ode_layers
+  def saveCheckpoint(self,directory,optimizer=None,extra=None,async_write=True):
+    """
+    Write a checkpoint of the layers to directory. Each processor writes the
+    state of its layers keyed by global layer index (and the optimizer state
+    of their parameters) to its own shard file, and the root writes a manifest.
+    So the checkpoint can be loaded on a different number of processors with
+    loadCheckpoint.
+
+    The state is copied to the host before returning, the files are written
+    in the background if async_write is True. Returns a CheckpointFuture, the
+    checkpoint is complete once its wait() method has returned on all processors
+    (saving the next checkpoint waits for the previous one). The files carry a
+    checkpoint id, and the manifest is only replaced after all the shards are
+    written, so the previous checkpoint in directory stays valid until then.
+
+    optimizer: Optimizer of the parameters on this processor. The state of
+               parameters that are not in the layers (e.g. the open and close
+               layers) is saved from the root processor.
+    extra: Anything else to save from the root processor (e.g. a scheduler
+           state dictionary), returned by loadCheckpoint
+    """
+    comm      = self.getMPIComm()
+    my_rank   = comm.Get_rank()
+    num_ranks = comm.Get_size()
+
+    # only one checkpoint is written at a time
+    if self.checkpoint_future is not None:
+      self.checkpoint_future.wait()
+      self.checkpoint_future = None
+
+    local = np.array([self.fwd_app.start_layer,len(self.layer_models)],dtype=np.int64)
+    ranges = np.zeros((num_ranks,2),dtype=np.int64) if my_rank==0 else None
+    comm.Gather(local,ranges,root=0)
+
+    checkpoint_id = comm.bcast(uuid.uuid4().hex if my_rank==0 else None,root=0)
+
+    # copy the state to the host
+    layer_params = set()
+    shard = {'checkpoint': checkpoint_id, 'layers': dict(), 'optimizer': dict()}
+    for i,layer in enumerate(self.layer_models):
+      index = self.fwd_app.start_layer+i
+      shard['layers'][index] = {k: self.hostCopy(v) for k,v in layer.state_dict().items()}
+      if optimizer is not None:
+        shard['optimizer'][index] = {n: {k: self.hostCopy(v) for k,v in optimizer.state[p].items()}
+                                     for n,p in layer.named_parameters() if p in optimizer.state}
+      layer_params.update([id(p) for p in layer.parameters()])
+
+    root = None
+    if my_rank==0:
+      root = {'checkpoint': checkpoint_id, 'extra': self.hostCopy(extra), 'param_groups': None, 'optimizer': dict()}
+      if optimizer is not None:
+        root['param_groups'] = [{k: self.hostCopy(v) for k,v in g.items() if k!='params'} for g in optimizer.param_groups]
+        others = [p for g in optimizer.param_groups for p in g['params'] if id(p) not in layer_params]
+        root['optimizer'] = {i: {k: self.hostCopy(v) for k,v in optimizer.state[p].items()}
+                             for i,p in enumerate(others) if p in optimizer.state}
+
+      manifest = {'format': 2,
+                  'checkpoint': checkpoint_id,
+                  'num_ranks': num_ranks,
+                  'num_layers': int(ranges[:,1].sum()),
+                  'optimizer': optimizer is not None,
+                  'root': f'root.{checkpoint_id}.pt',
+                  'shards': [{'file': f'shard.{checkpoint_id}.{r}.pt', 'start': int(start), 'count': int(count)}
+                             for r,(start,count) in enumerate(ranges)]}
+
+    def save(obj,filename):
+      # write to a temporary file first, so a partial file is never picked up
+      path = os.path.join(directory,filename)
+      torch.save(obj,path+'.tmp')
+      os.replace(path+'.tmp',path)
+
+    def write():
+      os.makedirs(directory,exist_ok=True)
+      save(shard,f'shard.{checkpoint_id}.{my_rank}.pt')
+      if my_rank==0:
+        save(root,f'root.{checkpoint_id}.pt')
+
+    def publish():
+      with open(os.path.join(directory,'manifest.json.tmp'),'w') as f:
+        json.dump(manifest,f,indent=2)
+      os.replace(os.path.join(directory,'manifest.json.tmp'),os.path.join(directory,'manifest.json'))
+
+      # remove the files of earlier checkpoints
+      for filename in os.listdir(directory):
+        match = re.fullmatch(r'(?:shard\.([0-9a-f]+)\.[0-9]+|root\.([0-9a-f]+))\.pt',filename)
+        if match is not None and checkpoint_id not in match.groups():
+          os.remove(os.path.join(directory,filename))
+
+    future = CheckpointFuture(comm,write,publish,async_write)
+    if async_write:
+      self.checkpoint_future = future
+    else:
+      future.wait()
+    return future
+  # end saveCheckpoint
+
+  def loadCheckpoint(self,directory,optimizer=None):
+    """
+    Load a checkpoint written by saveCheckpoint, possibly with a different
+    number of processors. Each processor reads the state of its layers from
+    the shards that hold them. Returns the extra data saved with the checkpoint.
+    """
+    with open(os.path.join(directory,'manifest.json')) as f:
+      manifest = json.load(f)
+    checkpoint_id = manifest['checkpoint']
+
+    layer_params = set()
+    shards = dict()
+    for i,layer in enumerate(self.layer_models):
+      index = self.fwd_app.start_layer+i
+      info = next((sh for sh in manifest['shards'] if sh['start']<=index<sh['start']+sh['count']),None)
+      if info is None:
+        raise RuntimeError(f'Layer {index} is not in the checkpoint \"{directory}\"')
+
+      if info['file'] not in shards:
+        shards[info['file']] = torch.load(os.path.join(directory,info['file']),map_location='cpu',mmap=True)
+        if shards[info['file']]['checkpoint']!=checkpoint_id:
+          raise RuntimeError(f'Shard "{info["file"]}" does not belong to the checkpoint in "{directory}"')
+      shard = shards[info['file']]
+
+      layer.load_state_dict(shard['layers'][index])
+      if optimizer is not None and manifest['optimizer']:
+        for n,p in layer.named_parameters():
+          if n in shard['optimizer'][index]:
+            optimizer.state[p] = self.optimizerState(shard['optimizer'][index][n],p)
+      layer_params.update([id(p) for p in layer.parameters()])
+    # end for layer
+
+    root = torch.load(os.path.join(directory,manifest['root']),map_location='cpu',weights_only=False)
+    if root['checkpoint']!=checkpoint_id:
+      raise RuntimeError(f'"{manifest["root"]}" does not belong to the checkpoint in "{directory}"')
+    if optimizer is not None and root['param_groups'] is not None:
+      if len(root['param_groups'])==len(optimizer.param_groups):
+        for g,saved in zip(optimizer.param_groups,root['param_groups']):
+          g.update(saved)
+
+      if self.getMPIComm().Get_rank()==0:
+        others = [p for g in optimizer.param_groups for p in g['params'] if id(p) not in layer_params]
+        for i,state in root['optimizer'].items():
+          optimizer.state[others[i]] = self.optimizerState(state,others[i])
+
+    return root['extra']
+  # end loadCheckpoint
+
+  @staticmethod
+  def hostCopy(obj):
+    """
+    Copy obj, with any tensors in it (possibly nested in dictionaries, lists
+    and tuples) copied to the host.
+    """
+    if isinstance(obj,torch.Tensor):
+      return obj.detach().to('cpu',copy=True)
+    if isinstance(obj,dict):
+      return {k: LayerParallel.hostCopy(v) for k,v in obj.items()}
+    if isinstance(obj,(list,tuple)):
+      return type(obj)([LayerParallel.hostCopy(v) for v in obj])
+    return copy.deepcopy(obj)
+
+  @staticmethod
+  def optimizerState(state,p):
+    """
+    Move a saved optimizer state to the device (and type) of parameter p, the
+    step counts are left as they are (like Optimizer.load_state_dict).
+    """
+    result = dict()
+    for k,v in state.items():
+      if isinstance(v,torch.Tensor):
+        # copy, so the state doesn't share memory with the checkpoint file
+        if k=='step':
+          v = v.clone()
+        else:
+          v = v.to(device=p.device,dtype=p.dtype if v.is_floating_point() else v.dtype,copy=True)
+      result[k] = v
+    return result
+
+  def repartition(self,new_comm,optimizer=None):
+    """
+    Move the layers onto the processors of new_comm without restarting, for
+    instance to continue on fewer processors. This is collective over the
+    current communicator, processors that are not in new_comm pass MPI.COMM_NULL.
+
+    new_comm must be made of processors of the current communicator, with
+    rank 0 remaining rank 0 (e.g. comm.Split(color,key=comm.Get_rank())).
+    As the layers are divided evenly, its size must divide the number of time
+    steps.
+
+    The apps are rebuilt on new_comm and the configuration set through this
+    module (setMaxIters, setCFactor, ...) is applied to them again. The state
+    of each layer is sent from its current owner to its new owner, along with
+    its optimizer state if optimizer is given. The parameters of the old
+    layers in optimizer are replaced by those of the new layers.
+
+    Returns True if this processor is in new_comm. Afterwards operators from
+    comp_op on ranks other than 0 must be created again, and calls made
+    directly on the apps (e.g. setTimerFile) repeated.
+    """
+    repartition_tag = 14
+    comm      = self.getMPIComm()
+    my_rank   = comm.Get_rank()
+    num_ranks = comm.Get_size()
+
+    member = new_comm!=MPI.COMM_NULL
+
+    # finish anything that uses the current layers or communicator
+    if self.checkpoint_future is not None:
+      self.checkpoint_future.wait()
+      self.checkpoint_future = None
+    for op in list(self.pending_comm.keys()):
+      self.startComm(op)
+
+    old_layers = self.layer_models
+    old_params = [p for l in old_layers for p in l.parameters()]
+    device = old_params[0].device if len(old_params)>0 else torch.device('cpu')
+
+    local = np.array([self.fwd_app.start_layer,len(old_layers),-1],dtype=np.int64)
+    if member:
+      local[2] = new_comm.Get_rank()
+    old_ranges = np.zeros((num_ranks,3),dtype=np.int64)
+    comm.Allgather(local,old_ranges)
+
+    new_ranks = old_ranges[:,2]
+    assert new_ranks[0]==0, 'Rank 0 must remain rank 0 when repartitioning'
+
+    if member:
+      app_device = self.fwd_app.device
+      self.buildApps(new_comm)
+      self.replayAppSettings()
+      if app_device is not None:
+        self.fwd_app.setDevice(app_device)
+        self.bwd_app.setDevice(app_device)
+
+      for l in self.layer_models:
+        l.to(device)
+      local = np.array([self.fwd_app.start_layer,len(self.layer_models)],dtype=np.int64)
+    else:
+      self.fwd_app = None
+      self.bwd_app = None
+      self.layer_models = []
+      self.local_layers = nn.Sequential()
+      local = np.array([-1,0],dtype=np.int64)
+
+    new_ranges = np.zeros((num_ranks,2),dtype=np.int64)
+    comm.Allgather(local,new_ranges)
+
+    def owner(index):
+      # the lowest ranked processor that had the layer
+      return next(r for r,(start,count,_) in enumerate(old_ranges) if start<=index<start+count)
+
+    # post the sends of the layers that are moving
+    requests = []
+    send_bufs = []
+    old_start = int(old_ranges[my_rank,0])
+    for rank,(start,count) in enumerate(new_ranges):
+      for index in range(start,start+count):
+        if owner(index)!=my_rank or rank==my_rank:
+          continue
+        layer = old_layers[index-old_start]
+        bufs = self.flattenState(layer)
+        if optimizer is not None:
+          desc,opt_bufs = self.flattenOptimizerState(layer,optimizer)
+          requests += [comm.isend(desc,dest=rank,tag=repartition_tag)]
+          bufs += opt_bufs
+        requests += [comm.Isend(buf,dest=rank,tag=repartition_tag) for buf in bufs]
+        send_bufs += [bufs]
+
+    # receive (or copy) the new layers
+    new_states = []
+    for i,layer in enumerate(self.layer_models):
+      index = self.fwd_app.start_layer+i
+      source = owner(index)
+      if source==my_rank:
+        old_layer = old_layers[index-old_start]
+        layer.load_state_dict(old_layer.state_dict())
+        if optimizer is not None:
+          for (n,p),old_p in zip(layer.named_parameters(),old_layer.parameters()):
+            if old_p in optimizer.state:
+              new_states += [(p,self.optimizerState(optimizer.state[old_p],p))]
+      else:
+        if optimizer is not None:
+          desc = comm.recv(source=source,tag=repartition_tag)
+        self.receiveState(layer,comm,source,repartition_tag)
+        if optimizer is not None:
+          new_states += self.receiveOptimizerState(layer,desc,comm,source,repartition_tag)
+    # end for layer
+
+    MPI.Request.Waitall(requests)
+
+    if optimizer is not None:
+      self.rebindOptimizer(optimizer,old_params,new_states)
+
+    self.comm = new_comm
+    self.exec_helper.my_rank = new_comm.Get_rank() if member else -1
+    self.host_bufs = dict()
+    self.comm_headers = dict()
+
+    return member
+  # end repartition
+
+  def flattenOptimizerState(self,layer,optimizer):
+    """
+    Get the optimizer state of the parameters of a layer as a description
+    (to be pickled), and flat host buffers (one per type) with the tensors.
+    """
+    desc = dict()
+    groups = dict()
+    for n,p in layer.named_parameters():
+      if p not in optimizer.state:
+        continue
+      desc[n] = dict()
+      for k,v in optimizer.state[p].items():
+        if isinstance(v,torch.Tensor):
+          desc[n][k] = ('tensor',v.shape,v.dtype)
+          groups.setdefault(v.dtype,[]).append(v.detach().reshape(-1).cpu())
+        else:
+          desc[n][k] = ('value',v)
+    return desc,[torch.cat(g) for g in groups.values()]
+
+  def receiveOptimizerState(self,layer,desc,comm,source,tag):
+    """
+    Receive the optimizer state sent by flattenOptimizerState, returns a list
+    of (parameter, state) pairs.
+    """
+    sizes = dict()
+    for entry in desc.values():
+      for kind,*info in entry.values():
+        if kind=='tensor':
+          sizes[info[1]] = sizes.get(info[1],0)+info[0].numel()
+
+    offsets = dict()
+    for dtype,n in sizes.items():
+      buf = torch.empty(n,dtype=dtype)
+      comm.Recv(buf,source=source,tag=tag)
+      offsets[dtype] = [buf,0]
+
+    params = dict(layer.named_parameters())
+    result = []
+    for n,entry in desc.items():
+      state = dict()
+      for k,(kind,*info) in entry.items():
+        if kind=='tensor':
+          shape,dtype = info
+          buf,offset = offsets[dtype]
+          state[k] = buf[offset:offset+shape.numel()].view(shape)
+          offsets[dtype][1] = offset+shape.numel()
+        else:
+          state[k] = info[0]
+      result += [(params[n],self.optimizerState(state,params[n]))]
+    return result
+
+  def rebindOptimizer(self,optimizer,old_params,new_states):
+    """
+    Replace the parameters of the old layers in optimizer by the parameters
+    of the current layers (in the group that held the old ones), and set the
+    state of the new parameters.
+    """
+    old_ids = set([id(p) for p in old_params])
+
+    target = None
+    for g in optimizer.param_groups:
+      kept = [p for p in g['params'] if id(p) not in old_ids]
+      if target is None and len(kept)<len(g['params']):
+        target = g
+      g['params'] = kept
+    if target is None:
+      target = optimizer.param_groups[0]
+    target['params'] += [p for l in self.layer_models for p in l.parameters()]
+
+    for p in old_params:
+      optimizer.state.pop(p,None)
+    for p,state in new_states:
+      optimizer.state[p] = state
+
+  def buildSequentialOnRoot(self,filename=None):
+    """
+    Build the serial network (an nn.Sequential of all the layers) on the root
+    processor, returns None on the other processors.
+
+    The skeleton of each layer is built on the meta device on the root, and
+    the values are streamed into it one layer at a time: each processor sends
+    a flat buffer per type for each of its layers. The serial network is on
+    the device of the layers of the root processor.
+
+    If filename is given, the layers are written to that file one at a time
+    instead (so the root never holds more than one layer) and None is returned
+    everywhere. Use readSequentialFile to get the state dictionary of the serial
+    network.
+    """
     build_seq_tag = 12         # this 
     comm          = self.getMPIComm()
     my_rank       = self.getMPIComm().Get_rank()
     num_ranks     = self.getMPIComm().Get_size()
 
-    # short circuit for serial case
-    if num_ranks==1:
-      return nn.Sequential(*remote_layers)
+    # the local layers of each processor, as (start layer, count)
+    local = np.array([self.fwd_app.start_layer,len(self.layer_models)],dtype=np.int64)
+    ranges = np.zeros((num_ranks,2),dtype=np.int64) if my_rank==0 else None
+    comm.Gather(local,ranges,root=0)
 
-    if my_rank==0:
-      for i in range(1,self.getMPIComm().Get_size()):
-        remote_layers += comm.recv(source=i,tag=build_seq_tag)
-      remote_layers = nn.Sequential(*remote_layers)
+    if my_rank!=0:
+      for l in self.layer_models:
+        for buf in self.flattenState(l):
+          comm.Send(buf,dest=0,tag=build_seq_tag)
+      return None
 
-      if hasattr(self,'device'):
-        return remote_layers.to(self.device)
-      else:
-        return remote_layers
-    else:
-      ode_layers_cpu = [o.cpu() for o in ode_layers]
-      comm.send(ode_layers_cpu,dest=0,tag=build_seq_tag)
+    params = [p for l in self.layer_models for p in l.parameters()]
+    device = params[0].device if len(params)>0 else torch.device('cpu')
+
+    out = None
+    if filename is not None:
+      out = open(filename,'wb')
+      torch.save({'num_layers': int(ranges[:,1].sum()), 'dt': self.dt},out,_use_new_zipfile_serialization=False)
+
+    layers = []
+    for rank,(start,count) in enumerate(ranges):
+      for i in range(count):
+        layer = self.buildSkeleton(int(start)+i,device)
+
+        if rank==0:
+          layer.layer.load_state_dict(self.layer_models[i].state_dict())
+        else:
+          self.receiveState(layer,comm,rank,build_seq_tag)
+
+        if out is not None:
+          torch.save(layer.state_dict(),out,_use_new_zipfile_serialization=False)
+        else:
+          layers += [layer]
+      # end for i
+    # end for rank
+
+    if out is not None:
+      out.close()
       return None
+
+    return nn.Sequential(*layers)
   # end buildSequentialOnRoot
 
+  @staticmethod
+  def readSequentialFile(filename):
+    """
+    Read a file written by buildSequentialOnRoot, and return the state
+    dictionary of the serial network.
+    """
+    state = dict()
+    with open(filename,'rb') as f:
+      header = torch.load(f)
+      for i in range(header['num_layers']):
+        for k,v in torch.load(f).items():
+          state[f'{i}.{k}'] = v
+    return state
+
+  def buildSkeleton(self,i,device):
+    """
+    Build the serial layer for global layer i on device, with uninitialized
+    state. The layer is constructed on the meta device (no memory, no
+    initialization) unless that fails, or it has state that is not in the
+    state dictionary.
+    """
+    try:
+      with torch.device('meta'):
+        layer = FixDTBlock(self.fwd_app.buildLayerBlock(i,device='meta'),self.dt)
+      state = layer.state_dict()
+      if all([n in state for n,_ in layer.named_buffers()]):
+        return layer.to_empty(device=device)
+    except (NotImplementedError,RuntimeError):
+      pass
+    return FixDTBlock(self.fwd_app.buildLayerBlock(i,device=device),self.dt)
+
+  def stateGroups(self,layer):
+    """
+    Group the state of a layer by type, returns a list of lists of tensors.
+    """
+    groups = dict()
+    for t in layer.state_dict().values():
+      groups.setdefault(t.dtype,[]).append(t)
+    return list(groups.values())
+
+  def flattenState(self,layer):
+    """
+    Get the state of a layer as flat buffers (one per type) for communication.
+    """
+    bufs = []
+    for group in self.stateGroups(layer):
+      buf = torch.cat([t.detach().reshape(-1) for t in group])
+      if buf.device.type!='cpu' and not self.gpu_aware_mpi:
+        buf = buf.cpu()
+      elif buf.device.type!='cpu':
+        torch.cuda.synchronize()
+      bufs += [buf]
+    return bufs
+
+  def receiveState(self,layer,comm,source,tag):
+    """
+    Receive the state of a layer sent by flattenState.
+    """
+    for group in self.stateGroups(layer):
+      device = group[0].device
+      n = sum([t.numel() for t in group])
+      if device.type=='cpu' or self.gpu_aware_mpi:
+        buf = torch.empty(n,dtype=group[0].dtype,device=device)
+      else:
+        buf = torch.empty(n,dtype=group[0].dtype)
+      comm.Recv(buf,source=source,tag=tag)
+
+      offset = 0
+      with torch.no_grad():
+        for t in group:
+          t.copy_(buf[offset:offset+t.numel()].view_as(t))
+          offset += t.numel()
+
 
 # end LayerParallel
@@ -34,12 +34,56 @@ import inspect
 import torch
 import torch.nn as nn
 
+import numpy as np
+
 from mpi4py import MPI
 
 import copy
 
 from torchbraid.braid_function import BraidFunction
 from torchbraid.utils import ContextTimerManager
+import torchbraid.utils
+
+class CommFuture:
+  """
+  Result of a non-blocking communication, wait() completes the communication
+  and returns the result.
+  """
+
+  def __init__(self,requests,result,buffers=()):
+    self.requests = requests
+    self.result = result
+    self.buffers = buffers # kept alive until the communication completes
+    self.value = None
+    self.done = False
+
+  def wait(self):
+    if not self.done:
+      MPI.Request.Waitall(self.requests)
+      self.value = self.result()
+      self.buffers = ()
+      self.done = True
+    return self.value
+# end CommFuture
+
+class PlaceholderFunction(torch.autograd.Function):
+  """
+  The result of a composite operator away from its execution rank: a one
+  element zero connected to the inputs. Nothing is computed, and the backward
+  returns no gradients (so the operations producing the inputs see a None
+  output gradient).
+  """
+
+  @staticmethod
+  def forward(ctx, device, *tensors):
+    ctx.set_materialize_grads(False)
+    ctx.num_tensors = len(tensors)
+    return torch.zeros(1,device=device)
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    return (None,)*(ctx.num_tensors+1)
+# end PlaceholderFunction
 
 class LPModule(nn.Module):
   """
@@ -58,45 +102,36 @@ class LPModule(nn.Module):
     signifying object composition.
     """
 
-    def __init__(self,rank):
-      """Constructor setting the LP rank of this processor"""
+    def __init__(self,rank,exec_rank=0):
+      """Constructor setting the LP rank of this processor, and the rank the operators are executed on"""
       self.my_rank = rank
+      self.exec_rank = exec_rank
 
     def __call__(self,op,*args,**kwargs):
-      """Call an operator conditionally based on being on rank 0
+      """Call an operator conditionally based on being on the execution rank (rank 0 by default)
 
          If op is a class, than this returns None on processors other
-         than rank 0.
+         than the execution rank.
       """
 
-      if self.my_rank==0:
+      if self.my_rank==self.exec_rank:
         return op(*args,**kwargs)
 
       # this helps with making constructors consistent
       if inspect.isclass(op):
         return None
 
-      # determine the parallel device
-      device = None
-      for a in args:
-        if hasattr(a,'device'):
-          device = a.device
-          break
-      # take the first device
-
-
-      # blindly assume that all the arguments are torch
-      # tensors, and propagate this through
-      value = torch.zeros(1,device=device)
-      for a in args:
-        if a.requires_grad:
-          value += torch.norm(a)
+      # the result is a placeholder attached to the tensor arguments, so the
+      # backward still reaches the layer parallel operations that produced them
+      tensors = [a for a in args if torch.is_tensor(a)]
+      device = tensors[0].device if len(tensors)>0 else None
+      value = PlaceholderFunction.apply(device,*tensors)
 
       # so this is all a hack to get this thing to work
       if 'mgopt_term' in kwargs:
-        return torch.zeros(1,device=device)*value - kwargs['mgopt_term']
+        return value - kwargs['mgopt_term']
       else:
-        return torch.zeros(1,device=device)*value
+        return value
 
   def __init__(self, comm):
     super().__init__()
@@ -106,11 +141,33 @@ class LPModule(nn.Module):
 
     self.enable_diagnostics = False
 
-  def comp_op(self):
+    # app configuration, replayed if the apps are rebuilt
+    self.app_settings = dict()
+
+    # communication buffers for getFinalOnRoot and copyVectorFromRoot
+    self.gpu_aware_mpi = False
+    self.host_bufs = dict()
+    self.pending_comm = dict()
+
+    # shape headers of the last getFinalOnRoot and copyVectorFromRoot
+    self.comm_headers = dict()
+
+  def comp_op(self,rank=0):
     """Short for compose operator, returns a functor that allows contstruction of composite neural 
        networks using this LayerParallel module.
+
+       The operators are executed on rank (a negative value counts from the last rank). For
+       instance, when the close layer lives on the last rank (see setCloseOnLastRank):
+
+         o      = parallel_nn.comp_op()        # open layer on rank 0
+         o_last = parallel_nn.comp_op(rank=-1) # close layer and loss on the last rank
     """
-    return self.exec_helper
+    if rank<0:
+      rank += self.comm.Get_size()
+
+    if rank==0:
+      return self.exec_helper
+    return self.ExecLP(self.comm.Get_rank(),rank)
 
   def extra_repr(self):
     return f'parallel rank = {self.getMPIComm().Get_rank()} of {self.getMPIComm().Get_size()}'
@@ -140,6 +197,32 @@ class LPModule(nn.Module):
     """
     return self.timer_manager
 
+  def configureApps(self,which,method,*args,**kwargs):
+    """
+    Call method on the forward app ('fwd'), the backward app ('bwd') or
+    both ('both'). The call is recorded so that it can be replayed when
+    the apps are rebuilt (see LayerParallel.repartition), a later call of
+    the same method (on the same level) replaces the earlier one.
+    """
+    key = (which,method,kwargs.get('level'),kwargs.get('tb_print'),args[0] if method=='__setattr__' else None)
+    self.app_settings.pop(key,None)
+    self.app_settings[key] = (args,kwargs)
+
+    self.applyAppSetting(which,method,args,kwargs)
+
+  def applyAppSetting(self,which,method,args,kwargs):
+    if which in ['fwd','both']:
+      getattr(self.fwd_app,method)(*args,**kwargs)
+    if which in ['bwd','both']:
+      getattr(self.bwd_app,method)(*args,**kwargs)
+
+  def replayAppSettings(self):
+    """
+    Apply the recorded configuration to the (rebuilt) apps.
+    """
+    for (which,method,_,_,_),(args,kwargs) in self.app_settings.items():
+      self.applyAppSetting(which,method,args,kwargs)
+
   def setPrintLevel(self,print_level,tb_print=False):
     """
     Set the print level for this module. If tb_print (torchbraid print) is
@@ -147,28 +230,25 @@ class LPModule(nn.Module):
     false, the print level is passed along to xbraid.
     """
 
-    self.fwd_app.setPrintLevel(print_level,tb_print)
-    self.bwd_app.setPrintLevel(print_level,tb_print)
+    self.configureApps('both','setPrintLevel',print_level,tb_print=tb_print)
 
   def setFwdNumRelax(self,relax,level=-1):
-    self.fwd_app.setNumRelax(relax,level=level)
+    self.configureApps('fwd','setNumRelax',relax,level=level)
 
   def setBwdNumRelax(self,relax,level=-1):
-    self.bwd_app.setNumRelax(relax,level=level)
+    self.configureApps('bwd','setNumRelax',relax,level=level)
 
   def setNumRelax(self,max_iters,level=-1):
-    self.fwd_app.setNumRelax(max_iters,level)
-    self.bwd_app.setNumRelax(max_iters,level)
+    self.configureApps('both','setNumRelax',max_iters,level=level)
 
   def setMaxIters(self,max_iters):
-    self.fwd_app.setMaxIters(max_iters)
-    self.bwd_app.setMaxIters(max_iters)
+    self.configureApps('both','setMaxIters',max_iters)
 
   def setFwdMaxIters(self,max_iters):
-    self.fwd_app.setMaxIters(max_iters)
+    self.configureApps('fwd','setMaxIters',max_iters)
 
   def setBwdMaxIters(self,max_iters):
-    self.bwd_app.setMaxIters(max_iters)
+    self.configureApps('bwd','setMaxIters',max_iters)
 
   def getFwdMaxIters(self):
     return self.fwd_app.getMaxIters()
@@ -177,18 +257,34 @@ class LPModule(nn.Module):
     return self.bwd_app.getMaxIters()
 
   def setCFactor(self,cfactor):
-    self.fwd_app.setCFactor(cfactor)
-    self.bwd_app.setCFactor(cfactor)
+    self.configureApps('both','setCFactor',cfactor)
 
   def setFwdCFactor(self,cfactor):
-    self.fwd_app.setCFactor(cfactor)
+    self.configureApps('fwd','setCFactor',cfactor)
 
   def setBwdCFactor(self,cfactor):
-    self.bwd_app.setCFactor(cfactor)
+    self.configureApps('bwd','setCFactor',cfactor)
+
+  def setAutocast(self,dtype,level=-1):
+    """
+    Evaluate the forward and adjoint steps on a level under torch.autocast
+    with dtype (e.g. torch.bfloat16). The parameters remain the fp32 master
+    copies, so the gradients are accumulated in fp32. A level of -1 sets
+    all levels, and a dtype of None disables autocast. For instance,
+
+      m.setAutocast(torch.bfloat16)      # all levels in bf16
+      m.setAutocast(None,level=0)        # ...except the fine grid
+    """
+    self.configureApps('both','setAutocast',dtype,level=level)
+
+  def setFwdAutocast(self,dtype,level=-1):
+    self.configureApps('fwd','setAutocast',dtype,level=level)
+
+  def setBwdAutocast(self,dtype,level=-1):
+    self.configureApps('bwd','setAutocast',dtype,level=level)
 
   def setSkipDowncycle(self,skip):
-    self.fwd_app.setSkipDowncycle(skip)
-    self.bwd_app.setSkipDowncycle(skip)
+    self.configureApps('both','setSkipDowncycle',skip)
 
   def getMPIComm(self):
     return self.fwd_app.getMPIComm()
@@ -201,7 +297,115 @@ class LPModule(nn.Module):
     itr, res = self.bwd_app.getBraidStats()
     return itr,res
 
-  def getFinalOnRoot(self,vec):
+  def copyScalarFromRank(self,value,rank=-1):
+    """
+    Copy a scalar (a python number or a one element tensor, such as the
+    loss) from rank to all processors. A negative rank counts from the last
+    rank. The value is returned as a python float.
+    """
+    comm = self.fwd_app.getCommBackend()
+    if rank<0:
+      rank += comm.getSize()
+
+    # a one element (host) buffer, instead of a pickled object
+    buf = torch.zeros(1,dtype=torch.float64)
+    if comm.getRank()==rank:
+      buf[0] = value.item() if hasattr(value,'item') else value
+    comm.bcast(buf,root=rank)
+
+    return buf.item()
+
+  def setCommBackend(self,backend):
+    """
+    Set the backend used by the forward and backward propagation to
+    communicate tensors, e.g. a TorchDistBackend to use torch.distributed
+    (see torchbraid.utils.comm_backend). None restores MPI on the
+    communicator of this module. The braid messages always use MPI.
+
+    The backend must rank the processors as the communicator does. It is not
+    carried over by LayerParallel.repartition.
+    """
+    if backend is not None:
+      assert backend.getRank()==self.comm.Get_rank() and backend.getSize()==self.comm.Get_size()
+    self.fwd_app.setCommBackend(backend)
+    self.bwd_app.setCommBackend(backend)
+
+  def setGPUAwareMPI(self,enable=True):
+    """
+    Set if MPI can communicate device (GPU) memory. If so getFinalOnRoot and
+    copyVectorFromRoot communicate device tensors directly, otherwise they are
+    staged through reused host buffers. The same holds for the default
+    communication backend of the apps (see getCommBackend) and the spline
+    gradient reductions of a SpliNet.
+    """
+    self.gpu_aware_mpi = enable
+    self.configureApps('both','__setattr__','gpu_aware_mpi',enable)
+
+  def sendBuffer(self,op,vec):
+    """
+    Get a tensor with the values of vec that can be handed to MPI.
+    """
+    vec = vec.detach().contiguous()
+    if vec.device.type=='cpu':
+      return vec
+    if self.gpu_aware_mpi:
+      torch.cuda.synchronize()
+      return vec
+    buf = self.hostBuffer(op,vec.shape,vec.dtype)
+    buf.copy_(vec)
+    return buf
+
+  def recvBuffer(self,op,shape,dtype,device):
+    """
+    Get a tensor to receive a tensor on device, this is a host buffer
+    unless the device is the host or MPI is GPU aware.
+    """
+    if device.type=='cpu' or self.gpu_aware_mpi:
+      return torch.empty(shape,dtype=dtype,device=device)
+    return self.hostBuffer(op,shape,dtype)
+
+  def hostBuffer(self,op,shape,dtype):
+    """
+    Get the host staging buffer for the operation op, this is reused until
+    the shape or type changes.
+    """
+    buf = self.host_bufs.get(op)
+    if buf is None or buf.shape!=shape or buf.dtype!=dtype:
+      buf = torch.empty(shape,dtype=dtype,pin_memory=torch.cuda.is_available())
+      self.host_bufs[op] = buf
+    return buf
+
+  def startComm(self,op):
+    # a previous non-blocking call must finish before its buffers are reused
+    future = self.pending_comm.pop(op,None)
+    if future is not None:
+      future.wait()
+
+  def updateCommHeader(self,op,header):
+    """
+    Record the shape header (see torchbraid.utils.encode_shapes) exchanged by
+    the operation op. All the processors taking part in op keep the same
+    header, so the next exchange can post the data with the cached shape
+    without waiting for the header. Returns True if the header changed.
+    """
+    cached = self.comm_headers.get(op)
+    if cached is not None and np.array_equal(cached[0],header):
+      return False
+
+    shapes,dtype = torchbraid.utils.decode_shapes(header)
+    self.comm_headers[op] = (header.copy(),shapes[0],dtype)
+    return True
+
+  def getFinalOnRoot(self,vec,async_op=False):
+    """
+    Copy vec from the last processor to the root processor. This returns the
+    copy on the root processor (on the device of vec), and None elsewhere.
+
+    If async_op is True this returns a CommFuture, whose wait() method
+    returns the copy. The shape header is not waited on before the data is
+    posted, the data is received with the shape of the previous call, and
+    only if the shape changed it is sent again when the root waits.
+    """
     build_seq_tag = 99        # this
     comm          = self.getMPIComm()
     my_rank       = self.getMPIComm().Get_rank()
@@ -209,39 +413,115 @@ class LPModule(nn.Module):
 
     # short circuit for serial case
     if num_ranks==1:
-      return vec
+      return CommFuture([],lambda: vec) if async_op else vec
+
+    self.startComm('final')
+    cached = self.comm_headers.get('final')
 
-    # send the output of the last layer to the root
+    # send the output of the last layer to the root, the shape and type first
     if my_rank==0:
-      remote_final = comm.recv(source=num_ranks-1,tag=build_seq_tag)
-      remote_final = remote_final.to(vec.device)
-      return remote_final
+      device = vec.device
+      header = torchbraid.utils.empty_shape_buffer()
+      requests = [comm.Irecv(header,source=num_ranks-1,tag=build_seq_tag)]
+
+      buf = None
+      if cached is not None:
+        buf = self.recvBuffer('final',cached[1],cached[2],device)
+        requests += [comm.Irecv(buf,source=num_ranks-1,tag=build_seq_tag)]
+
+      def result():
+        final = buf
+        if self.updateCommHeader('final',header):
+          _,shape,dtype = self.comm_headers['final']
+          final = self.recvBuffer('final',shape,dtype,device)
+          comm.Recv(final,source=num_ranks-1,tag=build_seq_tag)
+        return final.to(device)
+
+      future = CommFuture(requests,result,(header,buf))
     elif my_rank==num_ranks-1:
-      final = vec
-      comm.send(final.cpu(),dest=0,tag=build_seq_tag)
+      buf = self.sendBuffer('final',vec)
+      header = torchbraid.utils.encode_shapes(buf.shape,buf.dtype)
+      changed = self.updateCommHeader('final',header)
+
+      requests = [comm.Isend(header,dest=0,tag=build_seq_tag)]
+      buffers = [header,buf]
+      if cached is not None:
+        # the root expects the previous shape, if it changed fill that in first
+        first = buf if not changed else torch.empty(cached[1],dtype=cached[2])
+        requests += [comm.Isend(first,dest=0,tag=build_seq_tag)]
+        buffers += [first]
+      if changed:
+        requests += [comm.Isend(buf,dest=0,tag=build_seq_tag)]
+
+      future = CommFuture(requests,lambda: None,tuple(buffers))
+    else:
+      return CommFuture([],lambda: None) if async_op else None
 
-    return None
+    if async_op:
+      self.pending_comm['final'] = future
+      return future
+    return future.wait()
 
-  def copyVectorFromRoot(self,vec):
-    build_seq_tag = 99        # this
+  def copyVectorFromRoot(self,vec,async_op=False):
+    """
+    Copy vec from the root processor to all processors. On the other processors
+    vec is only used for its device (if it has one, otherwise the copy is on
+    the host).
+
+    If async_op is True this returns a CommFuture, whose wait() method
+    returns the copy. The shape header is not waited on before the data is
+    broadcast, the data is broadcast with the shape of the previous call, and
+    only if the shape changed it is broadcast again when waiting (so wait()
+    must be called at the same point on all processors, as a collective).
+    """
     comm          = self.getMPIComm()
     my_rank       = self.getMPIComm().Get_rank()
     num_ranks     = self.getMPIComm().Get_size()
 
     # short circuit for serial case
     if num_ranks==1:
-      return vec
+      return CommFuture([],lambda: vec) if async_op else vec
+
+    self.startComm('copy')
+    cached = self.comm_headers.get('copy')
+    device = vec.device if hasattr(vec,'device') else torch.device('cpu')
 
-    # send the output of the last layer to the root
+    # broadcast the shape and type with the data
     if my_rank==0:
-      for dest in range(1,num_ranks):
-        comm.send(vec.cpu(),dest,tag=build_seq_tag)
-      return vec
+      send = self.sendBuffer('copy',vec)
+      header = torchbraid.utils.encode_shapes(vec.shape,vec.dtype)
+      changed = self.updateCommHeader('copy',header)
     else:
-      result = comm.recv(source=0,tag=build_seq_tag)
-      if hasattr(vec,'device'):
-        result = result.to(vec.device)
-      return result
+      header = torchbraid.utils.empty_shape_buffer()
+    requests = [comm.Ibcast(header,root=0)]
+
+    buf = None
+    if cached is not None:
+      if my_rank==0:
+        # the others expect the previous shape, if it changed fill that in first
+        buf = send if not changed else torch.empty(cached[1],dtype=cached[2])
+      else:
+        buf = self.recvBuffer('copy',cached[1],cached[2],device)
+      requests += [comm.Ibcast(buf,root=0)]
+
+    def result():
+      if my_rank==0:
+        if changed:
+          comm.Bcast(send,root=0)
+        return vec
+
+      copy = buf
+      if self.updateCommHeader('copy',header):
+        _,shape,dtype = self.comm_headers['copy']
+        copy = self.recvBuffer('copy',shape,dtype,device)
+        comm.Bcast(copy,root=0)
+      return copy.to(device)
+
+    future = CommFuture(requests,result,(header,buf))
+    if async_op:
+      self.pending_comm['copy'] = future
+      return future
+    return future.wait()
 
   def getTimersString(self):
     """
@@ -278,8 +558,7 @@ class LPModule(nn.Module):
 
     self.enable_diagnostics = enable
 
-    self.fwd_app.diagnostics(enable)
-    self.bwd_app.diagnostics(enable)
+    self.configureApps('both','diagnostics',enable)
 
   def getDiagnostics(self):
     """
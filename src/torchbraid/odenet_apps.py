@@ -107,6 +107,14 @@ class ForwardODENetApp(BraidApp):
 
       self.splinebasis = BsplineBasis(nsplines, splinedegree, Tf)
       spline_dknots = Tf / (nsplines - splinedegree) # spacing of spline knots
+
+      # The spline coefficients at every fine time index (this includes all
+      # the coarse grid times), and the assembled layer weights per time index.
+      # The weights are rebuilt when the parameters change.
+      splines, ks = self.splinebasis.eval_many([i*self.dt for i in range(self.num_steps+1)])
+      self.spline_table = [(list(c),int(k)) for c,k in zip(splines,ks)]
+      self.spline_weights = dict()
+      self.spline_weights_version = None
       if comm.Get_rank() == 0: # First processor's time-interval includes t0_local=0.0. Others exclude t0_local, owning only (t0_local, tf_local]!
         self.start_layer = int( (self.t0_local ) / spline_dknots )
       else:
@@ -132,6 +140,16 @@ class ForwardODENetApp(BraidApp):
     self.timer_manager = timer_manager
     self.use_deriv = False
 
+    # cache of compiled steps, disabled by default
+    self.compile_cache = None
+
+    # copy the output of the network to all processors, otherwise
+    # it is only available on the last processor
+    self.bcast_output = True
+
+    # shapes of the states, keyed by the encoded input shape and the device
+    self.shape_cache = dict()
+
     self.parameter_shapes = []
     for layer_constr in self.layer_blocks[1]:
       # build the layer on the proper device
@@ -180,15 +198,30 @@ class ForwardODENetApp(BraidApp):
   def buildShapes(self,x):
     """Do a dry run to determine all the shapes that need to be built."""
     shapes = [x.shape]
-    for layer_constr in self.layer_blocks[1]:
-      # build the layer on the proper device
-      layer = layer_constr().to(self.device) 
-       
-      x = layer(x)
-      shapes += [x.shape]
+    with torch.no_grad():
+      for layer_constr in self.layer_blocks[1]:
+        # build the layer on the proper device
+        layer = layer_constr().to(self.device) 
+         
+        x = layer(x)
+        shapes += [x.shape]
 
     return shapes
 
+  def getCachedShapes(self,shape_buf,device):
+    """
+    Get the shapes of the states for an input described by shape_buf (see
+    torchbraid.utils.encode_shapes). The dry run of buildShapes is only
+    done the first time an input shape, type and device is seen.
+    """
+    key = (shape_buf.tobytes(),str(device))
+    if key not in self.shape_cache:
+      shapes,dtype = torchbraid.utils.decode_shapes(shape_buf)
+      x = torch.zeros(shapes[0],dtype=dtype,device=device)
+      self.shape_cache[key] = self.buildShapes(x)
+
+    return self.shape_cache[key]
+
   def buildLayerBlocks(self,layers):
     # this block of code prepares the data for easy sorting
     [counts,layer_blocks] = list(zip(*layers))
@@ -197,9 +230,10 @@ class ForwardODENetApp(BraidApp):
     num_steps = layer_indices[-1]
     return (layer_indices,layer_blocks,counts),num_steps
 
-  def buildLayerBlock(self,i):
+  def buildLayerBlock(self,i,device=None):
     """
     This function returns a block (e.g. a lambda that constructs the layer).
+    The block is moved to device (by default the device of the app).
     """
     ind = bisect_right(self.layer_blocks[0],i)
     layer = self.layer_blocks[1][ind]()
@@ -209,7 +243,32 @@ class ForwardODENetApp(BraidApp):
     else:
       layer = self.ODEBlock(layer)
 
-    return layer.to(self.device)
+    return layer.to(self.device if device is None else device)
+
+  def setCompile(self,enable,max_shapes=1,**compile_kwargs):
+    """
+    Turn on (or off) torch.compile of the step evaluations. The keyword
+    arguments are passed to torch.compile.
+    """
+    if enable:
+      self.compile_cache = torchbraid.utils.StepCompileCache(max_shapes,**compile_kwargs)
+    else:
+      self.compile_cache = None
+
+  def getCompileStats(self):
+    if self.compile_cache is None:
+      return dict()
+    return self.compile_cache.getStats()
+
+  def stepLayer(self,layer,t,dt,x,level):
+    """
+    Evaluate the step starting at time t, using the compile cache if enabled.
+    """
+    if self.compile_cache is None:
+      return layer(dt,x)
+
+    block = bisect_right(self.layer_blocks[0],self.getGlobalTimeIndex(t))
+    return self.compile_cache(block,layer,level,dt,x)
 
   def getTempLayer(self,t):
     """
@@ -246,24 +305,11 @@ class ForwardODENetApp(BraidApp):
   def setVectorWeights(self,t,x):
 
     if self.splinet: 
-      # Evaluate the splines at time t and get interval k such that t \in [\tau_k, \tau_k+1] for splineknots \tau
-      with torch.no_grad():
-        splines, k = self.splinebasis.eval(t)
-        # Add up sum over p+1 non-zero splines(t) times weights coeffients, l=0,\dots,p
-        l = 0 # first one here, because I didn't know how to set the shape of 'weights' correctly...
-        layermodel_localID = k + l - self.start_layer
-        assert layermodel_localID >= 0 and layermodel_localID < len(self.layer_models)
-        layer = self.layer_models[layermodel_localID]
-        weights = [splines[l] * p.data for p in layer.parameters()] # l=0
-        # others: l=1,dots, p
-        for l in range(1,len(splines)):
-          layermodel_localID = k + l - self.start_layer
-          if t== self.Tf and l==len(splines)-1: # There is one more spline at Tf, which is zero at Tf and therefore it is not stored. Skip. 
-            continue
-          assert layermodel_localID >= 0 and layermodel_localID < len(self.layer_models)
-          layer = self.layer_models[layermodel_localID]
-          for dest_w, src_p in zip(weights, list(layer.parameters())):  
-              dest_w.add_(src_p.data, alpha=splines[l])
+      # the weights are assembled once per time index (until the parameters change)
+      tidx = self.getGlobalTimeIndex(t)
+      if tidx not in self.spline_weights:
+        self.spline_weights[tidx] = self.assembleSplineWeights(tidx)
+      weights = self.spline_weights[tidx]
 
     else: 
       layer_index = self.getGlobalTimeIndex(t) - self.start_layer
@@ -282,6 +328,50 @@ class ForwardODENetApp(BraidApp):
     x.addWeightTensors(weights)
   # end setVectorWeights
 
+  def getSplineCoefficients(self,t):
+    """
+    Get the values of the d+1 non-zero splines at time t, and the interval k
+    such that t \in [tau_k, \tau_k+1] for spline knots \tau. These come from
+    a table computed at construction.
+    """
+    return self.spline_table[self.getGlobalTimeIndex(t)]
+
+  def assembleSplineWeights(self,tidx):
+    """
+    Compute the layer weights at a time index as the sum over the d+1 non-zero
+    splines times the weight coefficients.
+    """
+    with torch.no_grad():
+      splines, k = self.spline_table[tidx]
+      # Add up sum over p+1 non-zero splines(t) times weights coeffients, l=0,\dots,p
+      l = 0 # first one here, because I didn't know how to set the shape of 'weights' correctly...
+      layermodel_localID = k + l - self.start_layer
+      assert layermodel_localID >= 0 and layermodel_localID < len(self.layer_models)
+      layer = self.layer_models[layermodel_localID]
+      weights = [splines[l] * p.data for p in layer.parameters()] # l=0
+      # others: l=1,dots, p
+      for l in range(1,len(splines)):
+        layermodel_localID = k + l - self.start_layer
+        if tidx==self.num_steps and l==len(splines)-1: # There is one more spline at Tf, which is zero at Tf and therefore it is not stored. Skip. 
+          continue
+        assert layermodel_localID >= 0 and layermodel_localID < len(self.layer_models)
+        layer = self.layer_models[layermodel_localID]
+        for dest_w, src_p in zip(weights, list(layer.parameters())):  
+            dest_w.add_(src_p.data, alpha=splines[l])
+
+    return weights
+
+  def checkSplineWeights(self):
+    """
+    Clear the assembled spline weights if any of the parameters changed
+    since they were built (e.g. by an optimizer step), this uses the version
+    counter of the parameters.
+    """
+    version = tuple((p._version,p.data_ptr()) for l in self.layer_models for p in l.parameters())
+    if version!=self.spline_weights_version:
+      self.spline_weights = dict()
+      self.spline_weights_version = version
+
   def setLayerWeights(self,t,tf,level,weights):
     layer = self.getTempLayer(t)
 
@@ -303,6 +393,9 @@ class ForwardODENetApp(BraidApp):
   def run(self,x):
     # turn on derivative path (as requried)
     self.use_deriv = self.training
+
+    if self.splinet:
+      self.checkSplineWeights()
     
     # instead of doing runBraid, can execute tests
     #self.testBraid(x)
@@ -322,6 +415,85 @@ class ForwardODENetApp(BraidApp):
       return None
   # end forward
 
+  def runSequential(self,x):
+    """
+    Exact forward propagation without MGRIT, used for inference. Each
+    processor receives the state at its first step from its left neighbor,
+    applies its local layers and sends the result to the right. The layer
+    weights stay local and no braid storage is used.
+
+    Returns the output of the network on the last processor, and None
+    elsewhere.
+    """
+    seq_tag   = 23
+    comm      = self.getMPIComm()
+    my_rank   = comm.Get_rank()
+    num_ranks = comm.Get_size()
+
+    assert not self.splinet, 'Sequential evaluation is not supported for a SpliNet'
+
+    with self.timer("runSequential"):
+      # the shape and precision of the incoming state are sent ahead of it
+      if my_rank>0:
+        shape_buf = torchbraid.utils.empty_shape_buffer()
+        comm.Recv(shape_buf,source=my_rank-1,tag=seq_tag)
+        shapes,dtype = torchbraid.utils.decode_shapes(shape_buf)
+
+        x = torch.empty(shapes[0],dtype=dtype,device=x.device)
+        comm.Recv(x,source=my_rank-1,tag=seq_tag)
+
+      dtype = x.dtype
+      for i,layer in enumerate(self.layer_models):
+        t = (self.start_layer+i)*self.dt
+        with self.autocast(0):
+          x = self.stepLayer(layer,t,self.dt,x,0)
+        x = x.to(dtype)
+
+      if my_rank<num_ranks-1:
+        x = x.contiguous()
+        if self.use_cuda:
+          torch.cuda.synchronize()
+        comm.Send(torchbraid.utils.encode_shapes(x.shape,dtype),dest=my_rank+1,tag=seq_tag)
+        comm.Send(x,dest=my_rank+1,tag=seq_tag)
+        return None
+
+    return x
+  # end runSequential
+
+  def getSequentialCost(self):
+    """
+    Compare the critical path of the sequential (rank-by-rank) evaluation
+    with max_iters MGRIT iterations, counted in time steps.
+
+    Returns a tuple (sequential cost, mgrit cost)
+    """
+    local_steps  = self.local_num_steps
+    coarse_steps = self.num_steps
+    iter_cost = 0
+    for level in range(self.max_levels-1):
+      if isinstance(self.cfactor,int):
+        cfactor = self.cfactor
+      else:
+        cfactor = self.cfactor.get(level,2)
+
+      # no more coarsening is possible
+      if coarse_steps<cfactor:
+        break
+
+      # F-relaxation plus the CF-relaxation sweeps on this level
+      iter_cost    += (1+self.nrelax)*local_steps
+      local_steps  /= cfactor
+      coarse_steps /= cfactor
+
+    # the coarse grid is solved serially
+    iter_cost += coarse_steps
+
+    # the final FC-relaxation
+    mgrit_cost = self.max_iters*iter_cost+self.local_num_steps
+
+    return self.num_steps, mgrit_cost
+  # end getSequentialCost
+
   def timer(self,name):
     return self.timer_manager.timer("ForWD::"+name)
 
@@ -348,8 +520,11 @@ class ForwardODENetApp(BraidApp):
     # no gradients are necessary here, so don't compute them
     dt = tstop-tstart
     with torch.no_grad():
-      ny = layer(dt,t_y)
-      y.replaceTensor(ny) 
+      with self.autocast(level):
+        ny = self.stepLayer(layer,tstart,dt,t_y,level)
+
+      # the state is always kept in the master precision
+      y.replaceTensor(ny.to(t_y.dtype)) 
 
     # This connects weights at tstop with the vector y. For a SpliNet, the weights at tstop are evaluated using the spline basis function. 
     self.setVectorWeights(tstop,y)
@@ -382,7 +557,9 @@ class ForwardODENetApp(BraidApp):
     x.requires_grad = True 
     dt = tstop-tstart
     with torch.enable_grad():
-      y = layer(dt,x)
+      # if this is evaluated under autocast, the cast back to the precision
+      # of the state is part of the graph
+      y = self.stepLayer(layer,tstart,dt,x,0).to(x.dtype)
     return (y, x), layer
   # end getPrimalWithGrad
 
@@ -421,6 +598,16 @@ class BackwardODENetApp(BraidApp):
     self.setTimerFile("braid_backward_timings")
 
     self.timer_manager = timer_manager
+
+    # flat buffers for the spline gradient reductions, built on first use
+    self.spline_bufs = None
+    self.spline_bufs_gpu_aware = None
+
+    # flat buffer backing the gradients of the layer parameters
+    self.grad_buffer = None
+
+    # data parallel gradient reducer notified as the layer gradients become final
+    self.grad_reducer = None
   # end __init__
 
   def __del__(self):
@@ -436,6 +623,12 @@ class BackwardODENetApp(BraidApp):
 
     try:
 
+      with self.timer("attachGradBuffer"):
+        grad_views = self.attachGradBuffer()
+
+      if self.grad_reducer is not None:
+        self.grad_reducer.beginLayerGrads(self)
+
       with self.timer("runBraid"):
         f = self.runBraid(x)
 
@@ -444,20 +637,14 @@ class BackwardODENetApp(BraidApp):
 
       # Communicate the spline gradients here. Alternatively, this could be done in braid_function.py: "backward(ctx, grad_output)" ?
       if self.fwd_app.splinet:
-        # req = []
-        for i,splinecomm in enumerate(self.fwd_app.spline_comm_vec):
-          if splinecomm != MPI.COMM_NULL: 
-            # print(splinecomm.Get_rank(), ": I will pack spline ", i)
-            # pack the spline into a buffer and initiate non-blocking allredude
-            splinelayer = self.fwd_app.layer_models[i - self.fwd_app.start_layer]
-            buf = torchbraid.utils.pack_buffer([p.grad for p in splinelayer.parameters()])
-            req=splinecomm.Iallreduce(MPI.IN_PLACE, buf, MPI.SUM)
-
-            # Finish up communication. TODO: Queue all requests.
-            MPI.Request.Wait(req)
-            torchbraid.utils.unpack_buffer([p.grad for p in splinelayer.parameters()], buf)
+        with self.timer("reduceSplineGrads"):
+          self.reduceSplineGrads()
       # end splinet
 
+      if self.grad_reducer is not None:
+        with self.timer("reduceLayerGrads"):
+          self.grad_reducer.endLayerGrads(self)
+
       self.grads = []
 
       # preserve the layerwise structure, to ease communication
@@ -467,7 +654,15 @@ class BackwardODENetApp(BraidApp):
       for sublist in my_params:
         sub_gradlist = [] 
         for item in sublist:
-          if item.grad is not None:
+          if id(item) in grad_views:
+            # hand the view of the flat buffer to autograd (no copy), and 
+            # detach it from the parameter
+            view = grad_views[id(item)]
+            if item.grad is not None and item.grad.data_ptr()!=view.data_ptr():
+              view.copy_(item.grad)
+            sub_gradlist += [ view ]
+            item.grad = None
+          elif item.grad is not None:
             sub_gradlist += [ item.grad.clone() ] 
           else:
             sub_gradlist += [ None ]
@@ -487,6 +682,120 @@ class BackwardODENetApp(BraidApp):
     return f
   # end forward
 
+  def attachGradBuffer(self):
+    """
+    Back the gradients of the trainable layer parameters with views into a
+    single flat (zeroed) buffer. The buffer is handed to autograd after
+    the solve, so a new one is allocated for each solve. If the parameters
+    do not share a type and device no buffer is used.
+
+    Returns a dictionary mapping the id of each parameter to its gradient view.
+    """
+    params = [p for sublist in self.fwd_app.parameters() for p in sublist if p.requires_grad]
+    if len(params)==0:
+      self.grad_buffer = None
+      return dict()
+
+    dtype  = params[0].dtype
+    device = params[0].device
+    if any([p.dtype!=dtype or p.device!=device for p in params]):
+      self.grad_buffer = None
+      return dict()
+
+    self.grad_buffer = torch.zeros(sum([p.numel() for p in params]),dtype=dtype,device=device)
+
+    views = dict()
+    offset = 0
+    for p in params:
+      n = p.numel()
+      p.grad = self.grad_buffer[offset:offset+n].view_as(p)
+      views[id(p)] = p.grad
+      offset += n
+
+    return views
+  # end attachGradBuffer
+
+  def getGradBuffer(self):
+    """
+    Get the flat buffer from the last backward solve, if the gradients of
+    the trainable layer parameters are still views into it (otherwise None).
+    """
+    if self.grad_buffer is None:
+      return None
+
+    params = [p for sublist in self.fwd_app.parameters() for p in sublist if p.requires_grad]
+    ptr = self.grad_buffer.data_ptr()
+    for p in params:
+      if p.grad is None or p.grad.data_ptr()!=ptr:
+        return None
+      ptr += p.numel()*self.grad_buffer.element_size()
+
+    return self.grad_buffer
+  # end getGradBuffer
+
+  def reduceSplineGrads(self):
+    """
+    Sum the spline gradients over the processors sharing each spline. Each
+    spline is packed into its own reusable flat buffer (in the type and on
+    the device of the parameters) and its reduction is started right away,
+    so packing overlaps with the reductions in flight. All reductions are
+    completed before returning. Device buffers are staged through host
+    buffers unless MPI is GPU aware.
+    """
+    fwd_app = self.fwd_app
+
+    # build the flat buffers, or rebuild them if the layers were moved
+    moved = self.spline_bufs is not None and any(buf.device!=params[0].device for _,params,buf,_ in self.spline_bufs)
+    if self.spline_bufs is None or moved or self.spline_bufs_gpu_aware!=self.gpu_aware_mpi:
+      self.spline_bufs = []
+      for i,splinecomm in enumerate(fwd_app.spline_comm_vec):
+        if splinecomm == MPI.COMM_NULL:
+          continue
+        splinelayer = fwd_app.layer_models[i - fwd_app.start_layer]
+        params = list(splinelayer.parameters())
+        if len(params)==0:
+          continue
+        buf = torch.empty(sum([p.numel() for p in params]),dtype=params[0].dtype,device=params[0].device)
+        if buf.device.type=='cpu' or self.gpu_aware_mpi:
+          comm_buf = buf
+        else:
+          comm_buf = torch.empty(buf.shape,dtype=buf.dtype)
+        self.spline_bufs += [(splinecomm,params,buf,comm_buf)]
+      self.spline_bufs_gpu_aware = self.gpu_aware_mpi
+
+    requests = []
+    for splinecomm,params,buf,comm_buf in self.spline_bufs:
+      offset = 0
+      for p in params:
+        n = p.numel()
+        if p.grad is None:
+          buf[offset:offset+n].zero_()
+        else:
+          buf[offset:offset+n].copy_(p.grad.view(-1))
+        offset += n
+
+      if comm_buf is not buf:
+        comm_buf.copy_(buf)
+      elif fwd_app.use_cuda:
+        torch.cuda.synchronize()
+      requests += [splinecomm.Iallreduce(MPI.IN_PLACE, comm_buf, MPI.SUM)]
+
+    MPI.Request.Waitall(requests)
+
+    for splinecomm,params,buf,comm_buf in self.spline_bufs:
+      if comm_buf is not buf:
+        buf.copy_(comm_buf)
+
+      offset = 0
+      for p in params:
+        n = p.numel()
+        if p.grad is None:
+          p.grad = buf[offset:offset+n].view_as(p).clone()
+        else:
+          p.grad.copy_(buf[offset:offset+n].view_as(p))
+        offset += n
+  # end reduceSplineGrads
+
   def getFeatureShapes(self,tidx,level):
     fine_idx = self.getFineTimeIndex(tidx,level)
     # need to map back to the global fine index on the forward grid
@@ -503,8 +812,9 @@ class BackwardODENetApp(BraidApp):
           
         # we need to adjust the time step values to reverse with the adjoint
         # this is so that the renumbering used by the backward problem is properly adjusted
-        (t_y,t_x),layer = self.fwd_app.getPrimalWithGrad(self.Tf-tstop,
-                                                         self.Tf-tstart)
+        with self.autocast(level):
+          (t_y,t_x),layer = self.fwd_app.getPrimalWithGrad(self.Tf-tstop,
+                                                           self.Tf-tstart)
                                                          
         # print(self.fwd_app.my_rank, "--> FWD with layer ", [p.data for p in layer.parameters()])
 
@@ -533,7 +843,7 @@ class BackwardODENetApp(BraidApp):
         # The above set's the gradient of the layer.parameters(), which, in case of SpliNet, is the templayer -> need to spread those sensitivities to the layer_models
         if self.fwd_app.splinet and done==1:
           with torch.no_grad(): # No idea if this is actually needed here... 
-            splines, k = self.fwd_app.splinebasis.eval(self.Tf-tstop)
+            splines, k = self.fwd_app.getSplineCoefficients(self.Tf-tstop)
             # Spread derivavites to d+1 non-zero splines(t) times weights:
             # \bar L_{k+l} += splines[l] * layer.parameters().gradient
             for l in range(len(splines)): 
@@ -559,6 +869,11 @@ class BackwardODENetApp(BraidApp):
 
         for p,s in zip(layer.parameters(),required_grad_state):
           p.requires_grad = s
+
+        # the layer gradient is final, its data parallel reduction can start
+        # (for a SpliNet the gradients are spread to several layers, they are reduced after the solve)
+        if done==1 and level==0 and self.grad_reducer is not None and not self.fwd_app.splinet:
+          self.grad_reducer.layerGradReady(self,layer)
     except:
       print('\n**** Torchbraid Internal Exception: ' 
            +'backward eval: rank={}, level={}, time interval=({:.2f},{:.2f}) ****\n'.format(self.fwd_app.my_rank,level,tstart,tstop))
@@ -0,0 +1,269 @@
+#@HEADER
+# ************************************************************************
+#
+#                        Torchbraid v. 0.1
+#
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+#
+# Torchbraid is licensed under 3-clause BSD terms of use:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name National Technology & Engineering Solutions of Sandia,
+# LLC nor the names of the contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+#
+# ************************************************************************
+#@HEADER
+
+import torch
+import torch.autograd
+
+from mpi4py import MPI
+
+import torchbraid.utils
+
+class PipelineFunction(torch.autograd.Function):
+  """
+  Exact (GPipe style) pipelined propagation through the layers of a
+  ForwardODENetApp. This is an alternative to the MGRIT solve of the
+  BraidFunction, using the same layer partition.
+
+  The batch is split into micro-batches on rank 0. Each processor applies
+  its local layers to a micro-batch and sends the result to its right
+  neighbor without waiting, then moves on to the next micro-batch. The
+  backward pass streams the micro-batch gradients from the last processor
+  back to rank 0 in the same way.
+  """
+
+  fwd_tag = 24
+  bwd_tag = 25
+
+  @staticmethod
+  def forward(ctx, fwd_app, num_microbatches, x, *params):
+    comm          = fwd_app.getMPIComm()
+    my_rank       = fwd_app.getMPIComm().Get_rank()
+    num_ranks     = fwd_app.getMPIComm().Get_size()
+
+    assert not fwd_app.splinet, 'Pipelined propagation is not supported for a SpliNet'
+
+    # only build the graph if a derivative is needed
+    requires_grad = any(ctx.needs_input_grad)
+
+    ctx.fwd_app = fwd_app
+    ctx.params = params
+
+    if my_rank==0:
+      chunks = torch.chunk(x.detach(),num_microbatches,dim=0)
+      num_chunks = len(chunks)
+    else:
+      num_chunks = None # this comes with the first micro-batch
+
+    inputs = []
+    outputs = []
+    send_bufs = []
+    requests = []
+    with fwd_app.timer("pipeline::forward"):
+      m = 0
+      while num_chunks is None or m<num_chunks:
+        if my_rank==0:
+          xm = chunks[m].detach()
+        else:
+          # the micro-batch shape and the number of micro-batches are sent ahead of the state
+          shape_buf = torchbraid.utils.empty_shape_buffer()
+          comm.Recv(shape_buf,source=my_rank-1,tag=PipelineFunction.fwd_tag)
+          shapes,dtype = torchbraid.utils.decode_shapes(shape_buf)
+          num_chunks = shapes[1][0]
+
+          xm = torch.empty(shapes[0],dtype=dtype,device=x.device)
+          comm.Recv(xm,source=my_rank-1,tag=PipelineFunction.fwd_tag)
+
+        xm.requires_grad = requires_grad
+        with torch.set_grad_enabled(requires_grad):
+          ym = PipelineFunction.applyLayers(fwd_app,xm)
+
+        if requires_grad:
+          inputs += [xm]
+        if requires_grad or my_rank==num_ranks-1:
+          outputs += [ym]
+
+        # send to the right neighbor without waiting
+        if my_rank<num_ranks-1:
+          ym_send = ym.detach().contiguous()
+          if fwd_app.use_cuda:
+            torch.cuda.synchronize()
+          shape_buf = torchbraid.utils.encode_shapes([ym_send.shape,torch.Size([num_chunks])],ym_send.dtype)
+          requests += [comm.Isend(shape_buf,dest=my_rank+1,tag=PipelineFunction.fwd_tag)]
+          requests += [comm.Isend(ym_send,dest=my_rank+1,tag=PipelineFunction.fwd_tag)]
+
+          # keep the send buffers alive until the sends complete
+          send_bufs += [(shape_buf,ym_send)]
+
+        m += 1
+      # end while
+
+      MPI.Request.Waitall(requests)
+
+    ctx.inputs = inputs
+    ctx.outputs = outputs
+
+    # the output gradient is None on processors that don't use the output
+    ctx.set_materialize_grads(False)
+
+    if my_rank==num_ranks-1:
+      y = torch.cat([o.detach() for o in outputs],dim=0)
+    else:
+      y = None
+
+    if not fwd_app.bcast_output:
+      y = y if my_rank==num_ranks-1 else torch.zeros(1,device=x.device)
+    else:
+      y = PipelineFunction.bcastFromLast(comm,y,x.device,fwd_app.use_cuda)
+
+    ctx.output_shape = (y.shape,y.dtype,y.device)
+    return y
+
+  @staticmethod
+  def backward(ctx, grad_output):
+    comm          = ctx.fwd_app.getMPIComm()
+    my_rank       = ctx.fwd_app.getMPIComm().Get_rank()
+    num_ranks     = ctx.fwd_app.getMPIComm().Get_size()
+
+    fwd_app = ctx.fwd_app
+    params  = ctx.params
+    outputs = ctx.outputs
+    inputs  = ctx.inputs
+
+    shape,dtype,device = ctx.output_shape
+
+    # copy the output gradient to the final processor (where the backward pass begins),
+    # unless the output was only used there
+    if num_ranks>1 and fwd_app.bcast_output:
+      if my_rank==0:
+        if grad_output is None:
+          grad_output = torch.zeros(shape,dtype=dtype,device=device)
+        if fwd_app.use_cuda:
+          torch.cuda.synchronize()
+        req = comm.Isend(grad_output.contiguous(),dest=num_ranks-1,tag=PipelineFunction.bwd_tag)
+        req.Wait()
+      elif my_rank==num_ranks-1:
+        grad_output = torch.empty(shape,dtype=dtype,device=device)
+        comm.Recv(grad_output,source=0,tag=PipelineFunction.bwd_tag)
+    elif my_rank==num_ranks-1 and grad_output is None:
+      grad_output = torch.zeros(shape,dtype=dtype,device=device)
+
+    # post all the receives for the output gradients up front
+    grad_recvs = []
+    requests = []
+    if my_rank<num_ranks-1:
+      for ym in outputs:
+        g = torch.empty(ym.shape,dtype=ym.dtype,device=ym.device)
+        grad_recvs += [g]
+        requests += [comm.Irecv(g,source=my_rank+1,tag=PipelineFunction.bwd_tag)]
+    else:
+      sizes = [ym.shape[0] for ym in outputs]
+      grad_recvs = torch.split(grad_output,sizes,dim=0)
+
+    param_grads = [None for p in params]
+    input_grads = []
+    send_requests = []
+    with fwd_app.timer("pipeline::backward"):
+      for m,(xm,ym) in enumerate(zip(inputs,outputs)):
+        if my_rank<num_ranks-1:
+          requests[m].Wait()
+        gm = grad_recvs[m]
+
+        wrt = [xm] + list(params)
+        grads = torch.autograd.grad(ym,wrt,grad_outputs=gm,allow_unused=True)
+
+        for i,g in enumerate(grads[1:]):
+          if g is None:
+            continue
+          if param_grads[i] is None:
+            param_grads[i] = g
+          else:
+            param_grads[i] += g
+
+        input_grads += [grads[0]]
+        if my_rank>0:
+          send_grad = grads[0].contiguous()
+          if fwd_app.use_cuda:
+            torch.cuda.synchronize()
+          input_grads[-1] = send_grad # keep alive until the send completes
+          send_requests += [comm.Isend(send_grad,dest=my_rank-1,tag=PipelineFunction.bwd_tag)]
+      # end for m
+
+      MPI.Request.Waitall(send_requests)
+
+    # release the graph
+    ctx.inputs = None
+    ctx.outputs = None
+
+    # grad_input follows the input to forward: fwd_app, num_microbatches, x, params
+    grad_input = (None,None)
+    if my_rank==0 and ctx.needs_input_grad[2]:
+      grad_input += (torch.cat(input_grads,dim=0),)
+    else:
+      grad_input += (None,)
+
+    for grad_needed,g in zip(ctx.needs_input_grad[3:],param_grads):
+      grad_input += (g if grad_needed else None,)
+
+    return grad_input
+
+  @staticmethod
+  def applyLayers(fwd_app,x):
+    """
+    Apply the local layers of the forward app to x.
+    """
+    dtype = x.dtype
+    for i,layer in enumerate(fwd_app.layer_models):
+      t = (fwd_app.start_layer+i)*fwd_app.dt
+      with fwd_app.autocast(0):
+        x = fwd_app.stepLayer(layer,t,fwd_app.dt,x,0)
+      x = x.to(dtype)
+    return x
+
+  @staticmethod
+  def bcastFromLast(comm,y,device,use_cuda):
+    """
+    Broadcast the tensor y from the last processor, the shape and type
+    are broadcast first.
+    """
+    my_rank   = comm.Get_rank()
+    num_ranks = comm.Get_size()
+
+    if num_ranks==1:
+      return y
+
+    if my_rank==num_ranks-1:
+      shape_buf = torchbraid.utils.encode_shapes(y.shape,y.dtype)
+    else:
+      shape_buf = torchbraid.utils.empty_shape_buffer()
+    comm.Bcast(shape_buf,root=num_ranks-1)
+    shapes,dtype = torchbraid.utils.decode_shapes(shape_buf)
+
+    if my_rank==num_ranks-1:
+      result = y.contiguous()
+    else:
+      result = torch.empty(shapes[0],dtype=dtype,device=device)
+
+    if use_cuda:
+      torch.cuda.synchronize()
+    comm.Bcast(result,root=num_ranks-1)
+
+    return result
+# end PipelineFunction
@@ -34,7 +34,6 @@
 
 import torch
 import traceback
-import numpy as np
 
 from torchbraid.torchbraid_app import BraidApp
 import torchbraid.utils
@@ -70,7 +69,24 @@ class ForwardBraidApp(BraidApp):
     self.use_deriv = False
 
     self.seq_shapes = None
+
+    # fine level forward steps (with their graphs) stored for backprop,
+    # limited to backpropped_budget bytes (None is unlimited)
     self.backpropped = dict()
+    self.backpropped_budget = None
+    self.backpropped_policy = 'keep_first'
+    self.backpropped_bytes = 0
+    self.backpropped_full = False
+    self.resetBackpropStats()
+
+    # persistent requests and buffers for the sequence halo exchange
+    self.halo_key = None
+    self.halo_send = None
+    self.halo_recv = None
+    self.halo_recv_buf = None
+    self.halo_send_request = None
+    self.halo_recv_request = None
+    self.halo_pending = False
     self.seq_x_reduced = dict()
 
     self.has_fastforward = hasattr(self.RNN_models,'fastForward')
@@ -78,11 +94,103 @@ class ForwardBraidApp(BraidApp):
     self.fastforward_calls = 0
     if self.has_fastforward:
       assert(hasattr(self.RNN_models,'reduceX'))
+
+    # reduced sequence, indexed by time, if the whole sequence can be reduced at once
+    self.has_reduce_sequence = self.has_fastforward and hasattr(self.RNN_models,'reduceXSequence')
+    self.x_reduced = None
+    self.x_reduced_halo = None
   # end __init__
 
   def getFastForwardInfo(self):
     return self.fastforward_time, self.fastforward_calls
 
+  def setBackpropStorage(self,max_bytes=None,policy='keep_first'):
+    """
+    Limit the memory used by the forward steps stored for backprop to
+    about max_bytes (None is unlimited). Steps that are not stored are
+    recomputed by getPrimalWithGrad. If the budget is exceeded the policy
+    'keep_first' stores no more steps, and 'keep_last' drops the earliest
+    stored steps to make room.
+    """
+    assert policy in ['keep_first','keep_last']
+
+    self.backpropped_budget = max_bytes
+    self.backpropped_policy = policy
+
+  def resetBackpropStats(self):
+    self.backpropped_stats = {'hits':0,'misses':0,'stored':0,'dropped':0,'peak_bytes':0}
+
+  def getBackpropStats(self):
+    """
+    Statistics of the storage of forward steps for backprop since the start of
+    the last forward solve: the number of steps found (hits) and recomputed
+    (misses) in backprop, the number stored and dropped, and the peak number of
+    bytes stored (only measured if the storage is limited).
+    """
+    return dict(self.backpropped_stats)
+
+  def clearBackpropped(self):
+    self.backpropped = dict()
+    self.backpropped_bytes = 0
+    self.backpropped_full = False
+
+  def storeBackpropped(self,tstart,tstop,u,y,nbytes):
+    """
+    Store a fine level step for backprop, subject to the storage budget.
+    """
+    stats = self.backpropped_stats
+
+    # replacing a step doesn't add to the storage
+    if (tstart,tstop) in self.backpropped:
+      self.backpropped_bytes -= self.backpropped.pop((tstart,tstop))[2]
+
+    budget = self.backpropped_budget
+    if budget is not None:
+      if self.backpropped_policy=='keep_last':
+        while len(self.backpropped)>0 and self.backpropped_bytes+nbytes>budget:
+          key = next(iter(self.backpropped))
+          self.backpropped_bytes -= self.backpropped.pop(key)[2]
+          stats['dropped'] += 1
+
+      if self.backpropped_bytes+nbytes>budget:
+        self.backpropped_full = True
+        stats['dropped'] += 1
+        return
+
+    self.backpropped[tstart,tstop] = (u,y,nbytes)
+    self.backpropped_bytes += nbytes
+
+    stats['stored'] += 1
+    stats['peak_bytes'] = max(stats['peak_bytes'],self.backpropped_bytes)
+
+  def graphStep(self,level,tstart,tstop,seq_x,u):
+    """
+    Compute a step with its graph for backprop. If the storage is limited the
+    (approximate) number of bytes held by the graph is also returned, these
+    are the tensors saved for the backward pass that aren't parameters or the
+    sequence.
+    """
+    if self.backpropped_budget is None:
+      return self.computeStep(level,tstart,tstop,seq_x,u,allow_ff=False),0
+
+    external = set([p.untyped_storage().data_ptr() for p in self.parameters()])
+    external.add(self.x.untyped_storage().data_ptr())
+    if self.halo_recv is not None:
+      external.add(self.halo_recv.untyped_storage().data_ptr())
+
+    saved = dict()
+    def pack(t):
+      ptr = t.untyped_storage().data_ptr()
+      if ptr not in external:
+        saved[ptr,t.numel()] = t.numel()*t.element_size()
+      return t
+
+    with torch.autograd.graph.saved_tensors_hooks(pack,lambda t: t):
+      y = self.computeStep(level,tstart,tstop,seq_x,u,allow_ff=False)
+
+    nbytes = sum(saved.values()) + sum([v.numel()*v.element_size() for v in list(u)+list(y)])
+    return y,nbytes
+
   def computeStep(self,level,tstart,tstop,seq_x,u,allow_ff):
     """
     This method handles a fast forward evaluation. If the user has not
@@ -93,10 +201,16 @@ class ForwardBraidApp(BraidApp):
     reuse. Regardless of it being computed or pulled from storage, the fastForward
     version of the RNNcell is called (which used the reduced version of the
     sequence variable.
+
+    If the cell defines reduceXSequence, the reduced sequence is computed for
+    all the local time steps at the start of run, and is looked up by time index
+    (on all levels).
     """
 
     if allow_ff:
-      if tstart not in self.seq_x_reduced:
+      if self.x_reduced is not None:
+        seq_x_reduce = self.getReducedSequenceVector(tstart)
+      elif tstart not in self.seq_x_reduced:
         # don't differentiate this
 
         start_timer = timer()
@@ -142,12 +256,54 @@ class ForwardBraidApp(BraidApp):
 
     if index<self.x.shape[1]:
       value = self.x[:,index,:]
+    elif index==self.x.shape[1] and self.halo_recv is not None:
+      # the first time slice of the right neighbor
+      self.waitHaloRecv()
+      value = self.halo_recv
     else:
       # this is a sentinnel
       value = self.x[:,0,:].detach().clone()
 
     return value
 
+  def reduceSequence(self):
+    """
+    Compute the reduced version of the local sequence in one batched call
+    to the cell's reduceXSequence (time is the second dimension). The halo
+    is reduced separately when it's first needed, so the exchange isn't
+    waited on here.
+    """
+    start_timer = timer()
+    with torch.no_grad():
+      self.x_reduced = self.RNN_models.reduceXSequence(self.x)
+    stop_timer = timer()
+
+    self.x_reduced_halo = None
+
+    self.fastforward_time  +=  stop_timer-start_timer
+    self.fastforward_calls += 1
+
+  def getReducedSequenceVector(self,t):
+    index = self.getDataVectorIndex(t)
+
+    if index<self.x.shape[1]:
+      return tuple([r[:,index] for r in self.x_reduced])
+
+    if index==self.x.shape[1] and self.halo_recv is not None:
+      if self.x_reduced_halo is None:
+        start_timer = timer()
+        with torch.no_grad():
+          halo = self.getSequenceVector(t).unsqueeze(1)
+          self.x_reduced_halo = tuple([r[:,0] for r in self.RNN_models.reduceXSequence(halo)])
+        stop_timer = timer()
+
+        self.fastforward_time  +=  stop_timer-start_timer
+        self.fastforward_calls += 1
+      return self.x_reduced_halo
+
+    # this is a sentinnel (see getSequenceVector)
+    return tuple([r[:,0] for r in self.x_reduced])
+
   def initializeVector(self,t,x):
     try:
       if t!=0.0: # don't change the initial condition
@@ -158,7 +314,7 @@ class ForwardBraidApp(BraidApp):
 
       # if fast forward is available do an early evaluation of the
       # sequence preemptively
-      if self.has_fastforward:
+      if self.has_fastforward and self.x_reduced is None:
         start_timer = timer()
         with torch.no_grad():
           self.seq_x_reduced[t] = self.RNN_models.reduceX(value)
@@ -172,6 +328,79 @@ class ForwardBraidApp(BraidApp):
       traceback.print_exc()
 
 
+  def startHaloExchange(self,x):
+    """
+    Start the exchange of the first time slice of the local sequence with the
+    left neighbor, the right neighbor's slice is needed for the last step on
+    this processor. The exchange uses persistent requests on buffers that are
+    reused as long as the slice shape doesn't change. The buffers are on the
+    device of x if MPI is GPU aware (see gpu_aware_mpi), otherwise on the host.
+    The receive is completed lazily, when the halo is first needed.
+    """
+    comm      = self.mpi_comm
+    num_ranks = comm.Get_size()
+    my_rank   = self.my_rank
+
+    x_slice = x[:,0,:]
+    staged = x_slice.device.type!='cpu' and not self.gpu_aware_mpi
+    key = (x_slice.shape,x_slice.dtype,x_slice.device,staged)
+    if key!=self.halo_key:
+      self.freeHaloExchange()
+      self.halo_key = key
+
+      buf_device = torch.device('cpu') if staged else x_slice.device
+
+      # receive data vector from the right
+      if my_rank<num_ranks-1:
+        self.halo_recv = torch.empty(x_slice.shape,dtype=x_slice.dtype,device=x_slice.device)
+        self.halo_recv_buf = torch.empty(x_slice.shape,dtype=x_slice.dtype,device=buf_device) if staged else self.halo_recv
+        self.halo_recv_request = comm.Recv_init(self.halo_recv_buf,source=my_rank+1,tag=22)
+
+      # send data vector to the left
+      if my_rank>0:
+        self.halo_send = torch.empty(x_slice.shape,dtype=x_slice.dtype,device=buf_device)
+        self.halo_send_request = comm.Send_init(self.halo_send,dest=my_rank-1,tag=22)
+    # end if key
+
+    if self.halo_recv_request is not None:
+      self.halo_recv_request.Start()
+
+    if self.halo_send_request is not None:
+      self.halo_send.copy_(x_slice)
+      if self.halo_send.device.type!='cpu':
+        torch.cuda.synchronize()
+      self.halo_send_request.Start()
+
+    self.halo_pending = True
+
+  def waitHaloRecv(self):
+    if self.halo_pending and self.halo_recv_request is not None:
+      with self.timer("run:halo-wait"):
+        self.halo_recv_request.Wait()
+        if self.halo_recv_buf is not self.halo_recv:
+          self.halo_recv.copy_(self.halo_recv_buf)
+    self.halo_pending = False
+
+  def finishHaloExchange(self):
+    """
+    Complete the halo exchange, the send buffer may be reused afterwards.
+    """
+    self.waitHaloRecv()
+    if self.halo_send_request is not None:
+      self.halo_send_request.Wait()
+
+  def freeHaloExchange(self):
+    for request in [self.halo_send_request,self.halo_recv_request]:
+      if request is not None:
+        request.Free()
+    self.halo_key = None
+    self.halo_send = None
+    self.halo_recv = None
+    self.halo_recv_buf = None
+    self.halo_send_request = None
+    self.halo_recv_request = None
+    self.halo_pending = False
+
   def run(self,x,h_c):
     self.use_deriv = self.training
 
@@ -184,39 +413,29 @@ class ForwardBraidApp(BraidApp):
     self.fastforward_time  = 0.0 # we will measure new fastorward time
     self.fastforward_calls = 0
     self.seq_x_reduced = dict()
+    self.x_reduced = None
 
-    # TODO: We're using the GPU -> CPU -> CPU -> GPU model here - might be a better way to reorganize
-    #   this with the same logic we're using for the rest of it.
+    # the stored steps belong to the last batch
+    self.clearBackpropped()
+    self.resetBackpropStats()
 
-    self.x = x.cpu()
+    # the sequence stays on its device, only the halo slice is communicated
+    self.x = x.detach()
     self.seq_shapes = [x[:,0,:].shape]
 
     with self.timer("run:precomm"):
-      # receive data vector from the right
-      recv_request = None
-      if my_rank<num_ranks-1:
-        neighbor_x = torch.zeros(x[:,0,:].shape)
-        recv_request = comm.Irecv(neighbor_x.numpy(),source=my_rank+1,tag=22)
-
-      # send data vector to the left
-      send_request = None
-      if my_rank>0:
-        send_request = comm.Isend(np.ascontiguousarray(self.x[:,0,:].numpy()),dest=my_rank-1,tag=22)
-
-      if recv_request:
-        recv_request.Wait()
-        self.x = torch.cat((self.x,neighbor_x.unsqueeze(1)), 1)
-
-      if send_request:
-        send_request.Wait()
-    # end with timer
+      self.startHaloExchange(self.x)
 
-    self.x = self.x.to(x.device)
+    # reduce the sequence while the halo is in flight
+    if self.has_reduce_sequence:
+      self.reduceSequence()
 
     comm.Barrier()
     with self.timer("run:runBraid"):
       y = self.runBraid(h_c)
 
+    self.finishHaloExchange()
+
     # TODO: We're using the GPU -> CPU -> CPU -> GPU model here - might be a better way to reorganize
     #   this with the same logic we're using for the rest of it.
 
@@ -247,11 +466,19 @@ class ForwardBraidApp(BraidApp):
 
       seq_x = g0.weightTensors()[0].to(self.x.device)
 
-      # don't need derivatives or anything, just compute
-      if not done or level>0:
+      # don't need derivatives or anything, just compute (also if the
+      # storage is full and the step would be recomputed anyway)
+      store = done and level==0
+      if store and self.backpropped_full and self.backpropped_policy=='keep_first':
+        self.backpropped_stats['dropped'] += 1
+        store = False
+
+      if not store:
         u = [g.to(self.x.device) for g in g0.tensors()]
         with torch.no_grad():
-          y = self.computeStep(level,tstart,tstop,seq_x,u,self.has_fastforward)
+          with self.autocast(level):
+            y = self.computeStep(level,tstart,tstop,seq_x,u,self.has_fastforward)
+          y = tuple([yv.to(uv.dtype) for yv,uv in zip(y,u)])
       else:
         # setup the solution vector for derivatives
         u = tuple([t.detach().to(self.x.device) for t in g0.tensors()])
@@ -259,17 +486,19 @@ class ForwardBraidApp(BraidApp):
           t.requires_grad = True
 
         with torch.enable_grad():
-          y = self.computeStep(level,tstart,tstop,seq_x,u,allow_ff=False)
+          with self.autocast(level):
+            y,nbytes = self.graphStep(level,tstart,tstop,seq_x,u)
+          y = tuple([yv.to(uv.dtype) for yv,uv in zip(y,u)])
 
         # store the fine level solution for reuse later in backprop
-        if level==0:
-          self.backpropped[tstart,tstop] = (u,y)
+        self.storeBackpropped(tstart,tstop,u,y,nbytes)
 
       seq_x = self.getSequenceVector(tstop)
 
+      # the vector doesn't hold on to the graph, only the stored steps do
       g0.addWeightTensors((seq_x,))
       for i,t in enumerate(y):
-        g0.replaceTensor(t,i)
+        g0.replaceTensor(t.detach(),i)
   # end eval
 
   def getPrimalWithGrad(self,tstart,tstop,level,done):
@@ -286,9 +515,13 @@ class ForwardBraidApp(BraidApp):
     # use the short cut precomputed (with derivatives)
     if level==0 and (tstart,tstop) in self.backpropped:
       with self.timer("getPrimalWithGrad-short"):
-        u,y = self.backpropped[(tstart,tstop)]
+        u,y,_ = self.backpropped[(tstart,tstop)]
+      self.backpropped_stats['hits'] += 1
       return y,u, self.RNN_models
 
+    if level==0:
+      self.backpropped_stats['misses'] += 1
+
     with self.timer("getPrimalWithGrad-long"):
       # extract the various vectors for this value from the fine level to linearize around
       b_u = self.getUVector(0,tstart)
@@ -299,9 +532,12 @@ class ForwardBraidApp(BraidApp):
       for t in u:
         t.requires_grad = True
 
-      # evaluate the step
+      # evaluate the step (the caller is responsible for any autocast), the
+      # reduced sequence carries no derivative, so a fine level step that was
+      # not stored is recomputed without the fast forward
       with torch.enable_grad():
-        y = self.computeStep(level,tstart,tstop,seq_x,u,allow_ff=self.has_fastforward)
+        y = self.computeStep(level,tstart,tstop,seq_x,u,allow_ff=self.has_fastforward and level>0)
+        y = tuple([yv.to(uv.dtype) for yv,uv in zip(y,u)])
 
     sys.stdout.flush()
 
@@ -337,6 +573,9 @@ class BackwardBraidApp(BraidApp):
     self.setTimerFile("braid_backward_timings")
 
     self.timer_manager = timer_manager
+
+    # flat buffer holding the parameter gradients after a solve
+    self.grad_buffer = None
   # end __init__
 
   def __del__(self):
@@ -358,17 +597,27 @@ class BackwardBraidApp(BraidApp):
     try:
       f = self.runBraid(x)
 
-      my_params = self.fwd_app.parameters()
+      # gather the gradients in a single flat buffer, the grads are views into it.
+      # The layout covers all the parameters (zeros for a missing gradient), so
+      # it is the same on all processors
+      my_params = list(self.fwd_app.parameters())
+      flat = [item.grad.detach().reshape(-1) if item.grad is not None else
+              torch.zeros(item.numel(),dtype=item.dtype,device=item.device) for item in my_params]
+      self.grad_buffer = torch.cat(flat) if len(flat)>0 else torch.zeros(0,device=self.fwd_app.device)
+
       self.grads = []
+      offset = 0
       for item in my_params:
-        if item.grad is not None:
-          self.grads += [ item.grad.detach().clone() ]
-        else:
-          self.grads += [ None ]
+        n = item.numel()
+        self.grads += [ self.grad_buffer[offset:offset+n].view_as(item) ]
+        offset += n
 
       # required otherwise we will re-add the gradients
       self.fwd_app.RNN_models.zero_grad()
 
+      # release the stored forward steps
+      self.fwd_app.clearBackpropped()
+
     except:
       print('\n**** Torchbraid Internal Exception ****\n')
       traceback.print_exc()
@@ -387,7 +636,8 @@ class BackwardBraidApp(BraidApp):
 
         # we need to adjust the time step values to reverse with the adjoint
         # this is so that the renumbering used by the backward problem is properly adjusted
-        t_y,t_x,rnn_models = self.fwd_app.getPrimalWithGrad(self.Tf-tstop,self.Tf-tstart,level,done)
+        with self.autocast(level):
+          t_y,t_x,rnn_models = self.fwd_app.getPrimalWithGrad(self.Tf-tstop,self.Tf-tstart,level,done)
 
         # play with the parameter gradients to make sure they are on apprpriately,
         # store the initial state so we can revert them later
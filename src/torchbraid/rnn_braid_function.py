@@ -29,13 +29,11 @@
 # ************************************************************************
 #@HEADER
 
-import numpy as np
 import torch.autograd
 import torchbraid.utils as utils
 import traceback
 
 from torch.nn.functional import pad
-from mpi4py import MPI
 
 class BraidFunction(torch.autograd.Function):
 
@@ -52,7 +50,7 @@ class BraidFunction(torch.autograd.Function):
 
   @staticmethod
   def forward(ctx, fwd_app, bwd_app, num_input_tensors, x, *input_and_param_tensors):
-    comm          = fwd_app.getMPIComm()
+    comm          = fwd_app.getCommBackend()
     my_rank       = fwd_app.getMPIComm().Get_rank()
     num_ranks     = fwd_app.getMPIComm().Get_size()
 
@@ -61,8 +59,13 @@ class BraidFunction(torch.autograd.Function):
 
     # copy the input to all processors (ensure consistency)
     with fwd_app.timer("func:precomm"):
-      sizes = tuple([input_and_param_tensors[i].size() for i in range(num_input_tensors)])
-      shape = list(comm.bcast(sizes,root=0))
+      if my_rank==0:
+        sizes = [input_and_param_tensors[i].size() for i in range(num_input_tensors)]
+        shape_buf = utils.encode_shapes(sizes,x.dtype)
+      else:
+        shape_buf = utils.empty_shape_buffer()
+      comm.bcast(torch.from_numpy(shape_buf),root=0)
+      shape,_ = utils.decode_shapes(shape_buf)
 
     old_shape = fwd_app.getShape()
     adjusting = old_shape is not None and old_shape!=shape
@@ -101,7 +104,7 @@ class BraidFunction(torch.autograd.Function):
 
   @staticmethod
   def backward(ctx, *grad_state):
-    comm          = ctx.bwd_app.getMPIComm()
+    comm          = ctx.bwd_app.getCommBackend()
     my_rank       = ctx.bwd_app.getMPIComm().Get_rank()
     num_ranks     = ctx.bwd_app.getMPIComm().Get_size()
     device        = ctx.device
@@ -111,14 +114,13 @@ class BraidFunction(torch.autograd.Function):
       if num_ranks>1:
         if my_rank==num_ranks-1: 
           grad_state = torch.stack(grad_state)
-          req = comm.Irecv(grad_state.cpu().numpy(),source=0,tag=22)
-          req.Wait()
+          req = comm.irecv(grad_state,source=0,tag=22)
+          req.wait()
 
         if my_rank==0:
           grad_state = torch.stack(grad_state)
-          grad_state_cpu = grad_state.cpu()
-          comm.Isend(grad_state_cpu.numpy(),dest=num_ranks-1,tag=22)
-          grad_state = grad_state_cpu.to(device)
+          req = comm.isend(grad_state,dest=num_ranks-1,tag=22)
+          req.wait()
 
         grad_state = tuple([grad_state[i] for i in range(len(grad_state))])
       # end if num_ranks
@@ -133,13 +135,10 @@ class BraidFunction(torch.autograd.Function):
         result = ctx.bwd_app.run(None)
 
     with ctx.bwd_app.timer("func:postrun"):
-      # pack up the buffer, and then send it out
-      buf_size = utils.buffer_size(ctx.bwd_app.grads)
-
-      src_buf = utils.pack_buffer([g.cpu() if g is not None else None for g in ctx.bwd_app.grads])
-      dst_buf = np.zeros(buf_size)
-
-      req = comm.Iallreduce(src_buf,dst_buf,MPI.SUM)
+      # sum the gradients over the processors with a single reduction of
+      # the flat buffer (the grads are views into it)
+      grad_buffer = ctx.bwd_app.grad_buffer
+      req = comm.allreduce(grad_buffer,async_op=True)
 
       # grad_input follows the input to forward: fwd_app, bwd_app, Num_input_tensors, x, params
       grad_input = [None,None,None]
@@ -154,11 +153,7 @@ class BraidFunction(torch.autograd.Function):
             grad_input[4+i] = r
 
       # with for communication to complete
-      MPI.Request.Wait(req)
-
-      grads_cpu = [g.cpu() if g is not None else None for g in ctx.bwd_app.grads]
-      utils.unpack_buffer(grads_cpu,dst_buf)
-      ctx.bwd_app.grads = [g.to(device) if g is not None else None for g in grads_cpu]
+      req.wait()
 
       # setup the return value (perversely grad_input)
       for grad_needed,g in zip(ctx.needs_input_grad[5:],ctx.bwd_app.grads):
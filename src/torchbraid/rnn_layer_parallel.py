@@ -99,6 +99,23 @@ class RNN_Parallel(LPModule):
   def getFastForwardInfo(self):
     return self.fwd_app.getFastForwardInfo()
 
+  def setGraphStorage(self,max_mb=None,policy='keep_first'):
+    """
+    Limit the memory (in megabytes, None is unlimited) used to store the
+    fine level forward steps (with their graphs) for backprop. Steps that
+    don't fit are recomputed in the backward pass. The policy decides which
+    steps are kept when the limit is reached: 'keep_first' or 'keep_last'.
+    """
+    max_bytes = None if max_mb is None else int(max_mb * 2 ** 20)
+    self.configureApps('fwd','setBackpropStorage',max_bytes,policy)
+
+  def getGraphStorageStats(self):
+    """
+    Get the hits and misses of the stored forward steps in the last
+    backward pass (see ForwardBraidApp.getBackpropStats).
+    """
+    return self.fwd_app.getBackpropStats()
+
   def forward(self,x,h_c=None):
     # we are doing this to take adavtage of
     # pytorch's autograd which functions "naturally"
@@ -35,10 +35,12 @@
 import torch
 import numpy as np
 import traceback
+import contextlib
 
 from typing import Union
 from libc.stdio cimport FILE, stdout
 from torchbraid.braid_vector import BraidVector
+from torchbraid.utils.comm_backend import MPIBackend
 
 cimport mpi4py.MPI as MPI
 
@@ -84,7 +86,7 @@ class BraidApp:
     self.x_final = None
     self.shape0 = None
 
-    self.buffer = []
+    self.buffer = dict() # user allocated MPI buffers, keyed by address
 
     comm          = self.getMPIComm()
     my_rank       = self.getMPIComm().Get_rank()
@@ -122,6 +124,15 @@ class BraidApp:
 
     self.device = None
     self.use_cuda = False
+
+    self.comm_backend = None
+    self.default_comm_backend = None
+
+    # can MPI communicate device memory (otherwise it's staged through the host)
+    self.gpu_aware_mpi = False
+
+    # reduced precision evaluation of the step, keyed by level (-1 is all levels)
+    self.autocast_dtypes = dict()
   # end __init__
 
   def getNumSteps(self):
@@ -386,6 +397,50 @@ class BraidApp:
       self.user_mpi_buf = True
       braid_SetBufAllocFree(core, b_bufalloc, b_buffree)
 
+  def setAutocast(self,dtype,level=-1):
+    """
+    Evaluate the step in reduced precision on a level.
+
+    The step (and its linearization) is run under torch.autocast with
+    the specified dtype, while the parameters, the state vectors and the
+    accumulated gradients remain in their original (master) precision.
+
+    Parameters
+    ----------
+
+    dtype : torch.dtype | None
+      The autocast dtype (e.g. torch.bfloat16), None disables autocast.
+
+    level : int
+      The level to set, -1 (the default) implies all levels. Levels set
+      individually take precedence over the all level setting.
+    """
+    if level==-1:
+      self.autocast_dtypes = {-1: dtype}
+    else:
+      self.autocast_dtypes[level] = dtype
+
+  def getAutocastDType(self,level):
+    """
+    Get the autocast dtype used on a level, None if autocast is disabled.
+    """
+    if level in self.autocast_dtypes:
+      return self.autocast_dtypes[level]
+    return self.autocast_dtypes.get(-1,None)
+
+  def autocast(self,level):
+    """
+    Context manager enabling the autocast dtype (if any) for a level.
+    """
+    dtype = self.getAutocastDType(level)
+    if dtype is None:
+      return contextlib.nullcontext()
+
+    device_type = 'cpu'
+    if self.device is not None:
+      device_type = self.device.type
+    return torch.autocast(device_type=device_type,dtype=dtype)
+
   def diagnostics(self,enable):
     """
     This method tells torchbraid, to keep track of the feature vectors
@@ -411,19 +466,18 @@ class BraidApp:
     return self.shape0
 
   def addBufferEntry(self, tensor):
-    self.buffer.append(tensor)
-    return self.buffer[-1].data_ptr()
+    addr = tensor.data_ptr()
+    self.buffer[addr] = tensor
+    return addr
 
   def getBuffer(self, addr):
-    for i in range(len(self.buffer)):
-      dataPtr = self.buffer[i].data_ptr()
-      if dataPtr == addr:
-        return self.buffer[i]
-
-    raise Exception('Buffer not found')
+    if addr not in self.buffer:
+      raise Exception('Buffer not found')
+    return self.buffer[addr]
 
   def removeBufferEntry(self, addr):
-    self.buffer = [item for item in self.buffer if item.data_ptr() != addr]
+    # vectors unpacked from the buffer keep its memory alive
+    self.buffer.pop(addr,None)
 
   def initializeStates(self):
     try:
@@ -643,6 +697,24 @@ class BraidApp:
   def getMPIComm(self):
     return self.mpi_comm
 
+  def setCommBackend(self,backend):
+    """
+    Set the backend for the python level communication of the app (see
+    torchbraid.utils.comm_backend), None uses MPI on the communicator of
+    the app (staging device tensors through the host unless gpu_aware_mpi
+    is set). The braid messages always use MPI.
+    """
+    self.comm_backend = backend
+
+  def getCommBackend(self):
+    if self.comm_backend is not None:
+      return self.comm_backend
+
+    # rebuilt if gpu_aware_mpi changed
+    if self.default_comm_backend is None or self.default_comm_backend.gpu_aware!=self.gpu_aware_mpi:
+      self.default_comm_backend = MPIBackend(self.mpi_comm,gpu_aware=self.gpu_aware_mpi)
+    return self.default_comm_backend
+
   def getGlobalTimeIndex(self,t):
     return round(t / self.dt)
 
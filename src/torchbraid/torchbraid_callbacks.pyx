@@ -241,7 +241,9 @@ cdef int my_bufpack(braid_App app, braid_Vector u, void * buffer,braid_BufferSta
 
 
   try:
-    if pyApp.use_cuda:
+    # with user allocated buffers (always the case on the GPU) the buffer is a
+    # tensor (see my_bufalloc), and must use the same layout as my_bufunpack
+    if pyApp.use_cuda or pyApp.user_mpi_buf:
       return my_bufpack_cuda(app, u, buffer, tidx, level)
     else:
       return my_bufpack_cpu(app, u, buffer, tidx, level)
@@ -295,7 +297,8 @@ cdef int my_bufpack_cuda(braid_App app, braid_Vector u, void *buffer,int tidx, i
         start += size
 
       # finish the data movement
-      torch.cuda.synchronize()
+      if pyApp.use_cuda:
+        torch.cuda.synchronize()
 
   except:
     output_exception(f"my_bufpack_cuda: time index = {tidx}, level = {level}")
@@ -312,7 +315,7 @@ cdef int my_bufunpack(braid_App app, void *buffer, braid_Vector *u_ptr,braid_Buf
   pyApp = <object> app
 
   try:
-    if pyApp.use_cuda:
+    if pyApp.use_cuda or pyApp.user_mpi_buf:
       result = my_bufunpack_cuda(app, buffer, u_ptr,tidx, level)
     else:
       result = my_bufunpack_cpu(app, buffer, u_ptr,tidx, level)
@@ -334,17 +337,19 @@ cdef int my_bufunpack_cuda(braid_App app, void *buffer, braid_Vector *u_ptr,int
       size_vt = pyApp.getFeatureShapes(tidx,level)
       size_wt = pyApp.getParameterShapes(tidx,level)
 
+      # the vector uses the buffer memory directly, xbraid is done with
+      # the buffer after unpacking (see my_buffree)
       vt = []
       start = 0
       for s in size_vt:
         size = s.numel()
-        vt.append(torch.reshape(app_buffer[start:start+size].detach().clone(), s))
+        vt.append(app_buffer[start:start+size].view(s))
         start += size
 
       wt = []
       for s in size_wt:
         size = s.numel()
-        wt.append(torch.reshape(app_buffer[start:start+size].detach().clone(), s))
+        wt.append(app_buffer[start:start+size].view(s))
         start += size
 
       u_obj = BraidVector(tensor = vt, send_flag = True)
@@ -355,7 +360,8 @@ cdef int my_bufunpack_cuda(braid_App app, void *buffer, braid_Vector *u_ptr,int
       u_ptr[0] = <braid_Vector> u_obj
 
       # finish data movement (this one might not be neccessary)
-      torch.cuda.synchronize()
+      if pyApp.use_cuda:
+        torch.cuda.synchronize()
   except:
     output_exception("my_bufunpack_gpu")
 
@@ -436,17 +442,17 @@ cdef int my_bufalloc(braid_App app, void **buffer, int nbytes, braid_BufferStatu
 
   pyApp = <object>app
 
-  if pyApp.use_cuda:
-    # convert nbytes to number of elements
-    elements = math.ceil(nbytes / get_bytes(__float_alloc_type__))
+  # the buffers are tensors (on the device, or the host), so a received
+  # vector can be unpacked without copying
+  elements = math.ceil(nbytes / get_bytes(__float_alloc_type__))
+  device = 'cuda' if pyApp.use_cuda else 'cpu'
 
-    addr = pyApp.addBufferEntry(tensor=torch.empty(elements, dtype=__float_alloc_type__, device='cuda'))
+  addr = pyApp.addBufferEntry(tensor=torch.empty(elements, dtype=__float_alloc_type__, device=device))
 
-    buffer[0]=<void *> addr
+  buffer[0]=<void *> addr
 
+  if pyApp.use_cuda:
     torch.cuda.synchronize()
-  else:
-    buffer[0] = malloc(nbytes)
 
   return 0
 
@@ -454,12 +460,11 @@ cdef int my_buffree(braid_App app, void **buffer):
   cdef uintptr_t addr
 
   pyApp = <object> app
-  if pyApp.use_cuda:
-    addr = <uintptr_t> buffer[0]
-    pyApp.removeBufferEntry(addr=addr)
 
-  else:
-    free(buffer[0])
-    buffer[0] = NULL
+  # unpacked vectors may still hold views of the buffer, so drop the
+  # reference and let torch release the memory
+  addr = <uintptr_t> buffer[0]
+  pyApp.removeBufferEntry(addr=addr)
+  buffer[0] = NULL
 
   return 0
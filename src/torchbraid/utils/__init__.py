@@ -39,6 +39,19 @@ from .gittools import git_rev
 # import bufpackunpack tools
 from .bufpackunpack import buffer_size, pack_buffer, unpack_buffer
 
+# import the compiled step cache
+from .compile_cache import StepCompileCache
+
+# import the shape encoding for buffer based communication
+from .shape_buffer import encode_shapes, decode_shapes, empty_shape_buffer
+
+# import the rank aware loader for layer parallel training
+from .lp_data_loader import LPDataLoader
+
+from .placement import place_rank, node_communicator
+
+from .comm_backend import MPIBackend, TorchDistBackend
+
 try:
   # use the global one
   from mpi4py import MPI
@@ -120,12 +133,15 @@ def getDevice(comm):
   """
   Returns the host and serial device for this processor.
 
-  Only works on a single node at the moment (easy to change, use modulo arithmetic).
+  GPUs are assigned by the rank on the node (this assumes all nodes have the
+  same number of devices). See place_rank to also assign the cores and threads.
   """
   my_host    = torch.device('cpu')
   if torch.cuda.is_available(): 
+    local = node_communicator(comm)
     dev_cnt = torch.cuda.device_count() # this assumes all nodes have the same number of devices
-    dev_rank = comm.Get_rank() % dev_cnt
+    dev_rank = local.Get_rank() % dev_cnt
+    local.Free()
     if comm.Get_rank()==0:
       print('Using GPU Device')
     my_device  = torch.device(f'cuda:{dev_rank}')
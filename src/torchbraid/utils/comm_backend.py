@@ -0,0 +1,209 @@
+#@HEADER
+# ************************************************************************
+#
+#                        Torchbraid v. 0.1
+#
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+#
+# Torchbraid is licensed under 3-clause BSD terms of use:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name National Technology & Engineering Solutions of Sandia,
+# LLC nor the names of the contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+#
+# ************************************************************************
+#@HEADER
+
+import torch
+
+try:
+  from mpi4py import MPI
+except:
+  from .fake_mpi import MPI
+
+class CommRequest:
+  """
+  A non-blocking communication, wait() completes it. The finish function
+  (if any) is called after the communication completes, for instance to
+  copy a staging buffer back.
+  """
+
+  def __init__(self,requests,finish=None):
+    self.requests = requests
+    self.finish = finish
+
+  def wait(self):
+    for r in self.requests:
+      r.wait()
+    self.requests = []
+    if self.finish is not None:
+      self.finish()
+      self.finish = None
+# end CommRequest
+
+class _MPIRequest:
+  def __init__(self,request,buffers=()):
+    self.request = request
+    self.buffers = buffers # kept alive until the communication completes
+
+  def wait(self):
+    self.request.Wait()
+    self.buffers = ()
+
+class MPIBackend:
+  """
+  Communication of torch tensors through mpi4py (buffer based calls).
+
+  If gpu_aware is False device tensors are staged through the host,
+  otherwise they are handed to MPI directly.
+  """
+
+  def __init__(self,comm,gpu_aware=False):
+    self.comm = comm
+    self.gpu_aware = gpu_aware
+
+  def getRank(self):
+    return self.comm.Get_rank()
+
+  def getSize(self):
+    return self.comm.Get_size()
+
+  def stage(self,tensor):
+    if tensor.device.type=='cpu':
+      return tensor
+    if self.gpu_aware:
+      torch.cuda.synchronize()
+      return tensor
+    return tensor.cpu()
+
+  def bcast(self,tensor,root=0):
+    buf = self.stage(tensor)
+    self.comm.Bcast(buf,root=root)
+    if buf is not tensor:
+      tensor.copy_(buf)
+
+  def isend(self,tensor,dest,tag=0):
+    buf = self.stage(tensor.contiguous())
+    return CommRequest([_MPIRequest(self.comm.Isend(buf,dest=dest,tag=tag),(buf,))])
+
+  def irecv(self,tensor,source,tag=0):
+    buf = self.stage(tensor)
+    finish = None if buf is tensor else (lambda: tensor.copy_(buf))
+    return CommRequest([_MPIRequest(self.comm.Irecv(buf,source=source,tag=tag),(buf,))],finish)
+
+  def allreduce(self,tensor,async_op=False):
+    """
+    Sum tensor over the processors, in place.
+    """
+    buf = self.stage(tensor)
+    finish = None if buf is tensor else (lambda: tensor.copy_(buf))
+    req = CommRequest([_MPIRequest(self.comm.Iallreduce(MPI.IN_PLACE,buf,MPI.SUM),(buf,))],finish)
+    if async_op:
+      return req
+    req.wait()
+
+  def barrier(self):
+    self.comm.Barrier()
+# end MPIBackend
+
+class _DistRequest:
+  def __init__(self,work):
+    self.work = work
+
+  def wait(self):
+    self.work.wait()
+
+class TorchDistBackend:
+  """
+  Communication of torch tensors through torch.distributed, for instance
+  with the gloo backend on the host or NCCL on the GPU. The process group
+  must be initialized (torch.distributed.init_process_group) and, when used
+  for a layer parallel module, rank the processors as its MPI communicator does.
+
+  If the group can't communicate host tensors (NCCL), they are staged
+  through device.
+  """
+
+  def __init__(self,group=None,device=None):
+    import torch.distributed as dist
+
+    assert dist.is_initialized(), 'torch.distributed must be initialized to use TorchDistBackend'
+
+    self.dist = dist
+    self.group = group
+    self.device = device
+    self.stage_host = device is not None and dist.get_backend(group)=='nccl'
+
+  def getRank(self):
+    return self.dist.get_rank(self.group)
+
+  def getSize(self):
+    return self.dist.get_world_size(self.group)
+
+  def globalRank(self,rank):
+    if self.group is None:
+      return rank
+    return self.dist.get_global_rank(self.group,rank)
+
+  def stage(self,tensor):
+    if self.stage_host and tensor.device.type=='cpu':
+      return tensor.to(self.device)
+    return tensor
+
+  def bcast(self,tensor,root=0):
+    buf = self.stage(tensor)
+    self.dist.broadcast(buf,self.globalRank(root),group=self.group)
+    if buf is not tensor:
+      tensor.copy_(buf)
+
+  def isend(self,tensor,dest,tag=0):
+    buf = self.stage(tensor.contiguous())
+    work = self.dist.isend(buf,self.globalRank(dest),group=self.group,tag=tag)
+    return CommRequest([_DistRequest(work)])
+
+  def irecv(self,tensor,source,tag=0):
+    buf = self.stage(tensor)
+    work = self.dist.irecv(buf,self.globalRank(source),group=self.group,tag=tag)
+    finish = None if buf is tensor else (lambda: tensor.copy_(buf))
+    return CommRequest([_DistRequest(work)],finish)
+
+  def allreduce(self,tensor,async_op=False):
+    """
+    Sum tensor over the processors, in place.
+    """
+    buf = self.stage(tensor)
+    work = self.dist.all_reduce(buf,group=self.group,async_op=True)
+    finish = None if buf is tensor else (lambda: tensor.copy_(buf))
+    req = CommRequest([_DistRequest(work)],finish)
+    if async_op:
+      return req
+    req.wait()
+
+  def barrier(self):
+    self.dist.barrier(group=self.group)
+# end TorchDistBackend
+
+def as_backend(comm,gpu_aware=True):
+  """
+  Return comm if it is a communication backend, otherwise wrap the
+  MPI communicator in an MPIBackend. The data parallel reductions have
+  always handed device tensors to MPI, so gpu_aware defaults to True here.
+  """
+  if isinstance(comm,(MPIBackend,TorchDistBackend)):
+    return comm
+  return MPIBackend(comm,gpu_aware=gpu_aware)
@@ -0,0 +1,111 @@
+#@HEADER
+# ************************************************************************
+#
+#                        Torchbraid v. 0.1
+#
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+#
+# Torchbraid is licensed under 3-clause BSD terms of use:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name National Technology & Engineering Solutions of Sandia,
+# LLC nor the names of the contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+#
+# ************************************************************************
+#@HEADER
+
+import torch
+import warnings
+
+def _step(layer,dt,x):
+  return layer(dt,x)
+
+class StepCompileCache:
+  """
+  Cache of torch.compile'd time step evaluations.
+
+  Entries are keyed by (block type, shape, dtype, level, training, grad enabled).
+  For each (block type, level, training, grad enabled) family at most max_shapes
+  distinct shapes are compiled, any other shape falls back to the eager
+  step. If compilation (or a compiled call) fails, a warning is issued and
+  the entry also falls back to eager so the solve can proceed.
+  """
+
+  def __init__(self,max_shapes=1,**compile_kwargs):
+    self.max_shapes = max_shapes
+    self.compile_kwargs = compile_kwargs
+
+    self.entries = dict()
+    self.shape_counts = dict()
+    self.resetStats()
+
+  def resetStats(self):
+    self.stats = {'hits': 0, 'misses': 0, 'fallbacks': 0, 'failures': 0}
+
+  def getStats(self):
+    """
+    Return a dictionary with the number of compiled entries, the number of
+    calls through an already compiled entry (hits), calls that compiled a new
+    entry (misses), eager calls (fallbacks) and compile failures.
+    """
+    stats = dict(self.stats)
+    stats['entries'] = len([f for f in self.entries.values() if f is not None])
+    return stats
+
+  def compileFailed(self,key,err):
+    warnings.warn('compiled step failed, falling back to eager: {}'.format(err))
+    self.stats['failures'] += 1
+    self.entries[key] = None
+
+  def __call__(self,block,layer,level,dt,x):
+    """
+    Evaluate layer(dt,x), through a compiled function when possible.
+
+    block: integer identifying the layer block type
+    layer: the step module
+    level: the level in the braid hierarchy
+    """
+    grad_enabled = torch.is_grad_enabled()
+    key = (block,tuple(x.shape),x.dtype,level,layer.training,grad_enabled)
+
+    new_entry = key not in self.entries
+    if new_entry:
+      family = (block,level,layer.training,grad_enabled)
+      count = self.shape_counts.get(family,0)
+      if count<self.max_shapes:
+        self.shape_counts[family] = count+1
+        try:
+          self.entries[key] = torch.compile(_step,**self.compile_kwargs)
+        except Exception as err:
+          self.compileFailed(key,err)
+      else:
+        # shape changed, use the eager path
+        self.entries[key] = None
+
+    compiled = self.entries[key]
+    if compiled is not None:
+      try:
+        result = compiled(layer,dt,x)
+        self.stats['misses' if new_entry else 'hits'] += 1
+        return result
+      except Exception as err:
+        self.compileFailed(key,err)
+
+    self.stats['fallbacks'] += 1
+    return layer(dt,x)
+# end StepCompileCache
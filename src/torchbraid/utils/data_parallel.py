@@ -30,9 +30,12 @@
 # @HEADER
 
 import numpy as np
+import torch
 
 from mpi4py import MPI
 
+from .comm_backend import as_backend
+
 
 def split_communicator(comm: MPI.Comm, splitting: int):
   """
@@ -57,11 +60,305 @@ def split_communicator(comm: MPI.Comm, splitting: int):
 
 def average_gradients(model, comm_dp):
   """
-  Averages gradients for comm_dp
+  Averages gradients for comm_dp (an MPI communicator or a communication backend)
   """
+  comm = as_backend(comm_dp)
   for param in model.parameters():
-    comm_dp.Allreduce(MPI.IN_PLACE, param.grad.data, op=MPI.SUM)
-    param.grad.data /= float(comm_dp.Get_size())
+    comm.allreduce(param.grad.data)
+    param.grad.data /= float(comm.getSize())
+
+
+class _GradBucket(object):
+  """
+  A group of parameters whose gradients are averaged with one reduction.
+  If flat is given it is a view backing the gradients (and is reduced in
+  place), otherwise the gradients are packed into a buffer.
+  """
+  def __init__(self, items, params, flat=None):
+    self.items = items
+    self.params = params
+    self.flat = flat
+    self.ready = set()
+    self.request = None
+    self.buffer = None
+
+  def launch(self, comm, use_cuda):
+    if self.flat is not None:
+      self.buffer = self.flat
+    else:
+      ref = self.params[0]
+      self.buffer = torch.empty(sum([p.numel() for p in self.params]), dtype=ref.dtype, device=ref.device)
+      offset = 0
+      for p in self.params:
+        n = p.numel()
+        if p.grad is None:
+          self.buffer[offset:offset + n].zero_()
+        else:
+          self.buffer[offset:offset + n].copy_(p.grad.reshape(-1))
+        offset += n
+
+    self.buffer.div_(float(comm.getSize()))
+    if use_cuda:
+      torch.cuda.synchronize()
+    self.request = comm.allreduce(self.buffer, async_op=True)
+
+  def complete(self):
+    self.request.wait()
+    if self.flat is None:
+      offset = 0
+      for p in self.params:
+        n = p.numel()
+        if p.grad is not None:
+          p.grad.copy_(self.buffer[offset:offset + n].view_as(p.grad))
+        offset += n
+    self.request = None
+    self.buffer = None
+    self.ready = set()
+
+
+class GradientReducer(object):
+  """
+  Averages gradients over comm_dp while the backward pass is still running,
+  instead of after it (see average_gradients).
+
+  Parameters are grouped into buckets of about bucket_mb megabytes, and a
+  non-blocking reduction is started for a bucket as soon as all of its
+  gradients are final:
+
+  - The layers of a LayerParallel module are bucketed in layer order. A
+    layer's gradient is final after its step in the last relaxation sweep of
+    the backward solve, so the reductions overlap with the rest of the solve
+    (they are completed when the solve ends). The buckets are slices of the
+    flat gradient buffer of the solve, so nothing is packed.
+  - Any other parameter (e.g. the open and close layers on rank 0) is
+    bucketed in reverse order, and its gradient is final when autograd has
+    accumulated it.
+
+  Call finish() after the backward pass, before the optimizer step:
+
+    reducer = GradientReducer(model, comm_dp)
+    ...
+    loss.backward()
+    reducer.finish()
+    optimizer.step()
+
+  As with average_gradients, every processor in comm_dp must compute the
+  gradients of the same parameters.
+  """
+
+  def __init__(self, model, comm_dp, bucket_mb=25.0, use_cuda=False):
+    """
+    :param model: Module whose gradients are averaged
+    :param comm_dp: Data parallel communicator (or a communication backend, see comm_backend)
+    :param bucket_mb: Approximate bucket size in megabytes
+    :param use_cuda: Synchronize the device before starting a reduction
+    """
+    self.comm_dp = as_backend(comm_dp)
+    self.bucket_bytes = int(bucket_mb * 2 ** 20)
+    self.use_cuda = use_cuda
+
+    # the layer parallel modules do their own bookkeeping
+    self.lp_modules = [m for m in model.modules() if hasattr(m, 'setGradientReducer')]
+    for m in self.lp_modules:
+      m.setGradientReducer(self)
+    self.layer_buckets = dict()
+    self.solving = set()
+    self.reduced = set()
+
+    # buckets for the parameters reduced when autograd accumulates them, gradients
+    # arrive roughly in reverse order. The layer parallel parameters are only reduced
+    # here if the backward solve didn't (e.g. in the pipelined execution mode).
+    lp_params = [[p for p in m.parameters() if p.requires_grad] for m in self.lp_modules]
+    lp_ids = set([id(p) for params in lp_params for p in params])
+    params = [p for p in model.parameters() if p.requires_grad and id(p) not in lp_ids]
+    self.buckets = self.makeBuckets(list(reversed(params)), lambda p: [p])
+    for params in lp_params:
+      self.buckets += self.makeBuckets(list(reversed(params)), lambda p: [p])
+    self.param_bucket = dict()
+    self.handles = []
+    for bucket in self.buckets:
+      for p in bucket.params:
+        self.param_bucket[id(p)] = bucket
+        self.handles += [p.register_post_accumulate_grad_hook(self.paramGradReady)]
+
+  def makeBuckets(self, items, item_params, flat=None):
+    """
+    Group items (parameters or layers) into buckets. If flat is given the
+    parameters of the items are laid out consecutively in it.
+    """
+    buckets = []
+    current = []
+    current_bytes = 0
+    offset = 0
+    start = 0
+    for item in items:
+      nbytes = sum([p.numel() * p.element_size() for p in item_params(item)])
+      if len(current) > 0 and current_bytes + nbytes > self.bucket_bytes:
+        buckets += [(current, start, offset)]
+        current = []
+        current_bytes = 0
+        start = offset
+      current += [item]
+      current_bytes += nbytes
+      offset += sum([p.numel() for p in item_params(item)])
+    if len(current) > 0:
+      buckets += [(current, start, offset)]
+
+    return [_GradBucket(items, [p for item in items for p in item_params(item)],
+                        flat[start:end] if flat is not None else None) for items, start, end in buckets]
+
+  def paramGradReady(self, param):
+    if id(param) in self.solving:
+      # accumulated inside the backward solve, which does the reduction
+      return
+    if id(param) in self.reduced:
+      # already reduced by the backward solve
+      self.reduced.discard(id(param))
+      return
+    bucket = self.param_bucket[id(param)]
+    bucket.ready.add(id(param))
+    if len(bucket.ready) == len(bucket.params):
+      bucket.launch(self.comm_dp, self.use_cuda)
+
+  def beginLayerGrads(self, bwd_app):
+    """
+    Called by a BackwardODENetApp before the backward solve, once the
+    gradient buffer of the solve is attached.
+    """
+    layers = [l for l in bwd_app.fwd_app.layer_models if l is not None]
+    trainable = lambda l: [p for p in l.parameters() if p.requires_grad]
+    buckets = self.makeBuckets([l for l in layers if len(trainable(l)) > 0], trainable, bwd_app.grad_buffer)
+
+    layer_bucket = dict()
+    for bucket in buckets:
+      for l in bucket.items:
+        layer_bucket[id(l)] = bucket
+    self.layer_buckets[id(bwd_app)] = (buckets, layer_bucket)
+    self.solving.update([id(p) for bucket in buckets for p in bucket.params])
+
+  def layerGradReady(self, bwd_app, layer):
+    """
+    Called by a BackwardODENetApp when the gradient of a layer is final.
+    """
+    buckets, layer_bucket = self.layer_buckets[id(bwd_app)]
+    bucket = layer_bucket.get(id(layer))
+    if bucket is None or bucket.request is not None:
+      return
+    bucket.ready.add(id(layer))
+    if len(bucket.ready) == len(bucket.items):
+      bucket.launch(self.comm_dp, self.use_cuda)
+
+  def endLayerGrads(self, bwd_app):
+    """
+    Called by a BackwardODENetApp after the backward solve, starts any
+    remaining reductions and completes them all.
+    """
+    buckets, layer_bucket = self.layer_buckets.pop(id(bwd_app))
+    for bucket in buckets:
+      if bucket.request is None:
+        bucket.launch(self.comm_dp, self.use_cuda)
+    for bucket in buckets:
+      bucket.complete()
+      self.solving.difference_update([id(p) for p in bucket.params])
+      self.reduced.update([id(p) for p in bucket.params])
+
+  def finish(self):
+    """
+    Complete the reductions, the gradients are averaged on return.
+    """
+    for bucket in self.buckets:
+      if bucket.request is None and len(bucket.ready) > 0:
+        # some parameters were not used in this backward pass
+        bucket.launch(self.comm_dp, self.use_cuda)
+    for bucket in self.buckets:
+      if bucket.request is not None:
+        bucket.complete()
+    self.reduced = set()
+
+  def remove(self):
+    """
+    Remove the hooks, this stops the reducer.
+    """
+    for h in self.handles:
+      h.remove()
+    self.handles = []
+    for m in self.lp_modules:
+      m.setGradientReducer(None)
+
+
+def partition_indices(num_samples, procs, rank, batch_size, seed, epoch=0, shuffle=True):
+  """
+  Compute the sample indices of one processor. The indices are shuffled
+  (from seed+epoch, so all processors agree) and dealt out to the processors
+  in consecutive blocks of batch_size. Only the indices of rank are kept.
+  :param num_samples: Number of samples in the data set
+  :param procs: Number of data parallel processors
+  :param rank: Data parallel rank
+  :param batch_size: Size of the blocks dealt to each processor
+  :param seed: Seed for the shuffle
+  :param epoch: Epoch, changes the shuffle
+  :param shuffle: Shuffle the indices
+  :return: Numpy array of indices
+  """
+  if shuffle:
+    indices = np.random.RandomState(seed + epoch).permutation(num_samples)
+  else:
+    indices = np.arange(num_samples)
+
+  # positions of the blocks owned by rank
+  num_blocks = (num_samples + batch_size - 1) // batch_size
+  positions = (np.arange(rank, num_blocks, procs)[:, None] * batch_size + np.arange(batch_size)).reshape(-1)
+  return indices[positions[positions < num_samples]]
+
+
+def partition_size(num_samples, procs, rank, batch_size):
+  """
+  Number of indices returned by partition_indices, without computing them.
+  """
+  num_blocks = (num_samples + batch_size - 1) // batch_size
+  owned = len(range(rank, num_blocks, procs))
+  if owned > 0 and (num_blocks - 1) % procs == rank:
+    # the last block may be partial
+    return (owned - 1) * batch_size + num_samples - (num_blocks - 1) * batch_size
+  return owned * batch_size
+
+
+class PartitionSampler(torch.utils.data.Sampler):
+  """
+  Sampler drawing the partition of one data parallel processor, for use with
+  a standard DataLoader:
+
+    sampler = PartitionSampler(train_set, procs=size_dp, rank=rank_dp, seed=seed, batch_size=batch_size)
+    loader = torch.utils.data.DataLoader(train_set, batch_size=batch_size, sampler=sampler)
+    for epoch in range(epochs):
+      sampler.set_epoch(epoch)
+      ...
+
+  The partitions are reshuffled for each epoch. Only the indices of this
+  processor are kept.
+  """
+
+  def __init__(self, data, procs, rank, seed, batch_size, shuffle=True):
+    self.num_samples = len(data)
+    self.procs = procs
+    self.rank = rank
+    self.seed = seed
+    self.batch_size = batch_size
+    self.shuffle = shuffle
+    self.epoch = 0
+
+  def set_epoch(self, epoch):
+    self.epoch = epoch
+
+  def indices(self):
+    return partition_indices(self.num_samples, self.procs, self.rank, self.batch_size,
+                             self.seed, self.epoch, self.shuffle)
+
+  def __iter__(self):
+    return iter(self.indices().tolist())
+
+  def __len__(self):
+    return partition_size(self.num_samples, self.procs, self.rank, self.batch_size)
 
 
 class Partition(object):
@@ -73,23 +370,23 @@ class Partition(object):
     return len(self.index)
 
   def __getitem__(self, index):
-    data_idx = self.index[index]
+    data_idx = int(self.index[index])
     return self.data[data_idx]
 
 
 class Partioner(object):
   def __init__(self, data, procs, seed, batch_size):
-    def partion(iterable, start, select, skip):
-      return [x for i, x in enumerate(iterable[start:]) if i % (select + skip) < select]
-
     self.data = data
-    indices = np.arange(0, len(self.data))
-    np.random.seed(seed)
-    np.random.shuffle(indices)
-    self.partitions = [partion(indices,
-                               start=batch_size * i,
-                               select=batch_size,
-                               skip=batch_size * (procs - 1)) for i in range(procs)]
+    self.procs = procs
+    self.seed = seed
+    self.batch_size = batch_size
+
+  @property
+  def partitions(self):
+    return [self.get_indices(rank).tolist() for rank in range(self.procs)]
+
+  def get_indices(self, rank):
+    return partition_indices(len(self.data), self.procs, rank, self.batch_size, self.seed)
 
   def get_partion(self, rank):
-    return Partition(self.data, self.partitions[rank])
+    return Partition(self.data, self.get_indices(rank))
@@ -0,0 +1,155 @@
+#@HEADER
+# ************************************************************************
+#
+#                        Torchbraid v. 0.1
+#
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+#
+# Torchbraid is licensed under 3-clause BSD terms of use:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name National Technology & Engineering Solutions of Sandia,
+# LLC nor the names of the contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+#
+# ************************************************************************
+#@HEADER
+
+
+import torch
+
+def _describe(batch):
+  """
+  Describe the structure of a batch: a tensor is replaced by its shape and
+  type, a list or tuple is described element by element, anything else by None.
+  """
+  if isinstance(batch,torch.Tensor):
+    return (tuple(batch.shape),batch.dtype)
+  if isinstance(batch,(list,tuple)):
+    return [_describe(b) for b in batch]
+  return None
+
+def _placeholder(desc,batch_size,device):
+  """
+  Build a batch from a description, with batch_size samples (the first
+  dimension). The tensors have the right shape and type but no storage (all
+  elements alias a single zero on device).
+  """
+  if desc is None:
+    return None
+  if isinstance(desc,list):
+    return [_placeholder(d,batch_size,device) for d in desc]
+  shape,dtype = desc
+  if len(shape)>0:
+    shape = (batch_size,)+shape[1:]
+  return torch.zeros((),dtype=dtype,device=device).expand(shape)
+
+def _batch_size(desc):
+  """
+  The number of samples (first dimension) of the first tensor in a described batch.
+  """
+  if isinstance(desc,list):
+    sizes = [_batch_size(d) for d in desc]
+    return next((s for s in sizes if s is not None),None)
+  if desc is None or len(desc[0])==0:
+    return None
+  return desc[0][0]
+
+def _final_batch_size(loader,count,first_size):
+  """
+  The number of samples in the last batch of a torch DataLoader (which is
+  smaller if the batch size doesn't divide the dataset). Other loaders are
+  assumed to produce batches of the same size.
+  """
+  batch_size = getattr(loader,'batch_size',None)
+  sampler = getattr(loader,'sampler',None)
+  if first_size is None or batch_size is None or sampler is None or getattr(loader,'drop_last',False):
+    return first_size
+  try:
+    return len(sampler)-(count-1)*batch_size
+  except TypeError:
+    return first_size
+
+class LPDataLoader:
+  """
+  Wrap a data loader so it is only run on the layer parallel processors that
+  consume data, by default rank 0, which evaluates the open layer and the loss.
+  The other processors get placeholder batches, with the shape and type of
+  the batches but no data, and never iterate the wrapped loader. So no
+  samples are read, decoded or augmented there. The placeholders are built
+  on device, moving them to another device would allocate and copy the full
+  batch. For instance:
+
+    train_loader = LPDataLoader(torch.utils.data.DataLoader(train_set,batch_size=50),comm,device=device)
+    for data,target in train_loader:
+      output = model(data.to(device))
+      loss = compose(criterion,output,target.to(device))
+      ...
+
+  The number of batches, the structure of a batch and the size of the last
+  batch are broadcast from the first consumer at the start of each pass. If there is more than one
+  consumer (e.g. the loss is evaluated on the last rank), their loaders must
+  produce the same batches.
+  """
+
+  def __init__(self,loader,comm,ranks=(0,),device=None):
+    """
+    loader: The data loader (any iterable with a length)
+    comm: The layer parallel communicator
+    ranks: Ranks that consume data, negative ranks count from the end
+    device: Device of the placeholder batches (the host by default)
+    """
+    self.loader = loader
+    self.comm = comm
+    self.device = device
+
+    num_ranks = comm.Get_size()
+    self.ranks = sorted(set([r % num_ranks for r in ranks]))
+    self.root = self.ranks[0]
+    self.consumer = comm.Get_rank() in self.ranks
+
+  @property
+  def dataset(self):
+    return self.loader.dataset
+
+  def __len__(self):
+    return len(self.loader)
+
+  def __iter__(self):
+    if self.comm.Get_rank()==self.root:
+      itr = iter(self.loader)
+      first = next(itr,None)
+      count = len(self.loader) if first is not None else 0
+      desc = _describe(first)
+      final = _final_batch_size(self.loader,count,_batch_size(desc))
+      self.comm.bcast((count,desc,final),root=self.root)
+
+      if first is not None:
+        yield first
+        yield from itr
+    else:
+      count,desc,final = self.comm.bcast(None,root=self.root)
+      if self.consumer:
+        yield from self.loader
+      else:
+        batch = _placeholder(desc,_batch_size(desc),self.device)
+        for i in range(count-1):
+          yield batch
+        if count>0:
+          yield _placeholder(desc,final,self.device)
+  # end __iter__
+# end LPDataLoader
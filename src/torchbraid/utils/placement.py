@@ -0,0 +1,148 @@
+#@HEADER
+# ************************************************************************
+#
+#                        Torchbraid v. 0.1
+#
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+#
+# Torchbraid is licensed under 3-clause BSD terms of use:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name National Technology & Engineering Solutions of Sandia,
+# LLC nor the names of the contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+#
+# ************************************************************************
+#@HEADER
+
+import os
+import torch
+
+try:
+  from mpi4py import MPI
+except:
+  from .fake_mpi import MPI
+
+def node_communicator(comm):
+  """
+  Split comm into communicators of the processors sharing a node.
+  """
+  return comm.Split_type(MPI.COMM_TYPE_SHARED,key=comm.Get_rank())
+
+def assign_cores(affinities,node_rank):
+  """
+  Choose the cores of a processor from the CPU affinities of all the processors
+  on its node (a list of lists, indexed by node local rank).
+
+  If the processor's affinity is disjoint from the others (e.g. it was bound
+  by the launcher) it is kept. Otherwise the cores of the node are divided
+  into contiguous blocks, one per processor.
+  """
+  mine = sorted(affinities[node_rank])
+  others = [set(a) for r,a in enumerate(affinities) if r!=node_rank]
+  if all([len(o.intersection(mine))==0 for o in others]):
+    return mine
+
+  cores = sorted(set().union(*[set(a) for a in affinities]))
+  num_procs = len(affinities)
+  if len(cores)<num_procs:
+    # more processors than cores, they have to share
+    return [cores[node_rank % len(cores)]]
+
+  block,extra = divmod(len(cores),num_procs)
+  start = node_rank*block+min(node_rank,extra)
+  return cores[start:start+block+(1 if node_rank<extra else 0)]
+
+def core_string(cores):
+  """
+  Compact string for a list of cores, e.g. [0,1,2,3,8] is '0-3,8'.
+  """
+  ranges = []
+  for c in sorted(cores):
+    if len(ranges)>0 and ranges[-1][1]==c-1:
+      ranges[-1][1] = c
+    else:
+      ranges += [[c,c]]
+  return ','.join([f'{a}' if a==b else f'{a}-{b}' for a,b in ranges])
+
+def placement_report(placements):
+  """
+  Format the placements returned by place_rank (gathered from all processors)
+  as a table.
+  """
+  lines = ['  rank  node                  local  device    threads  cores']
+  for p in placements:
+    lines += ['  {rank:<5d} {node:<21s} {local:<6s} {device:<9s} {threads:<8d} {cores}'.format(
+              rank=p['rank'],node=p['node'],local=f"{p['node_rank']}/{p['node_size']}",
+              device=p['device'],threads=p['threads'],cores=core_string(p['cores']))]
+  return '\n'.join(lines)
+
+def place_rank(comm,num_threads=None,pin=True,use_gpu=True,report=False):
+  """
+  Place this processor on its node: choose its device, the cores it runs on
+  and the number of threads torch uses. This is collective over comm.
+
+  The processors sharing a node are found with Split_type. GPUs are assigned by
+  node local rank, and the cores of the node are divided between its processors
+  (see assign_cores), so several processors per node don't oversubscribe the
+  cores with torch's thread pools.
+
+  num_threads: Number of torch threads, by default the number of cores of this processor
+  pin: Set the CPU affinity of this processor to its cores
+  use_gpu: Use a GPU if one is available
+  report: Print a table of the placement of all processors on the root
+
+  Returns the device, the host, and a dictionary describing the placement.
+  """
+  local = node_communicator(comm)
+  node_rank = local.Get_rank()
+  node_size = local.Get_size()
+
+  if hasattr(os,'sched_getaffinity'):
+    affinity = sorted(os.sched_getaffinity(0))
+  else:
+    affinity = list(range(os.cpu_count()))
+  cores = assign_cores(local.allgather(affinity),node_rank)
+  local.Free()
+
+  if pin and hasattr(os,'sched_setaffinity'):
+    os.sched_setaffinity(0,cores)
+
+  threads = num_threads if num_threads is not None else len(cores)
+  torch.set_num_threads(threads)
+
+  host = torch.device('cpu')
+  device = host
+  if use_gpu and torch.cuda.is_available():
+    device = torch.device(f'cuda:{node_rank % torch.cuda.device_count()}')
+    torch.cuda.set_device(device)
+
+  placement = {'rank': comm.Get_rank(),
+               'node': MPI.Get_processor_name(),
+               'node_rank': node_rank,
+               'node_size': node_size,
+               'device': str(device),
+               'threads': threads,
+               'cores': cores}
+
+  if report:
+    placements = comm.gather(placement,root=0)
+    if comm.Get_rank()==0:
+      print(placement_report(placements))
+
+  return device,host,placement
+# end place_rank
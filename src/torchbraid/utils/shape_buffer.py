@@ -0,0 +1,89 @@
+#@HEADER
+# ************************************************************************
+#
+#                        Torchbraid v. 0.1
+#
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+#
+# Torchbraid is licensed under 3-clause BSD terms of use:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name National Technology & Engineering Solutions of Sandia,
+# LLC nor the names of the contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+#
+# ************************************************************************
+#@HEADER
+
+import torch
+import numpy as np
+
+# fixed length of an encoded shape buffer, this is large
+# enough for a handful of tensors of moderate rank
+SHAPE_BUFFER_SIZE = 32
+
+_dtypes = [torch.float32, torch.float64, torch.float16, torch.bfloat16,
+           torch.int64, torch.int32, torch.int16, torch.int8, torch.uint8, torch.bool]
+
+def encode_shapes(shapes,dtype=torch.float32):
+  """
+  Encode a list of shapes, and a dtype, in a fixed size integer
+  array. This is suitable for uppercase (buffer based) MPI calls.
+
+  The layout is [dtype code, number of shapes, rank_0, dims_0..., rank_1, dims_1...]
+
+  shapes: A torch.Size, or a list of them
+  """
+
+  if isinstance(shapes,torch.Size):
+    shapes = [shapes]
+
+  values = [_dtypes.index(dtype), len(shapes)]
+  for s in shapes:
+    values += [len(s)] + list(s)
+
+  assert len(values)<=SHAPE_BUFFER_SIZE, 'too many shapes to encode in the shape buffer'
+
+  buf = np.zeros(SHAPE_BUFFER_SIZE,dtype=np.int64)
+  buf[0:len(values)] = values
+  return buf
+# end encode_shapes
+
+def decode_shapes(buf):
+  """
+  Decode a buffer produced by encode_shapes.
+
+  returns: A tuple with the list of torch.Size objects, and the dtype
+  """
+  dtype = _dtypes[int(buf[0])]
+  num_shapes = int(buf[1])
+
+  shapes = []
+  start = 2
+  for i in range(num_shapes):
+    rank = int(buf[start])
+    shapes += [torch.Size([int(d) for d in buf[start+1:start+1+rank]])]
+    start += rank+1
+
+  return shapes, dtype
+# end decode_shapes
+
+def empty_shape_buffer():
+  """
+  Allocate a receive buffer for encode_shapes.
+  """
+  return np.zeros(SHAPE_BUFFER_SIZE,dtype=np.int64)
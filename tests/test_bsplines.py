@@ -0,0 +1,73 @@
+#@HEADER
+# ************************************************************************
+# 
+#                        Torchbraid v. 0.1
+# 
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC 
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S. 
+# Government retains certain rights in this software.
+# 
+# Torchbraid is licensed under 3-clause BSD terms of use:
+# 
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+# 
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+# 
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+# 
+# 3. Neither the name National Technology & Engineering Solutions of Sandia, 
+# LLC nor the names of the contributors may be used to endorse or promote 
+# products derived from this software without specific prior written permission.
+# 
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+# 
+# ************************************************************************
+#@HEADER
+
+import unittest
+import faulthandler
+faulthandler.enable()
+
+import numpy as np
+
+from torchbraid.bsplines import BsplineBasis
+
+class TestBsplines(unittest.TestCase):
+
+  def test_evalMany(self):
+    Tf = 2.0
+    times = [i*Tf/64 for i in range(65)]
+
+    for degree,nsplines in [(1,5),(2,10),(3,8)]:
+      basis = BsplineBasis(nsplines,degree,Tf)
+      splines,ks = basis.eval_many(times)
+
+      self.assertEqual(splines.shape,(len(times),degree+1))
+      self.assertEqual(ks.shape,(len(times),))
+
+      # must match the single point evaluation
+      for t,s,k in zip(times,splines,ks):
+        s_ref,k_ref = basis.eval(t)
+        self.assertEqual(k,k_ref)
+        self.assertTrue(np.allclose(s,s_ref,rtol=0.0,atol=1e-15))
+
+      # partition of unity inside the domain
+      self.assertTrue(np.allclose(splines[:-1].sum(axis=1),1.0,rtol=0.0,atol=1e-14))
+
+  def test_evalMemoized(self):
+    basis = BsplineBasis(10,2,1.0)
+
+    s0,k0 = basis.eval(0.37)
+    s0[0] = -1.0 # modifying the result does not change the cache
+    s1,k1 = basis.eval(0.37)
+
+    self.assertEqual(k0,k1)
+    self.assertEqual(s1,basis.eval_uncached(0.37)[0])
+
+if __name__ == '__main__':
+  unittest.main()
@@ -36,9 +36,11 @@ import unittest
 import sys
 import numpy as np
 import statistics as stats
+import copy
 
 import torchbraid
 from torchbraid.utils import l2_reg, getDevice
+from torchbraid.lp_module import LPModule
 
 import faulthandler
 faulthandler.enable()
@@ -80,7 +82,7 @@ class StepLayer(nn.Module):
 # end layer
 
 class ParallelNet(nn.Module):
-  def __init__(self,channels=4,local_steps=2,Tf=1.0,max_levels=1,max_iters=1,print_level=0):
+  def __init__(self,channels=4,local_steps=2,Tf=1.0,max_levels=1,max_iters=1,print_level=0,close_on_last=False):
     super(ParallelNet, self).__init__()
 
     self.rank = MPI.COMM_WORLD.Get_rank()
@@ -96,10 +98,17 @@ class ParallelNet(nn.Module):
     self.parallel_nn.setCFactor(4)
     self.o = self.parallel_nn.comp_op() # get tool to build up composition neural networks
 
+    # the close layer is either on rank 0, or on the last rank
+    if close_on_last:
+      self.parallel_nn.setCloseOnLastRank()
+      self.o_close = self.parallel_nn.comp_op(rank=-1)
+    else:
+      self.o_close = self.o
+
     # in this case, because OpenLayer/CloseLayer are classes, these return None on processors
     # away from rank==0...this might be too cute
     self.open_nn  = self.o(OpenLayer,channels)
-    self.close_nn = self.o(CloseLayer,channels)
+    self.close_nn = self.o_close(CloseLayer,channels)
 
   def forward(self, x):
     o_ = self.o
@@ -107,7 +116,7 @@ class ParallelNet(nn.Module):
     # here o_ is ensuring the gradients are handled yet no code is executed on rank!=0
     x = o_(self.open_nn,x)
     x = self.parallel_nn(x) 
-    x = o_(self.close_nn,x)
+    x = self.o_close(self.close_nn,x)
 
     return x
 
@@ -128,11 +137,18 @@ class ParallelNet(nn.Module):
         remote_p = [p.to(device) for p in remote_p]
         params.extend(remote_p)
 
-      return params + [p.grad for p in list(self.open_nn.parameters())] \
-                    + [p.grad for p in list(self.close_nn.parameters())]
+      # the close layer may live on the last rank
+      if self.close_nn is not None:
+        close_grads = [p.grad for p in list(self.close_nn.parameters())]
+      else:
+        close_grads = comm.recv(source=num_proc-1,tag=78)
+        close_grads = [p.to(device) for p in close_grads]
+      return params + [p.grad for p in list(self.open_nn.parameters())] + close_grads
     else:
       params_cpu = [p.cpu() for p in params]
       comm.send(params_cpu,dest=0,tag=77)
+      if self.close_nn is not None:
+        comm.send([p.grad.cpu() for p in list(self.close_nn.parameters())],dest=0,tag=78)
       return None
   # end copyParametersToRoot
 # end ParallelNet
@@ -268,6 +284,102 @@ class TestTorchBraid(unittest.TestCase):
         self.assertTrue(val<=1e-7)
     #self.assertTrue(False)
   # end test_linearNet_Exact
+
+  def test_execPlaceholder(self):
+    # an operator away from its execution rank is not evaluated
+    o = LPModule.ExecLP(1,exec_rank=0)
+
+    calls = []
+    def op(a,b):
+      calls.append(1)
+      return a*b
+
+    x = torch.randn(3,4,requires_grad=True)
+    y = o(op,x,2.0)
+
+    self.assertEqual(len(calls),0)
+    self.assertEqual(y.shape,torch.Size([1]))
+    self.assertEqual(y.item(),0.0)
+    self.assertTrue(y.requires_grad)
+
+    # no gradient flows back to the arguments
+    y.backward()
+    self.assertTrue(x.grad is None)
+
+    w = torch.ones(2,requires_grad=True)
+    z = o(op,x,2.0,mgopt_term=(3.0*w).sum())
+    z.backward()
+    self.assertTrue(torch.equal(w.grad,-3.0*torch.ones(2)))
+
+    self.assertTrue(o(OpenLayer,1) is None)
+
+  def test_composite_closeOnLast(self):
+    comm = MPI.COMM_WORLD
+    my_rank = comm.Get_rank()
+    procs = comm.Get_size()
+
+    my_device,my_host = getDevice(comm)
+
+    criterion = nn.MSELoss()
+    criterion = criterion.to(my_device)
+
+    images   =  2
+    channels = 1
+    image_size = image_width
+    data = torch.randn(images,3,image_size,image_size,device=my_device)
+
+    # the target is used on the last rank
+    target = comm.bcast(torch.randn(images,target_size),root=0).to(my_device)
+
+    parallel_net = ParallelNet(channels=channels,close_on_last=True)
+    parallel_net = parallel_net.to(my_device)
+
+    # build the serial verson, the close layer comes from the last rank
+    serial_layers = parallel_net.parallel_nn.buildSequentialOnRoot()
+    if my_rank==procs-1:
+      close_nn = copy.deepcopy(parallel_net.close_nn).cpu()
+      if procs>1:
+        comm.send(close_nn,dest=0,tag=31)
+    if my_rank==0:
+      if procs>1:
+        close_nn = comm.recv(source=procs-1,tag=31)
+      serial_net = SerialNet(serial_layers,copy.deepcopy(parallel_net.open_nn),close_nn)
+      serial_net = serial_net.to(my_device)
+      serial_net.train()
+      serial_net.zero_grad()
+
+      s_output = serial_net(data)
+      s_loss = criterion(s_output, target)
+      s_loss.backward()
+    #######################
+
+    parallel_net.train()
+    parallel_net.zero_grad()
+
+    p_output = parallel_net(data)
+
+    # the loss is only computed on the last rank, then shared
+    p_loss = parallel_net.o_close(criterion,p_output,target)
+    p_loss.backward()
+    p_loss_value = parallel_net.parallel_nn.copyScalarFromRank(p_loss,rank=-1)
+
+    # the output is not communicated away from the last rank
+    if my_rank!=procs-1:
+      self.assertEqual(p_output.shape,torch.Size([1]))
+
+    p_grads = parallel_net.copyParameterGradToRoot(my_device)
+    if my_rank==0:
+      print('loss error: {} ?= {}'.format(p_loss_value,s_loss.item()))
+      self.assertTrue(abs(p_loss_value-s_loss.item())<=1e-6*abs(s_loss.item()))
+
+      s_grads = [p.grad for p in list(serial_net.parameters())]
+      self.assertEqual(len(s_grads),len(p_grads))
+      for s_grad,p_grad in zip(s_grads,p_grads):
+        val = torch.norm(s_grad-p_grad).item()
+        self.assertTrue(val<=1e-7)
+
+    comm.Barrier()
+  # end test_composite_closeOnLast
   
 
 if __name__ == '__main__':
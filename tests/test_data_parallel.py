@@ -29,9 +29,13 @@
 # ************************************************************************
 #@HEADER
 
+import torch
 import torchbraid.utils.data_parallel
+from torchbraid.utils.comm_backend import MPIBackend, TorchDistBackend
 import unittest
 
+from mpi4py import MPI
+
 res = {}
 res[(1, 2)] = [[3, 16, 6, 10, 2, 14, 4, 17, 7, 1, 13, 0, 19, 18, 9, 15, 8, 12, 11, 5]]
 res[(2, 2)] = [[3, 16, 2, 14, 7, 1, 19, 18, 8, 12], [6, 10, 4, 17, 13, 0, 9, 15, 11, 5]]
@@ -51,6 +55,119 @@ class TestDataParallel(unittest.TestCase):
         for rank in range(procs):
           self.assertListEqual(train_partition.partitions[rank], res[(procs,batch_size)][rank])
 
+  def test_sampler(self):
+    data = [[i] for i in range(23)]
+    for procs in range(1, 4):
+      for batch_size in [2, 5]:
+        samplers = [torchbraid.utils.data_parallel.PartitionSampler(data, procs=procs, rank=rank, seed=1, batch_size=batch_size)
+                    for rank in range(procs)]
+
+        # the first epoch matches the Partioner, later epochs are reshuffled
+        partioner = torchbraid.utils.data_parallel.Partioner(data=data, procs=procs, seed=1, batch_size=batch_size)
+        for rank, sampler in enumerate(samplers):
+          self.assertListEqual(list(sampler), partioner.partitions[rank])
+          self.assertEqual(len(sampler), len(list(sampler)))
+
+        for epoch in range(3):
+          for sampler in samplers:
+            sampler.set_epoch(epoch)
+          indices = [i for sampler in samplers for i in sampler]
+          self.assertListEqual(sorted(indices), list(range(len(data))))
+        self.assertNotEqual(list(samplers[0]), partioner.partitions[0])
+
+        loader = torch.utils.data.DataLoader(data, batch_size=batch_size, sampler=samplers[-1])
+        self.assertEqual(sum([len(b[0]) for b in loader]), len(samplers[-1]))
+
+  def test_gradientReducer(self):
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    torch.manual_seed(13)
+    model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.ReLU(), torch.nn.Linear(8, 2))
+
+    # small buckets so that there is more than one
+    reducer = torchbraid.utils.data_parallel.GradientReducer(model, comm, bucket_mb=1e-4)
+    self.assertGreater(len(reducer.buckets), 1)
+
+    # each processor gets a different sample
+    xs = [torch.randn(3, 4) for i in range(size)]
+    model(xs[rank]).sum().backward()
+    reducer.finish()
+    grads = [p.grad.clone() for p in model.parameters()]
+    reducer.remove()
+
+    # the average of the gradients of all the samples
+    model.zero_grad()
+    for x in xs:
+      (model(x).sum() / size).backward()
+
+    for g, p in zip(grads, model.parameters()):
+      self.assertTrue(torch.allclose(g, p.grad, atol=1e-6))
+
+  def test_commBackend(self):
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    backend = MPIBackend(comm, gpu_aware=False)
+    self.assertEqual(backend.getRank(), rank)
+    self.assertEqual(backend.getSize(), size)
+
+    t = torch.full((3,), float(rank))
+    backend.bcast(t, root=size - 1)
+    self.assertTrue(torch.equal(t, torch.full((3,), float(size - 1))))
+
+    a = torch.full((4,), float(rank + 1))
+    backend.allreduce(a, async_op=True).wait()
+    self.assertTrue(torch.equal(a, torch.full((4,), float(size * (size + 1) // 2))))
+
+    # the backend is accepted in place of the communicator
+    model = torch.nn.Linear(2, 3)
+    for p in model.parameters():
+      p.grad = torch.full(p.shape, float(rank + 1))
+    torchbraid.utils.data_parallel.average_gradients(model, backend)
+    for p in model.parameters():
+      self.assertTrue(torch.allclose(p.grad, torch.full(p.shape, (size + 1) / 2.0)))
+
+  def test_torchDistBackend(self):
+    import torch.distributed as dist
+
+    if not dist.is_available() or not dist.is_gloo_available():
+      self.skipTest('torch.distributed with gloo is not available')
+
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+    size = comm.Get_size()
+
+    # rank the gloo processes as the MPI communicator does
+    port = 29500 + (torch.randint(0, 1000, (1,)).item() if rank == 0 else 0)
+    port = comm.bcast(port, root=0)
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port), rank=rank, world_size=size)
+    try:
+      backend = TorchDistBackend()
+      self.assertEqual(backend.getRank(), rank)
+      self.assertEqual(backend.getSize(), size)
+
+      a = torch.full((4,), float(rank + 1))
+      backend.allreduce(a, async_op=True).wait()
+      self.assertTrue(torch.equal(a, torch.full((4,), float(size * (size + 1) // 2))))
+
+      t = torch.full((3,), float(rank))
+      backend.bcast(t, root=size - 1)
+      self.assertTrue(torch.equal(t, torch.full((3,), float(size - 1))))
+
+      # pass a tensor around a ring
+      if size > 1:
+        r = torch.zeros(2, 3)
+        recv = backend.irecv(r, (rank - 1) % size, tag=7)
+        send = backend.isend(torch.full((2, 3), float(rank)), (rank + 1) % size, tag=7)
+        recv.wait()
+        send.wait()
+        self.assertTrue(torch.equal(r, torch.full((2, 3), float((rank - 1) % size))))
+    finally:
+      dist.destroy_process_group()
+
 if __name__ == '__main__':
   unittest.main()
 
@@ -37,6 +37,7 @@ import sys
 import traceback
 import numpy as np
 import statistics as stats
+import copy
 
 import torchbraid
 
@@ -102,6 +103,121 @@ class TestGradUpdate(unittest.TestCase):
     self.backForwardProp(dim,basic_block,x0,w0,max_levels,max_iters,test_tol=1e-6,prefix='reLUNet_Approx')
   # end test_reLUNet_Approx
 
+  def test_asyncPipeline_NoStaleness(self):
+    dim = 2
+    basic_block = lambda: ReLUBlock(dim)
+    num_steps = 4*MPI.COMM_WORLD.Get_size()
+    lr = 1e-3
+
+    my_device,my_host = getDevice(MPI.COMM_WORLD)
+
+    m = torchbraid.LayerParallel(MPI.COMM_WORLD,basic_block,num_steps,Tf=2.0)
+    m = m.to(my_device)
+
+    rank = m.getMPIComm().Get_rank()
+
+    # the open and close layers live on rank 0
+    torch.manual_seed(rank)
+    if rank==0:
+      open_nn  = nn.Linear(3,dim).to(my_device)
+      close_nn = nn.Linear(dim,1).to(my_device)
+      params = list(m.parameters())+list(open_nn.parameters())+list(close_nn.parameters())
+    else:
+      open_nn  = None
+      close_nn = None
+      params = list(m.parameters())
+
+    # the reference is copied before training
+    f = m.buildSequentialOnRoot()
+    if rank==0:
+      f = nn.Sequential(copy.deepcopy(open_nn),f,copy.deepcopy(close_nn))
+
+    batches = [(torch.randn(5,3,device=my_device),torch.randn(5,1,device=my_device)) for i in range(4)]
+
+    criterion = nn.MSELoss()
+    optimizer = torch.optim.SGD(params,lr=lr)
+    trainer = torchbraid.AsyncPipelineTrainer(m,optimizer,criterion,open_nn=open_nn,close_nn=close_nn,max_staleness=0)
+    losses = trainer.train(batches)
+    trainer.close()
+
+    if rank==0:
+      optimizer = torch.optim.SGD(f.parameters(),lr=lr)
+      for (x,target),loss_m in zip(batches,losses):
+        optimizer.zero_grad()
+        loss_f = criterion(f(x),target)
+        loss_f.backward()
+        optimizer.step()
+
+        print('asyncPipeline: loss error = %.6e' % abs(loss_f.item()-loss_m))
+        self.assertTrue(abs(loss_f.item()-loss_m)<=1e-6*abs(loss_f.item()))
+
+      self.assertEqual(len(losses),len(batches))
+    else:
+      self.assertEqual(len(losses),0)
+
+    MPI.COMM_WORLD.barrier()
+  # end test_asyncPipeline_NoStaleness
+
+  def test_asyncPipeline_Staleness(self):
+    dim = 2
+    basic_block = lambda: ReLUBlock(dim)
+    num_steps = 4*MPI.COMM_WORLD.Get_size()
+    lr = 1e-2
+    epochs = 10
+
+    my_device,my_host = getDevice(MPI.COMM_WORLD)
+
+    torch.manual_seed(0)
+    batches = [(torch.randn(5,3,device=my_device),torch.randn(5,1,device=my_device)) for i in range(4)]
+
+    # train the same network synchronously and with overlapped (stale) batches
+    final_losses = []
+    for max_staleness in [0,2]:
+      m = torchbraid.LayerParallel(MPI.COMM_WORLD,basic_block,num_steps,Tf=2.0)
+      m = m.to(my_device)
+
+      # keep the growth through the layers moderate
+      with torch.no_grad():
+        for p in m.parameters():
+          p *= 0.1
+
+      rank = m.getMPIComm().Get_rank()
+
+      torch.manual_seed(rank)
+      if rank==0:
+        open_nn  = nn.Linear(3,dim).to(my_device)
+        close_nn = nn.Linear(dim,1).to(my_device)
+        params = list(m.parameters())+list(open_nn.parameters())+list(close_nn.parameters())
+      else:
+        open_nn  = None
+        close_nn = None
+        params = list(m.parameters())
+
+      criterion = nn.MSELoss()
+      optimizer = torch.optim.SGD(params,lr=lr)
+      trainer = torchbraid.AsyncPipelineTrainer(m,optimizer,criterion,open_nn=open_nn,close_nn=close_nn,max_staleness=max_staleness)
+
+      epoch_losses = []
+      for epoch in range(epochs):
+        losses = trainer.train(batches)
+        if rank==0:
+          self.assertEqual(len(losses),len(batches))
+          epoch_losses += [sum(losses)/len(losses)]
+      trainer.close()
+
+      if rank==0:
+        print('asyncPipeline: max_staleness = %d, loss %.6e -> %.6e' % (max_staleness,epoch_losses[0],epoch_losses[-1]))
+        self.assertTrue(epoch_losses[-1]<epoch_losses[0])
+        final_losses += [epoch_losses[-1]]
+    # end for max_staleness
+
+    # the stale updates don't set back the training much
+    if rank==0:
+      self.assertTrue(abs(final_losses[1]-final_losses[0])<=0.05*final_losses[0])
+
+    MPI.COMM_WORLD.barrier()
+  # end test_asyncPipeline_Staleness
+
   def copyParameterGradToRoot(self,m,device):
     comm     = m.getMPIComm()
     my_rank  = m.getMPIComm().Get_rank()
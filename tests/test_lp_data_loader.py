@@ -0,0 +1,106 @@
+#@HEADER
+# ************************************************************************
+#
+#                        Torchbraid v. 0.1
+#
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+#
+# Torchbraid is licensed under 3-clause BSD terms of use:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name National Technology & Engineering Solutions of Sandia,
+# LLC nor the names of the contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+#
+# ************************************************************************
+#@HEADER
+
+import torch
+import unittest
+
+from mpi4py import MPI
+
+from torchbraid.utils import LPDataLoader
+
+class TestLPDataLoader(unittest.TestCase):
+
+  def buildLoader(self,num_samples,batch_size):
+    torch.manual_seed(0)
+    data = torch.randn(num_samples,3,4)
+    target = torch.randint(0,10,(num_samples,))
+    dataset = torch.utils.data.TensorDataset(data,target)
+    return torch.utils.data.DataLoader(dataset,batch_size=batch_size,shuffle=False)
+
+  def checkPass(self,num_samples,batch_size):
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+
+    loader = self.buildLoader(num_samples,batch_size)
+    lp_loader = LPDataLoader(loader,comm,device=torch.device('cpu'))
+    self.assertEqual(len(lp_loader),len(loader))
+
+    # only rank 0 runs the wrapped loader
+    batches = list(lp_loader)
+    expected = list(loader)
+    self.assertEqual(len(batches),len(expected))
+
+    for (data,target),(e_data,e_target) in zip(batches,expected):
+      self.assertEqual(data.shape,e_data.shape)
+      self.assertEqual(data.dtype,e_data.dtype)
+      self.assertEqual(target.shape,e_target.shape)
+      self.assertEqual(target.dtype,e_target.dtype)
+
+      if rank==0:
+        self.assertTrue(torch.equal(data,e_data))
+        self.assertTrue(torch.equal(target,e_target))
+      else:
+        # placeholders, without storage for the batch
+        self.assertEqual(data.stride(),(0,0,0))
+        self.assertEqual(data.device,torch.device('cpu'))
+
+    comm.barrier()
+
+  def test_evenBatches(self):
+    self.checkPass(num_samples=12,batch_size=4)
+
+  def test_unevenBatches(self):
+    # the final batch is smaller
+    self.checkPass(num_samples=11,batch_size=4)
+
+  def test_singleBatch(self):
+    self.checkPass(num_samples=3,batch_size=4)
+
+  def test_consumerRanks(self):
+    comm = MPI.COMM_WORLD
+    rank = comm.Get_rank()
+
+    # the first and last ranks consume data
+    loader = self.buildLoader(10,4)
+    lp_loader = LPDataLoader(loader,comm,ranks=(0,-1))
+    consumer = rank in [0,comm.Get_size()-1]
+
+    for (data,target),(e_data,e_target) in zip(lp_loader,loader):
+      self.assertEqual(data.shape,e_data.shape)
+      if consumer:
+        self.assertTrue(torch.equal(data,e_data))
+      else:
+        self.assertEqual(data.stride(),(0,0,0))
+
+    comm.barrier()
+
+if __name__ == '__main__':
+  unittest.main()
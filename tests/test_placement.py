@@ -0,0 +1,69 @@
+#@HEADER
+# ************************************************************************
+#
+#                        Torchbraid v. 0.1
+#
+# Copyright 2020 National Technology & Engineering Solutions of Sandia, LLC
+# (NTESS). Under the terms of Contract DE-NA0003525 with NTESS, the U.S.
+# Government retains certain rights in this software.
+#
+# Torchbraid is licensed under 3-clause BSD terms of use:
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions are
+# met:
+#
+# 1. Redistributions of source code must retain the above copyright
+# notice, this list of conditions and the following disclaimer.
+#
+# 2. Redistributions in binary form must reproduce the above copyright
+# notice, this list of conditions and the following disclaimer in the
+# documentation and/or other materials provided with the distribution.
+#
+# 3. Neither the name National Technology & Engineering Solutions of Sandia,
+# LLC nor the names of the contributors may be used to endorse or promote
+# products derived from this software without specific prior written permission.
+#
+# Questions? Contact Eric C. Cyr (eccyr@sandia.gov)
+#
+# ************************************************************************
+#@HEADER
+
+import torch
+import unittest
+
+from mpi4py import MPI
+
+from torchbraid.utils.placement import assign_cores, core_string, place_rank
+
+class TestPlacement(unittest.TestCase):
+
+  def test_assignCores(self):
+    # a shared affinity is divided into blocks
+    self.assertEqual(assign_cores([[0,1,2,3]]*2,0),[0,1])
+    self.assertEqual(assign_cores([[0,1,2,3]]*2,1),[2,3])
+    self.assertEqual(assign_cores([[0,1,2,3,4]]*3,0),[0,1])
+    self.assertEqual(assign_cores([[0,1,2,3,4]]*3,2),[4])
+
+    # disjoint affinities (bound by the launcher) are kept
+    self.assertEqual(assign_cores([[0,1],[2,3]],1),[2,3])
+
+    # more processors than cores
+    self.assertEqual(assign_cores([[0,1]]*3,2),[0])
+
+  def test_coreString(self):
+    self.assertEqual(core_string([0,1,2,3,8,10,11]),'0-3,8,10-11')
+    self.assertEqual(core_string([5]),'5')
+
+  def test_placeRank(self):
+    comm = MPI.COMM_WORLD
+    device,host,placement = place_rank(comm,pin=False)
+
+    self.assertEqual(host,torch.device('cpu'))
+    self.assertEqual(placement['rank'],comm.Get_rank())
+    self.assertTrue(0<=placement['node_rank']<placement['node_size'])
+    self.assertEqual(torch.get_num_threads(),placement['threads'])
+    self.assertEqual(placement['threads'],len(placement['cores']))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -97,6 +97,52 @@ class LSTMBlock(nn.Module):
 
     return (torch.stack(hn), torch.stack(cn))
 
+class FastLSTMBlock(LSTMBlock):
+  """
+  LSTM block with a fast forward path, the input projection of the first
+  layer is computed separately by reduceX.
+  """
+  def reduceX(self, x):
+    cell = self.lstm_cells[0]
+    return (F.linear(x, cell.weight_ih, cell.bias_ih),)
+
+  def fastForward(self, level, tstart, tstop, x_red, h):
+    h_prev = h[0]
+    c_prev = h[1]
+
+    dt = tstop-tstart
+
+    hn = self.num_layers*[None]
+    cn = self.num_layers*[None]
+
+    # the first layer uses the reduced input
+    cell = self.lstm_cells[0]
+    gates = x_red[0] + F.linear(h_prev[0], cell.weight_hh, cell.bias_hh)
+    i_g, f_g, g_g, o_g = gates.chunk(4, 1)
+    cn[0] = torch.sigmoid(f_g)*c_prev[0] + torch.sigmoid(i_g)*torch.tanh(g_g)
+    hn[0] = torch.sigmoid(o_g)*torch.tanh(cn[0])
+
+    x_cur = hn[0]
+    for i in range(1,self.num_layers):
+      hn[i], cn[i] = self.lstm_cells[i](x_cur, (h_prev[i], c_prev[i]))
+      x_cur = hn[i]
+
+    # handle implicitness on coarse levels
+    if level>0:
+      for i in range(self.num_layers):
+        hn[i] = (h_prev[i]+dt*hn[i])/(1.0+dt)
+        cn[i] = (c_prev[i]+dt*cn[i])/(1.0+dt)
+
+    return (torch.stack(hn), torch.stack(cn))
+
+class SequenceLSTMBlock(FastLSTMBlock):
+  """
+  LSTM block that also reduces a whole (batch x time x input) sequence at once.
+  """
+  def reduceXSequence(self, x):
+    # the projection acts on the last dimension
+    return self.reduceX(x)
+
 def RNN_build_block_with_dim(input_size, hidden_size, num_layers):
   b = LSTMBlock(input_size, hidden_size, num_layers) # channels = hidden_size
   return b
@@ -159,6 +205,59 @@ class TestRNNLayerParallel(unittest.TestCase):
   def test_forward_approx(self):
     self.forwardProp(max_levels=3,max_iters=20)
 
+  def test_forward_reduced(self):
+    sequence_length = 28
+    input_size = 28
+    hidden_size = 20
+    num_layers = 2
+
+    comm      = MPI.COMM_WORLD
+    num_procs = comm.Get_size()
+    my_rank   = comm.Get_rank()
+
+    my_device,my_host = getDevice(comm)
+
+    x_block = preprocess_distribute_input_data_parallel(my_rank,num_procs,1,1,1,sequence_length,input_size,comm,my_device)
+    num_steps = x_block[0].shape[1]
+
+    # the same network evaluating the step, the step with per step reduction
+    # of the input, and the step with the reduction of the whole sequence
+    outputs = []
+    calls = []
+    for block in [LSTMBlock,FastLSTMBlock,SequenceLSTMBlock]:
+      parallel_rnn = torchbraid.RNN_Parallel(comm,
+                                             block(input_size,hidden_size,num_layers),
+                                             num_steps,
+                                             hidden_size,
+                                             num_layers,
+                                             float(sequence_length),
+                                             max_fwd_levels=3,
+                                             max_bwd_levels=3,
+                                             max_iters=20)
+      parallel_rnn.to(my_device)
+      parallel_rnn.setPrintLevel(0)
+      parallel_rnn.setSkipDowncycle(True)
+      parallel_rnn.setCFactor(2)
+      parallel_rnn.setNumRelax(1)
+
+      with torch.no_grad():
+        y_hn,y_cn = parallel_rnn(x_block[0])
+      outputs += [(y_hn.cpu(),y_cn.cpu())]
+      calls += [parallel_rnn.getFastForwardInfo()[1]]
+
+    (ref_hn,ref_cn),(fast_hn,fast_cn),(seq_hn,seq_cn) = outputs
+    self.assertTrue(torch.allclose(fast_hn,ref_hn,rtol=1e-5,atol=1e-6))
+    self.assertTrue(torch.allclose(fast_cn,ref_cn,rtol=1e-5,atol=1e-6))
+    self.assertTrue(torch.allclose(seq_hn,fast_hn,rtol=1e-5,atol=1e-6))
+    self.assertTrue(torch.allclose(seq_cn,fast_cn,rtol=1e-5,atol=1e-6))
+
+    # the sequence is reduced in one call (plus one for the halo)
+    self.assertGreater(calls[1],2)
+    self.assertLessEqual(calls[2],2)
+
+    comm.barrier()
+  # end test_forward_reduced
+
   def test_backward_exact(self):
     self.backwardProp()
 
@@ -168,6 +267,15 @@ class TestRNNLayerParallel(unittest.TestCase):
   def test_backward_approx(self):
     self.backwardProp(max_levels=3,max_iters=20,sequence_length=27,tol=1e-5)
 
+  def test_backward_recompute(self):
+    self.backwardProp(applications=2,storage_mb=0.0)
+
+  def test_backward_recompute_fastforward(self):
+    self.backwardProp(applications=2,storage_mb=0.0,block=SequenceLSTMBlock)
+
+  def test_backward_storage_last(self):
+    self.backwardProp(max_levels=3,max_iters=20,sequence_length=27,tol=1e-5,storage_mb=0.01,storage_policy='keep_last')
+
   # TODO: dead code?
   # def copyParameterGradToRoot(self,m):
   #   comm     = m.getMPIComm()
@@ -298,7 +406,10 @@ class TestRNNLayerParallel(unittest.TestCase):
                    num_layers = 1,
                    batch_size = 1,
                    tol=1e-6,
-                   applications=1):
+                   applications=1,
+                   storage_mb=None,
+                   storage_policy='keep_first',
+                   block=LSTMBlock):
 
     comm      = MPI.COMM_WORLD
     num_procs = comm.Get_size()
@@ -325,7 +436,7 @@ class TestRNNLayerParallel(unittest.TestCase):
 
     num_steps = x_block[0].shape[1]
 
-    basic_block_parallel = lambda: RNN_build_block_with_dim(input_size, hidden_size, num_layers)
+    basic_block_parallel = lambda: block(input_size, hidden_size, num_layers)
     parallel_rnn = torchbraid.RNN_Parallel(comm,
                                            basic_block_parallel(),
                                            num_steps,
@@ -340,6 +451,7 @@ class TestRNNLayerParallel(unittest.TestCase):
     parallel_rnn.setSkipDowncycle(True)
     parallel_rnn.setCFactor(cfactor)
     parallel_rnn.setNumRelax(nrelax)
+    parallel_rnn.setGraphStorage(storage_mb,storage_policy)
 
     torch.manual_seed(20)
     rand_w = torch.randn([1,x_block[0].size(0),hidden_size],device=my_device)
@@ -360,6 +472,12 @@ class TestRNNLayerParallel(unittest.TestCase):
 
       y_parallel_hn.backward(w_h)
 
+      # with no storage every step is recomputed
+      stats = parallel_rnn.getGraphStorageStats()
+      if storage_mb==0.0:
+        self.assertEqual(stats['hits'],0)
+        self.assertEqual(stats['stored'],0)
+
       if i<applications-1:
         with torch.no_grad():
           for p in parallel_rnn.parameters():